@@ -1,26 +1,178 @@
+import hashlib
 import json
+import logging
 import sqlite3
-from collections import OrderedDict
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from functools import wraps
 from copy import deepcopy
+from itertools import chain, islice
 
 from anki_base import *
 from misc import *
 from util import *
+from template_cache import TemplateCache, process_template_cache
 import re
 
 # logger = get_logger("AnkiCollectionWriter")
 
+# rows per executemany batch
+BULK_INSERT_CHUNK = 5000
+# cards per task of the conversion workers
+CONVERT_CHUNK = 2000
+# fewer cards are converted in this process, starting the workers costs more than it saves
+PARALLEL_MIN_CARDS = 20000
+# sqlite virtual machine steps between two looks at the cancel token, a few ms
+CANCEL_CHECK_STEPS = 100000
+# the collection is a scratch file until it is packed, so durability is not needed while building
+BUILD_PRAGMAS = [
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -32768",  # KiB, bounded no matter the deck size
+    # only takes effect on the VACUUM in optimize()
+    "PRAGMA page_size = 4096",
+]
+
+# the mutable values of BASE_DECK, copied for every deck
+DECK_LIST_KEYS = [k for k, v in BASE_DECK.items() if isinstance(v, list)]
+
+# {template path: in-memory copy of the template with the old rows cleared}, one per process
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def load_template(template_path):
+    """read the template collection once per process into an in-memory database"""
+    with _templates_lock:
+        if template_path not in _templates:
+            assert os.path.exists(template_path), f"File not exists: {template_path}"
+            src = sqlite3.connect(template_path)
+            template = sqlite3.connect(":memory:", check_same_thread=False)
+            src.backup(template)
+            src.close()
+            with template as c:
+                for table in ["cards", "notes", "revlog", "col"]:
+                    c.execute(f"DELETE FROM {table}")
+            template.execute("VACUUM")
+            _templates[template_path] = template
+        return _templates[template_path]
+
+
+def open_collection(template_path, collection_path=":memory:"):
+    """clone the cached template into a new collection, in memory by default"""
+    template = load_template(template_path)
+    con = sqlite3.connect(collection_path)
+    with _templates_lock:
+        template.backup(con)
+    return con
+
+
+def dump_collection(con):
+    """the bytes of the collection file, written as collection.anki2"""
+    if hasattr(con, "serialize"):
+        # python 3.11+
+        return con.serialize()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "collection.anki2")
+        dst = sqlite3.connect(path)
+        con.backup(dst)
+        dst.close()
+        with open(path, "rb") as f:
+            return f.read()
+
+
+def load_collection(data, collection_path=":memory:"):
+    """open the bytes of a collection file (see dump_collection), in memory by default"""
+    con = sqlite3.connect(collection_path)
+    if collection_path == ":memory:" and hasattr(con, "deserialize"):
+        # python 3.11+
+        con.deserialize(data)
+        return con
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "collection.anki2")
+        with open(path, "wb") as f:
+            f.write(data)
+        src = sqlite3.connect(path)
+        src.backup(con)
+        src.close()
+    return con
+
+
+def build_note(mod, idx, model_id, model, fields_dict):
+    """the notes row of a card"""
+    fields = AnkiCollectionWriter.insert_fields_to_notes(idx, fields_dict, model)
+    # the same cid keeps its guid, whatever the rpk is named, so a re-import updates the note instead of adding one
+    return (idx, stable_guid(idx), model_id, mod, -1, '',
+            # flds
+            '\x1f'.join(fields),
+            fields[0],
+            field_checksum(fields[0]),
+            0, '')
+
+
+def note_hash(mid, flds):
+    """hash of what a re-import of a note would change"""
+    return hashlib.sha1(f"{mid}\x1f{flds}".encode("utf-8")).hexdigest()[:16]
+
+
+# (mod, models) of the conversion a worker process serves, see init_convert_worker
+_worker_state = None
+
+
+def init_convert_worker(mod, models):
+    global _worker_state
+    _worker_state = (mod, models)
+
+
+def convert_chunk(chunk):
+    """notes rows of [(cid, model id, card data)], runs in a worker process"""
+    mod, models = _worker_state
+    return [build_note(mod, idx, model_id, models[str(model_id)], data)
+            for idx, model_id, data in chunk]
+
+
+def interruptible(method):
+    """raise Cancelled instead of the sqlite error of a statement the cancel token interrupted"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except sqlite3.OperationalError:
+            if self.cancel_token is not None:
+                self.cancel_token.check()
+            raise
+    return wrapper
+
 
 class AnkiCollectionWriter:
     def __init__(self,
                  root_deck_name: str,
-                 collection_path: str,
+                 collection,
                  cats_df: OrderedDict,
                  cards_df: OrderedDict,
-                 tpls_df: OrderedDict
+                 tpls_df: OrderedDict,
+                 mod: int = None,
+                 template_cache: TemplateCache = None,
+                 workers: int = None,
+                 cancel_token=None,
+                 model_ids=None
                  ):
-        assert os.path.exists(collection_path), f"File not exists: {collection_path}"
-        self.con = sqlite3.connect(collection_path)
+        """collection: path of the collection file, or an open sqlite3 connection (see open_collection)
+
+        mod: modification time of the notes and cards, when the content was exported; now by default.
+        anki only updates a note on re-import when its mod is newer
+        template_cache: models of the tpl records already built, the one of the process by default
+        workers: processes converting the card fields of big decks, the rows are still written by this one
+        cancel_token: a cancellation.CancelToken checked between two batches of rows, and by sqlite while a
+        statement runs: VACUUM and the index builds of a huge deck take a while
+        model_ids: write only these models, e.g. not the back side of a tpl record no card uses
+        """
+        if isinstance(collection, sqlite3.Connection):
+            self.con = collection
+        else:
+            assert os.path.exists(collection), f"File not exists: {collection}"
+            self.con = sqlite3.connect(collection)
         self.root_deck_name = root_deck_name
         self.cats_df = cats_df
         self.cards_df = cards_df
@@ -31,10 +183,129 @@ class AnkiCollectionWriter:
                 self.insert_default_deck = True
                 break
         self.tpls_df = tpls_df
+        self.mod = mod or now_sec()
+        self.template_cache = template_cache or process_template_cache
+        self.workers = workers
+        self.cancel_token = cancel_token
+        if cancel_token is not None:
+            # a true result interrupts the statement running, see interruptible
+            self.con.set_progress_handler(lambda: cancel_token.cancelled, CANCEL_CHECK_STEPS)
+        self.model_ids = model_ids
+        self.models = None
 
     def close(self):
         self.con.close()
 
+    def apply_build_pragmas(self):
+        for pragma in BUILD_PRAGMAS:
+            self.con.execute(pragma)
+
+    def drop_indexes(self, tables=("notes", "cards")):
+        """drop the indexes of `tables` before a bulk load, returns the sql to recreate them"""
+        rows = self.con.execute(
+            f"SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"
+            f" AND tbl_name IN ({', '.join('?' * len(tables))})", tables).fetchall()
+        with self.con as c:
+            for name, _ in rows:
+                c.execute(f"DROP INDEX {name}")
+        return [sql for _, sql in rows]
+
+    @interruptible
+    def create_indexes(self, index_sqls):
+        with self.con as c:
+            for sql in index_sqls:
+                c.execute(sql)
+
+    @interruptible
+    def delete_notes(self, cids):
+        with self.con as c:
+            c.executemany("DELETE FROM cards WHERE nid = ?", [(x,) for x in cids])
+            c.executemany("DELETE FROM notes WHERE id = ?", [(x,) for x in cids])
+            c.commit()
+
+    @interruptible
+    def update_due(self, dues):
+        """dues: [(due, cid)] of the cards that moved"""
+        with self.con as c:
+            c.executemany("UPDATE cards SET due = ? WHERE id = ?", dues)
+            c.commit()
+
+    @interruptible
+    def rewrite_media_references(self, aliases):
+        """point the fields at other media files, aliases: {old filename: new filename}
+
+        only the forms written by convert_to_apkg_format are rewritten (<img src="x"> and [sound:x]),
+        returns the old filenames that are still mentioned somewhere else (other html, templates, css)
+        """
+        if not aliases:
+            return set()
+        ref_re = re.compile(r'(src="|\[sound:)([^"\]]*)(?=["\]])')
+        names_re = re.compile("|".join(re.escape(x) for x in sorted(aliases, key=len, reverse=True)))
+
+        def replace(m):
+            return m.group(1) + aliases.get(m.group(2), m.group(2))
+
+        updates = []
+        still_referenced = set()
+        for idx, flds, sfld in self.con.execute("SELECT id, flds, sfld FROM notes"):
+            if names_re.search(flds) is None:
+                continue
+            new_flds = ref_re.sub(replace, flds)
+            new_sfld = ref_re.sub(replace, str(sfld))
+            still_referenced.update(names_re.findall(new_flds))
+            # the checksum of the first field covers the names of its images
+            updates.append((new_flds, new_sfld, field_checksum(new_flds.split('\x1f', 1)[0]), idx))
+        with self.con as c:
+            c.executemany("UPDATE notes SET flds = ?, sfld = ?, csum = ? WHERE id = ?", updates)
+            c.commit()
+        models = self.con.execute("SELECT models FROM col").fetchone()[0]
+        still_referenced.update(names_re.findall(models))
+        return still_referenced
+
+    @interruptible
+    def keep_unchanged_mods(self, previous, out):
+        """give the notes whose model and fields did not change since the previous apkg their mod back, and to
+        their cards: a re-import only updates the notes that changed
+
+        previous: (note id, note_hash, mod) of the previous apkg by id, see build_manifest.iter_note_mods.
+        out: text file the same lines of every note are written to, for the next conversion.
+        Both go by id a batch at a time, so memory stays flat whatever the deck size
+        """
+        previous = iter(previous)
+        last = next(previous, None)
+        after = -1 << 63
+        kept = 0
+        while True:
+            rows = self.con.execute("SELECT id, mid, flds, mod FROM notes WHERE id > ? ORDER BY id LIMIT ?",
+                                    (after, BULK_INSERT_CHUNK)).fetchall()
+            if not rows:
+                break
+            lines = []
+            updates = []
+            for idx, mid, flds, mod in rows:
+                while last is not None and last[0] < idx:
+                    last = next(previous, None)
+                h = note_hash(mid, flds)
+                if last is not None and last[0] == idx and last[1] == h and last[2] != mod:
+                    mod = last[2]
+                    updates.append((mod, idx))
+                lines.append(f"{idx} {h} {mod}\n")
+            out.write("".join(lines))
+            with self.con as c:
+                c.executemany("UPDATE notes SET mod = ? WHERE id = ?", updates)
+                c.executemany("UPDATE cards SET mod = ? WHERE nid = ?", updates)
+                c.commit()
+            kept += len(updates)
+            after = rows[-1][0]
+        logging.info(f"{kept} unchanged notes keep their previous mod")
+        return kept
+
+    @interruptible
+    def optimize(self):
+        """refresh the planner statistics and compact the file, call once before packing"""
+        self.con.execute("ANALYZE")
+        self.con.execute("VACUUM")
+
     def clear_old_rows(self):
         with self.con as c:
             c.execute("DELETE FROM cards")
@@ -128,80 +399,123 @@ class AnkiCollectionWriter:
             .replace("class='answer", "class='GF_answer") \
             .replace("class=\"answer", "class=\"GF_answer")
 
-    def get_decks(self):
-        def get_deck_name(idx, child_name=None):
-            """recursively build the deck name"""
-            row = self.cats_df[idx]
-            deck_name = row['name'] if child_name is None else f"{row['name']}::{child_name}"
-            if row['pid'] == 0:
-                return self.root_deck_name + "::" + deck_name
+    def get_deck_names(self):
+        """{aid: full deck name}, resolved in one pass: every walk up the pids stops at the first resolved category
+
+        a pid that is not a category, or a cycle of pids, is reported and hung under the root deck
+        """
+        names = {}
+        for aid in self.cats_df:
+            # the unresolved categories from aid up, and the name they hang under
+            path = []
+            on_path = set()
+            parent_name = self.root_deck_name
+            cur = aid
+            while cur not in names:
+                row = self.cats_df.get(cur)
+                if row is None:
+                    logging.warning(f"Category {path[-1]} has a missing parent {cur}, put under the root deck")
+                    break
+                if cur in on_path:
+                    logging.warning(f"Category {cur} is in a cycle of parents, put under the root deck")
+                    break
+                path.append(cur)
+                on_path.add(cur)
+                if row['pid'] == 0:
+                    break
+                cur = row['pid']
             else:
-                return get_deck_name(row['pid'], deck_name)
-
-        decks = {}
-        for idx, row in self.cats_df.items():
-            deck_info = deepcopy(BASE_DECK)
-            deck_info['id'] = idx
-            deck_info['name'] = get_deck_name(idx)
-            decks[str(idx)] = deck_info
+                parent_name = names[cur]
+            for idx in reversed(path):
+                parent_name = f"{parent_name}::{self.cats_df[idx]['name']}"
+                names[idx] = parent_name
+        return names
+
+    @staticmethod
+    def new_deck(deck_id, name):
+        """a copy of BASE_DECK, its lists are the only values that need copying"""
+        deck = BASE_DECK.copy()
+        for key in DECK_LIST_KEYS:
+            deck[key] = deck[key][:]
+        deck['id'] = deck_id
+        deck['name'] = name
+        return deck
+
+    def get_decks(self):
+        names = self.get_deck_names()
+        # in category order, the first deck becomes the current one
+        decks = {str(idx): self.new_deck(idx, names[idx]) for idx in self.cats_df}
         if self.insert_default_deck or len(decks) == 0:
             # 添加一个默认目录
-            deck_info = deepcopy(BASE_DECK)
-            deck_info['id'] = DEFAULT_DECK_ID
-            deck_info['name'] = self.root_deck_name
-            decks[str(DEFAULT_DECK_ID)] = deck_info
+            decks[str(DEFAULT_DECK_ID)] = self.new_deck(DEFAULT_DECK_ID, self.root_deck_name)
         return decks
 
     @staticmethod
     def process_tmpl(tmpl: str):
         return str(tmpl).replace("{{@", "{{")
 
-    def get_models(self):
-        models = {}
-        for idx, row in self.tpls_df.items():
-            model = deepcopy(BASE_MODEL)
-            model['name'] = row['name']
-            model['css'] += row['css']
+    def build_models(self, row):
+        """[model, model of the back side or None] of a tpl record, without their ids"""
+        model = deepcopy(BASE_MODEL)
+        model['name'] = row['name']
+        model['css'] += row['css']
+        for ord, f in enumerate(row['fields']):
+            field = deepcopy(BASE_FIELD)
+            field['name'] = f['name']
+            field['ord'] = ord
+            model['flds'].append(field)
+        tmpl = deepcopy(BASE_TMPL)
+        if "填空" in row['name']:
+            tmpl['qfmt'] = self.process_tmpl(row['front']).replace("{{问题}}", "{{cloze:问题}}")
+            tmpl['afmt'] = self.process_tmpl(row['back']).replace("{{问题}}", "{{cloze:问题}}")
+        else:
+            tmpl['qfmt'] = self.process_tmpl(row['front'])
+            tmpl['afmt'] = self.process_tmpl(row['back'])
+        model['tmpls'].append(tmpl)
+
+        # handle double-sided cards
+        model2 = None
+        if len(row['front_back'].strip()) > 0:
+            model2 = deepcopy(BASE_MODEL)
+            model2['name'] = row['name'] + "_back"
+            model2['css'] += row['css_back']
             for ord, f in enumerate(row['fields']):
                 field = deepcopy(BASE_FIELD)
                 field['name'] = f['name']
                 field['ord'] = ord
-                model['flds'].append(field)
+                model2['flds'].append(field)
             tmpl = deepcopy(BASE_TMPL)
-            if "填空" in row['name']:
-                tmpl['qfmt'] = self.process_tmpl(row['front']).replace("{{问题}}", "{{cloze:问题}}")
-                tmpl['afmt'] = self.process_tmpl(row['back']).replace("{{问题}}", "{{cloze:问题}}")
-            else:
-                tmpl['qfmt'] = self.process_tmpl(row['front'])
-                tmpl['afmt'] = self.process_tmpl(row['back'])
-            model['tmpls'].append(tmpl)
-
-            # handle double-sided cards
-            if len(row['front_back'].strip()) > 0:
-                model2 = deepcopy(BASE_MODEL)
-                model2['name'] = row['name'] + "_back"
-                model2['css'] += row['css_back']
-                # XXX: use N+1 as back's model id
-                model2['id'] = str(idx + 1)
-                for ord, f in enumerate(row['fields']):
-                    field = deepcopy(BASE_FIELD)
-                    field['name'] = f['name']
-                    field['ord'] = ord
-                    model2['flds'].append(field)
-                tmpl = deepcopy(BASE_TMPL)
-                tmpl['qfmt'] = self.process_tmpl(row['front_back'])
-                tmpl['afmt'] = self.process_tmpl(row['back_back'])
-                model2['tmpls'].append(tmpl)
-                models[str(idx + 1)] = model2
-
-            if '[choice:A]' in model['tmpls'][0]['qfmt']:
-                # 处理选择题的特殊格式
-                AnkiCollectionWriter.modify_model_for_choices(model)
-
-            model['id'] = str(idx)
-            models[str(idx)] = model
-        return models
+            tmpl['qfmt'] = self.process_tmpl(row['front_back'])
+            tmpl['afmt'] = self.process_tmpl(row['back_back'])
+            model2['tmpls'].append(tmpl)
+
+        if '[choice:A]' in model['tmpls'][0]['qfmt']:
+            # 处理选择题的特殊格式
+            AnkiCollectionWriter.modify_model_for_choices(model)
+        return [model, model2]
+
+    def get_models(self):
+        """{model id: model}, built once per writer, the tpl records go through the template cache"""
+        if self.models is None:
+            models = {}
+            for idx, row in self.tpls_df.items():
+                built = self.template_cache.get(row)
+                if built is None:
+                    built = self.build_models(row)
+                    self.template_cache.put(row, built)
+                model, model2 = built
+                if model2 is not None:
+                    # XXX: use N+1 as back's model id
+                    model2['id'] = str(idx + 1)
+                    models[str(idx + 1)] = model2
+                model['id'] = str(idx)
+                models[str(idx)] = model
+            if self.model_ids is not None:
+                models = {mid: model for mid, model in models.items() if int(mid) in self.model_ids}
+            self.models = models
+        return self.models
 
+    @interruptible
     def insert_col_table(self):
         models = self.get_models()
         decks = self.get_decks()
@@ -212,7 +526,7 @@ class AnkiCollectionWriter:
         conf['curModel'] = next(iter(models))
 
         with self.con as c:
-            c.execute('INSERT INTO col (id, crt, mod, scm, ver, dty, usn, ls, conf, models, decks, dconf, tags)'
+            c.execute('INSERT OR REPLACE INTO col (id, crt, mod, scm, ver, dty, usn, ls, conf, models, decks, dconf, tags)'
                       ' values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
                       (1, now_sec(), now_ms(), now_ms(), SCHEMA_VERSION, 0, 0, 0,
                        # conf
@@ -225,7 +539,8 @@ class AnkiCollectionWriter:
 
             c.commit()
 
-    def insert_fields_to_notes(self, idx, fields_dict, model):
+    @staticmethod
+    def insert_fields_to_notes(idx, fields_dict, model):
         fields = []
         # insert fields according to static/anki-awesome-select.json
         if model['name'] == "AwesomeSelect-3.x":
@@ -256,48 +571,111 @@ class AnkiCollectionWriter:
                 fields.append(f)
         return fields
 
-    def insert_notes_table(self):
+    def iter_cards(self, only=None):
+        """yield (due, cid, model id, card record) of every card, or of the cids in `only`"""
+        cnt = 0
+        for idx, row in self.cards_df.items():
+            cnt += 1
+            if only is not None and idx not in only:
+                continue
+            model_id = row['tid']
+            if row['is_back'] == 1:
+                model_id += 1
+            yield cnt, idx, model_id, row
+
+    def card_row(self, due, idx, row):
+        # aid (cats id) as did
+        deckId = row['aid']
+        # “未分类”卡片，换成另外一个deck id
+        if deckId == 0:
+            deckId = DEFAULT_DECK_ID
+        return (idx, idx,  # same cid, did
+                deckId,
+                0,  # ord
+                self.mod,
+                -1, 0, 0,
+                due,  # from 1 as due
+                0, 0, 0, 0, 0, 0, 0, 0,
+                '')
+
+    def iter_note_rows(self, only=None):
+        """yield a (notes row, cards row) pair for every card, or for the cids in `only`
+
+        the fields are converted by self.workers processes from PARALLEL_MIN_CARDS cards on; a streamed
+        cards.json has no length, its first PARALLEL_MIN_CARDS cards are read before deciding
+        """
         models = self.get_models()
+        cards = self.iter_cards(only)
+        if self.workers and self.workers > 1:
+            if only is not None:
+                count = len(only)
+            elif isinstance(self.cards_df, dict):
+                count = len(self.cards_df)
+            else:
+                head = list(islice(cards, PARALLEL_MIN_CARDS))
+                count = len(head)
+                cards = chain(head, cards)
+            if count >= PARALLEL_MIN_CARDS:
+                yield from self.iter_note_rows_parallel(models, cards)
+                return
+        for due, idx, model_id, row in cards:
+            note = build_note(self.mod, idx, model_id, models[str(model_id)], row['data'])
+            yield note, self.card_row(due, idx, row)
 
-        cnt = 0
+    def iter_note_rows_parallel(self, models, cards):
+        """iter_note_rows with the fields converted by self.workers processes, in card order
+
+        cards: iterator of iter_cards. At most two chunks per worker are in flight, so a streamed cards.json
+        is not read ahead
+        """
+        # only loaded by the conversions using workers
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        logging.info(f"Converting the card fields in {self.workers} processes")
+        # spawn: forking while the download and pack threads run could inherit their held locks
+        pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=init_convert_worker, initargs=(self.mod, models))
+        pending = deque()
+        try:
+            while True:
+                while len(pending) < 2 * self.workers:
+                    chunk = list(islice(cards, CONVERT_CHUNK))
+                    if not chunk:
+                        break
+                    task = [(idx, model_id, row['data']) for _, idx, model_id, row in chunk]
+                    pending.append((chunk, pool.submit(convert_chunk, task)))
+                if not pending:
+                    break
+                chunk, future = pending.popleft()
+                for (due, idx, _, row), note in zip(chunk, future.result()):
+                    yield note, self.card_row(due, idx, row)
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    @interruptible
+    def insert_notes_table(self, only=None):
+        """insert the notes and cards of every card, or of the cids in `only` into an existing collection,
+        returns the number of cards inserted"""
+        # a few rows are cheaper to index one by one than rebuilding the indexes
+        index_sqls = self.drop_indexes() if only is None else []
+        rows = self.iter_note_rows(only)
+        count = 0
         with self.con as c:
-            for idx, row in self.cards_df.items():
-                # logger.info(f'Writing card {row}')
-
-                # aid (cats id) as did
-                deckId = row['aid']
-                # “未分类”卡片，换成另外一个deck id
-                if deckId == 0:
-                    deckId = DEFAULT_DECK_ID
-                cnt += 1
-                tid = row['tid']
-                model_id = tid
-                if row['is_back'] == 1:
-                    model_id += 1
-                model = models[str(model_id)]
-                fields_dict = row['data']
-                fields = self.insert_fields_to_notes(idx, fields_dict, model)
-
-                c.execute("INSERT INTO notes (id, guid, mid, mod, usn, tags, flds, sfld, csum, flags, data)"
-                          " values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                          (idx, gen_guid(), model_id, now_sec(), -1, '',
-                           # flds
-                           '\x1f'.join(fields),
-                           fields[0],
-                           # fake csum
-                           random.randint(0, 1000000),
-                           0, ''
-                           ))
-                c.execute(
+            while True:
+                if self.cancel_token is not None:
+                    self.cancel_token.check()
+                chunk = list(islice(rows, BULK_INSERT_CHUNK))
+                if not chunk:
+                    break
+                count += len(chunk)
+                c.executemany("INSERT INTO notes (id, guid, mid, mod, usn, tags, flds, sfld, csum, flags, data)"
+                              " values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                              [note for note, _ in chunk])
+                c.executemany(
                     "INSERT INTO cards (id, nid, did, ord, mod, usn, type, queue, due, ivl, factor, reps, lapses, left, odue, odid, flags, data)"
                     " values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                    (idx, idx,  # same cid, did
-                     deckId,
-                     0,  # ord
-                     now_sec(),
-                     -1, 0, 0,
-                     cnt,  # from 1 as due
-                     0, 0, 0, 0, 0, 0, 0, 0,
-                     ''
-                     ))
+                    [card for _, card in chunk])
             c.commit()
+        self.create_indexes(index_sqls)
+        return count
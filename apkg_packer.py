@@ -0,0 +1,456 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+import zipfile
+import zlib
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+COPY_BUFFER_SIZE = 1024 * 1024
+# formats that are compressed already, deflating them again costs CPU and saves next to nothing
+STORED_EXTENSIONS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".heic",
+    ".mp3", ".m4a", ".aac", ".ogg", ".oga", ".opus", ".flac", ".spx",
+    ".mp4", ".m4v", ".webm", ".mov", ".mkv",
+    ".zip", ".gz", ".7z", ".rar", ".woff", ".woff2",
+}
+# zip can not store timestamps before 1980
+MIN_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# zlib levels, fast for local testing, best for distribution
+COMPRESS_LEVELS = {"fast": 1, "default": 6, "best": 9}
+DEFAULT_COMPRESS_LEVEL = COMPRESS_LEVELS["default"]
+# members are deflated in blocks of this size, each block by its own thread
+DEFLATE_BLOCK_SIZE = 1024 * 1024
+# every block is primed with the tail of the previous one, so splitting costs next to no ratio
+DEFLATE_WINDOW = 32 * 1024
+# blocks compressed or being compressed but not written yet, per thread
+MAX_PENDING_BLOCKS_PER_THREAD = 4
+
+
+def compress_type_for(filename):
+    return zipfile.ZIP_STORED if os.path.splitext(filename)[1].lower() in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def hash_source(opener):
+    digest = hashlib.sha1()
+    with opener() as src:
+        while True:
+            chunk = src.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PackStats:
+    def __init__(self):
+        self.files = 0
+        self.bytes_in = 0
+        self.dedup_files = 0
+        self.dedup_bytes = 0
+        # copied from the previous apkg without compressing them again
+        self.reused_files = 0
+        self.stored_bytes = 0
+        self.deflated_bytes = 0
+        # summed over the compressing threads
+        self.deflate_sec = 0.0
+
+    def report(self):
+        message = (f"{self.files} media files, {self.bytes_in / 1024 / 1024:.1f} MB:"
+                   f" {self.dedup_files} duplicates ({self.dedup_bytes / 1024 / 1024:.1f} MB) skipped,"
+                   f" {self.stored_bytes / 1024 / 1024:.1f} MB stored without deflate")
+        if self.reused_files:
+            message += f", {self.reused_files} copied from the previous apkg"
+        if self.deflate_sec > 0 and self.deflated_bytes > 0:
+            # what deflating the stored files would have cost at the speed measured on the others
+            saved_sec = self.stored_bytes / (self.deflated_bytes / self.deflate_sec)
+            message += f", ~{saved_sec:.1f}s of deflate saved"
+        return message
+
+
+class MediaFile:
+    """a media file already packed, hashed only when another file of the same size shows up"""
+
+    def __init__(self, filename, opener, size):
+        self.filename = filename
+        self.opener = opener
+        self.size = size
+        self._sha1 = None
+
+    @property
+    def sha1(self):
+        if self._sha1 is None:
+            self._sha1 = hash_source(self.opener)
+        return self._sha1
+
+
+class PendingEntry:
+    """a zip member queued for writing, members are written in the order they were added"""
+
+    def __init__(self, arcname, compress_type, size, date_time, opener=None, media_file=None):
+        self.arcname = arcname
+        self.compress_type = compress_type
+        self.size = size
+        self.date_time = date_time
+        # stored members are copied from the opener when their turn comes
+        self.opener = opener
+        # the MediaFile whose sha1 is recorded while writing, with record_hashes
+        self.media_file = media_file
+        # members of a previous apkg, copied as they are (see add_raw_media)
+        self.raw = None
+        # deflated members: futures of the compressed blocks, in order
+        self.blocks = deque()
+        self.submitted = False
+        self.crc = 0
+        self.zinfo = None
+        self.zip64 = False
+
+
+class ApkgPacker:
+    """writes an apkg: the numbered media files, the media map and collection.anki2
+
+    deflated members are compressed in blocks by a thread pool (zlib releases the GIL) and
+    appended to the zip in the order they were added, so the output does not depend on the
+    number of threads. Archives over 4 GB are written with ZIP64.
+
+    media files with the same content are written once, the duplicates are kept aside
+    (see get_aliases / write_duplicates) until the references to them are rewritten. The name kept for
+    the content is the smallest of them, whatever order the files came in.
+    """
+
+    def __init__(self, path, dedup=True, compress_level=DEFAULT_COMPRESS_LEVEL, threads=None, record_hashes=False,
+                 cancel_token=None):
+        """path: the apkg file, or a writable file object such as io.BytesIO
+        record_hashes: hash every media file while writing it, see media_hashes
+        cancel_token: a cancellation.CancelToken checked between two blocks, abort() the packer after Cancelled"""
+        self.path = path
+        self.cancel_token = cancel_token
+        self.zipf = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.dedup = dedup
+        self.record_hashes = record_hashes
+        self.compress_level = compress_level
+        self.threads = threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix="deflate")
+        self.pending = deque()
+        self.pending_blocks = 0
+        self.max_pending_blocks = self.threads * MAX_PENDING_BLOCKS_PER_THREAD
+        # {arcname: filename}, written as the media map
+        self.media = {}
+        # {size: [MediaFile]}, only files of the same size can be duplicates
+        self.written = defaultdict(list)
+        # [(filename, canonical filename, opener, size, date_time, PreviousMedia or None)]
+        self.duplicates = []
+        # {filename: MediaFile} of the media written
+        self.media_files = {}
+        # {filename: (opener, size, date_time, PreviousMedia or None)} of the media written
+        self.sources = {}
+        self.canonicals_chosen = False
+        self.stats = PackStats()
+        self.stats_lock = threading.Lock()
+
+    def next_arcname(self):
+        return str(len(self.media))
+
+    def compress_block(self, data, zdict, last):
+        start = time.process_time()
+        if zdict:
+            c = zlib.compressobj(self.compress_level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+        else:
+            c = zlib.compressobj(self.compress_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        # a sync flush ends the block on a byte boundary without ending the deflate stream
+        out = c.compress(data) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+        with self.stats_lock:
+            self.stats.deflate_sec += time.process_time() - start
+        return out
+
+    def hashing(self, entry):
+        """a sha1 to feed with the content of entry, None when it is not recorded"""
+        if self.record_hashes and entry.media_file is not None and entry.media_file._sha1 is None:
+            return hashlib.sha1()
+        return None
+
+    def add_entry(self, arcname, opener, size, date_time, compress_type, media_file=None):
+        entry = PendingEntry(arcname, compress_type, size, max(tuple(date_time), MIN_DATE_TIME),
+                             media_file=media_file)
+        self.pending.append(entry)
+        if compress_type == zipfile.ZIP_STORED:
+            entry.opener = opener
+            entry.submitted = True
+            self.stats.stored_bytes += size
+            self.write_ready(wait=False)
+            return
+        self.stats.deflated_bytes += size
+        digest = self.hashing(entry)
+        with opener() as src:
+            zdict = b""
+            data = src.read(DEFLATE_BLOCK_SIZE)
+            while True:
+                next_data = src.read(DEFLATE_BLOCK_SIZE)
+                last = not next_data
+                entry.crc = zlib.crc32(data, entry.crc)
+                if digest is not None:
+                    digest.update(data)
+                if self.cancel_token is not None:
+                    self.cancel_token.check()
+                while self.pending_blocks >= self.max_pending_blocks:
+                    self.write_ready(wait=True)
+                entry.blocks.append(self.executor.submit(self.compress_block, data, zdict, last))
+                self.pending_blocks += 1
+                if last:
+                    break
+                zdict = (zdict + data)[-DEFLATE_WINDOW:]
+                data = next_data
+        if digest is not None:
+            media_file._sha1 = digest.hexdigest()
+        entry.submitted = True
+        self.write_ready(wait=False)
+
+    def write_ready(self, wait):
+        """append the queued members that are ready, in order. wait: block until the first one moves on"""
+        fp = self.zipf.fp
+        while self.pending:
+            entry = self.pending[0]
+            if entry.raw is not None:
+                self.write_raw(entry)
+                self.pending.popleft()
+                continue
+            if entry.compress_type == zipfile.ZIP_STORED:
+                zinfo = zipfile.ZipInfo(entry.arcname, entry.date_time)
+                zinfo.compress_type = zipfile.ZIP_STORED
+                # lets zipfile pick zip64 up front for members over 4 GB
+                zinfo.file_size = entry.size
+                digest = self.hashing(entry)
+                with entry.opener() as src, self.zipf.open(zinfo, "w") as dst:
+                    while True:
+                        if self.cancel_token is not None:
+                            self.cancel_token.check()
+                        chunk = src.read(COPY_BUFFER_SIZE)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        if digest is not None:
+                            digest.update(chunk)
+                if digest is not None:
+                    entry.media_file._sha1 = digest.hexdigest()
+                self.pending.popleft()
+                continue
+            if entry.zinfo is None:
+                entry.zinfo = zipfile.ZipInfo(entry.arcname, entry.date_time)
+                entry.zinfo.compress_type = zipfile.ZIP_DEFLATED
+                entry.zinfo.external_attr = 0o600 << 16
+                entry.zinfo.file_size = entry.size
+                entry.zinfo.compress_size = 0
+                entry.zinfo.CRC = 0
+                entry.zinfo.header_offset = fp.tell()
+                # same rule as zipfile, deflate may grow incompressible data a little
+                entry.zip64 = entry.size * 1.05 > zipfile.ZIP64_LIMIT
+                # placeholder, rewritten once the crc and compressed size are known
+                fp.write(entry.zinfo.FileHeader(entry.zip64))
+            while entry.blocks and (wait or entry.blocks[0].done()):
+                data = entry.blocks.popleft().result()
+                fp.write(data)
+                entry.zinfo.compress_size += len(data)
+                self.pending_blocks -= 1
+                wait = False
+            if entry.blocks or not entry.submitted:
+                return
+            self.finish_entry(entry)
+            self.pending.popleft()
+
+    def finish_entry(self, entry):
+        """the same bookkeeping zipfile does when a member written through ZipFile.open is closed"""
+        fp = self.zipf.fp
+        zinfo = entry.zinfo
+        zinfo.CRC = entry.crc
+        end = fp.tell()
+        fp.seek(zinfo.header_offset)
+        fp.write(zinfo.FileHeader(entry.zip64))
+        fp.seek(end)
+        self.register(zinfo)
+
+    def register(self, zinfo):
+        self.zipf.filelist.append(zinfo)
+        self.zipf.NameToInfo[zinfo.filename] = zinfo
+        self.zipf.start_dir = self.zipf.fp.tell()
+
+    def write_raw(self, entry):
+        """copy the compressed data of a member of another zip under a new name"""
+        fp = self.zipf.fp
+        src_info = entry.raw.zinfo
+        zinfo = zipfile.ZipInfo(entry.arcname, entry.date_time)
+        zinfo.compress_type = src_info.compress_type
+        zinfo.external_attr = 0o600 << 16
+        zinfo.file_size = src_info.file_size
+        zinfo.compress_size = src_info.compress_size
+        zinfo.CRC = src_info.CRC
+        zinfo.header_offset = fp.tell()
+        zip64 = max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT
+        fp.write(zinfo.FileHeader(zip64))
+        remaining = src_info.compress_size
+        with entry.raw.open_raw() as src:
+            while remaining:
+                chunk = src.read(min(COPY_BUFFER_SIZE, remaining))
+                if not chunk:
+                    raise EOFError(f"Truncated member in {entry.raw.filename}")
+                fp.write(chunk)
+                remaining -= len(chunk)
+        self.register(zinfo)
+
+    def flush(self):
+        for entry in self.pending:
+            entry.submitted = True
+        while self.pending:
+            if self.cancel_token is not None:
+                self.cancel_token.check()
+            self.write_ready(wait=True)
+
+    def find_duplicate(self, media_file):
+        """filename of an already packed file with the same content, hashes only on a size match"""
+        if not self.dedup:
+            return None
+        for other in self.written.get(media_file.size, []):
+            if other.sha1 == media_file.sha1:
+                return other.filename
+        return None
+
+    def add_media(self, filename, opener, size, date_time):
+        """opener: returns a new binary file object of the media file"""
+        self.stats.files += 1
+        self.stats.bytes_in += size
+        media_file = MediaFile(filename, opener, size)
+        duplicate = self.find_duplicate(media_file)
+        if duplicate is not None:
+            self.duplicates.append((filename, duplicate, opener, size, date_time, None))
+            self.stats.dedup_files += 1
+            self.stats.dedup_bytes += size
+            return
+        self.written[size].append(media_file)
+        self.media_files[filename] = media_file
+        self.sources[filename] = (opener, size, date_time, None)
+        self.add_entry(self.next_arcname(), opener, size, date_time, compress_type_for(filename), media_file)
+        self.media[str(len(self.media))] = filename
+
+    def add_raw_media(self, filename, previous):
+        """previous: a PreviousMedia, packed without being decompressed or compressed again"""
+        zinfo = previous.zinfo
+        self.stats.files += 1
+        self.stats.bytes_in += zinfo.file_size
+        self.stats.reused_files += 1
+        media_file = MediaFile(filename, None, zinfo.file_size)
+        media_file._sha1 = previous.sha1
+        duplicate = self.find_duplicate(media_file)
+        if duplicate is not None:
+            self.duplicates.append((filename, duplicate, None, zinfo.file_size, zinfo.date_time, previous))
+            self.stats.dedup_files += 1
+            self.stats.dedup_bytes += zinfo.file_size
+            return
+        self.written[zinfo.file_size].append(media_file)
+        self.media_files[filename] = media_file
+        self.sources[filename] = (None, zinfo.file_size, zinfo.date_time, previous)
+        self.add_raw_entry(self.next_arcname(), previous)
+        self.media[str(len(self.media))] = filename
+
+    def add_raw_entry(self, arcname, previous):
+        entry = PendingEntry(arcname, previous.zinfo.compress_type, previous.zinfo.file_size,
+                             max(tuple(previous.zinfo.date_time), MIN_DATE_TIME))
+        entry.raw = previous
+        entry.submitted = True
+        self.pending.append(entry)
+        self.write_ready(wait=False)
+
+    def choose_canonicals(self):
+        """name every content written after the smallest filename it came with, once all the media are added
+
+        the files come in download order, the first of a content is the one written. When another name of
+        it is smaller, the member written is listed under that name in the media map and the first name
+        becomes a duplicate, so the references and the media map do not change from one run to the next
+        """
+        if self.canonicals_chosen:
+            return
+        self.canonicals_chosen = True
+        # {filename written: [duplicate]}
+        groups = defaultdict(list)
+        for duplicate in self.duplicates:
+            groups[duplicate[1]].append(duplicate)
+        arcnames = {filename: arcname for arcname, filename in self.media.items()}
+        duplicates = []
+        for written, group in groups.items():
+            canonical = min([written] + [filename for filename, _, _, _, _, _ in group])
+            if canonical == written:
+                duplicates += group
+                continue
+            self.media[arcnames[written]] = canonical
+            media_file = self.media_files.pop(written)
+            media_file.filename = canonical
+            self.media_files[canonical] = media_file
+            self.sources[canonical] = self.sources.pop(written)
+            opener, size, date_time, previous = self.sources[canonical]
+            duplicates.append((written, canonical, opener, size, date_time, previous))
+            duplicates += [(filename, canonical, *source) for filename, _, *source in group if filename != canonical]
+        # written back in the same order on every run, see write_duplicates
+        self.duplicates = sorted(duplicates, key=lambda x: x[0])
+
+    def get_aliases(self):
+        """{duplicate filename: filename of the same content written}, call once every media file is added"""
+        self.choose_canonicals()
+        return {filename: canonical for filename, canonical, _, _, _, _ in self.duplicates}
+
+    def write_duplicates(self, filenames):
+        """write the duplicates that are still referenced by their own name after all"""
+        self.choose_canonicals()
+        for filename, canonical, opener, size, date_time, previous in self.duplicates:
+            if filename in filenames:
+                # same content as the canonical file
+                media_file = MediaFile(filename, opener, size)
+                media_file._sha1 = self.media_files[canonical]._sha1
+                self.media_files[filename] = media_file
+                if previous is not None:
+                    self.add_raw_entry(self.next_arcname(), previous)
+                else:
+                    self.add_entry(self.next_arcname(), opener, size, date_time, compress_type_for(filename),
+                                   media_file)
+                self.media[str(len(self.media))] = filename
+                self.stats.dedup_files -= 1
+                self.stats.dedup_bytes -= size
+
+    def media_hashes(self):
+        """{filename: sha1} of the media written, complete with record_hashes once flushed"""
+        return {filename: f._sha1 for filename, f in self.media_files.items() if f._sha1 is not None}
+
+    def add_bytes(self, arcname, data):
+        self.add_entry(arcname, lambda: io.BytesIO(data), len(data), time.localtime()[:6], zipfile.ZIP_DEFLATED)
+
+    def write_media_map(self):
+        self.choose_canonicals()
+        self.add_bytes("media", json.dumps(self.media).encode())
+
+    def write_collection(self, collection):
+        """collection: bytes of the collection, or the path of the collection file"""
+        if isinstance(collection, (bytes, bytearray)):
+            self.add_bytes("collection.anki2", collection)
+        else:
+            st = os.stat(collection)
+            self.add_entry("collection.anki2", lambda: open(collection, "rb"), st.st_size,
+                           time.localtime(st.st_mtime)[:6], zipfile.ZIP_DEFLATED)
+
+    def close(self):
+        if self.zipf.fp is not None:
+            self.flush()
+            self.zipf.close()
+            self.executor.shutdown()
+            logging.info(self.stats.report())
+
+    def abort(self):
+        for entry in self.pending:
+            for f in entry.blocks:
+                f.cancel()
+        self.pending.clear()
+        self.executor.shutdown()
+        self.zipf.close()
+        if isinstance(self.path, str) and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,98 @@
+# coding=utf-8
+"""categories/sec of AnkiCollectionWriter.get_decks against the recursive walk it replaced
+
+builds a synthetic category tree, checks that both give the same decks, then times them.
+--depth adds a chain of that many nested categories, deeper than the recursion limit the
+recursive walk fails on it.
+
+    python bench/bench_decks.py --nodes 100000 --depth 5000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from anki_base import BASE_DECK, DEFAULT_DECK_ID
+from anki_collection_writer import AnkiCollectionWriter
+
+
+def get_decks_recursive(writer):
+    """AnkiCollectionWriter.get_decks before it was memoized"""
+    def get_deck_name(idx, child_name=None):
+        row = writer.cats_df[idx]
+        deck_name = row['name'] if child_name is None else f"{row['name']}::{child_name}"
+        if row['pid'] == 0:
+            return writer.root_deck_name + "::" + deck_name
+        else:
+            return get_deck_name(row['pid'], deck_name)
+
+    decks = {}
+    for idx, row in writer.cats_df.items():
+        deck_info = deepcopy(BASE_DECK)
+        deck_info['id'] = idx
+        deck_info['name'] = get_deck_name(idx)
+        decks[str(idx)] = deck_info
+    if writer.insert_default_deck or len(decks) == 0:
+        deck_info = deepcopy(BASE_DECK)
+        deck_info['id'] = DEFAULT_DECK_ID
+        deck_info['name'] = writer.root_deck_name
+        decks[str(DEFAULT_DECK_ID)] = deck_info
+    return decks
+
+
+def make_cats(nodes, depth, seed=1):
+    """a random tree of `nodes` categories, a few roots, parents listed after their children at times"""
+    rnd = random.Random(seed)
+    aids = list(range(1000, 1000 + nodes))
+    cats = []
+    for i, aid in enumerate(aids):
+        # any earlier category as the parent, ~ln(nodes) levels deep
+        pid = 0 if i < 10 else aids[rnd.randrange(i)]
+        cats.append({"aid": aid, "pid": pid, "name": f"分类{aid}"})
+    pid = 0
+    for aid in range(1000 + nodes, 1000 + nodes + depth):
+        cats.append({"aid": aid, "pid": pid, "name": f"chain{aid}"})
+        pid = aid
+    rnd.shuffle(cats)
+    return OrderedDict((x["aid"], x) for x in cats)
+
+
+def timed(fn, writer):
+    start = time.perf_counter()
+    try:
+        return fn(writer), time.perf_counter() - start
+    except RecursionError:
+        return None, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=100000)
+    parser.add_argument("--depth", type=int, default=0, help="length of an extra chain of nested categories")
+    args = parser.parse_args()
+
+    cats = make_cats(args.nodes, args.depth)
+    cards = OrderedDict({1: {"aid": 0}})
+    writer = AnkiCollectionWriter("bench", sqlite3.connect(":memory:"), cats_df=cats, cards_df=cards,
+                                  tpls_df=OrderedDict())
+    new, new_sec = timed(AnkiCollectionWriter.get_decks, writer)
+    old, old_sec = timed(get_decks_recursive, writer)
+    longest = max(x["name"].count("::") for x in new.values())
+    print(f"{len(cats)} categories, deepest {longest} levels")
+    if old is None:
+        print(f"recursive: RecursionError after {old_sec:.2f}s")
+    else:
+        assert json.dumps(old) == json.dumps(new), "decks differ"
+        print(f"recursive: {old_sec:.2f}s, {len(cats) / old_sec:,.0f} categories/sec")
+    print(f"memoized:  {new_sec:.2f}s, {len(cats) / new_sec:,.0f} categories/sec")
+
+
+if __name__ == "__main__":
+    main()
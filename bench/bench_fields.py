@@ -0,0 +1,72 @@
+# coding=utf-8
+"""fields/sec of util.convert_to_apkg_format against the chained regexes it replaced
+
+tests/test_util.py checks both give identical output on a golden corpus and on random markup
+
+    python bench/bench_fields.py --fields 1000000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util import convert_to_apkg_format
+
+
+def convert_chained(f):
+    """convert_to_apkg_format before it was precompiled"""
+    if not f:
+        return ""
+    f = str(f)
+    f = f.replace(r"[audio:aws_", "[sound:")
+    f = f.replace(r"[audio:", "[sound:")
+    f = re.sub(r"\[image:(.*?)\]", r'<img src="\1">', f)
+    f = re.sub(r"__([^_,]{1,100}?)__", r"{{c1::\1}}", f)
+    # remove spaces in cloze
+    f = re.sub(r"{{c1::\s*(.*?)\s*}}", r"{{c1::\1}}", f)
+    f = re.sub(r"\[hide:(.*?)\]", r"{{c1::\1}}", f)
+    return f.strip()
+
+
+TOKENS = ["[audio:", "[audio:aws_", "[image:", "[hide:", "]", "__", "_", "{{c1::", "}}", " ", "\n",
+          ",", "a", "b", "汉字", ".png", ".mp3", "<br>", "{{", "::"]
+
+
+def random_fields(count, seed=0):
+    rnd = random.Random(seed)
+    return ["".join(rnd.choice(TOKENS) for _ in range(rnd.randint(0, 20))) for _ in range(count)]
+
+
+def realistic_fields(count, seed=1):
+    rnd = random.Random(seed)
+    samples = [
+        "a leap in the dark", "冒险举动；轻举妄动", "<div>some <b>html</b> answer</div>",
+        "a leap in the dark [audio:aws_oddcast-a76728aa.mp3]", "[image:c5b7e0c1.png]",
+        "The __capital__ of France is __Paris__", "[hide:answer] explained", "",
+    ]
+    return [rnd.choice(samples) + (" " * rnd.randint(0, 2)) for _ in range(count)]
+
+
+def bench(name, convert, fields):
+    start = time.perf_counter()
+    for f in fields:
+        convert(f)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>8}: {len(fields) / elapsed:,.0f} fields/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fields", type=int, default=1000000)
+    args = parser.parse_args()
+    fields = realistic_fields(args.fields)
+    bench("chained", convert_chained, fields)
+    bench("current", convert_to_apkg_format, fields)
+
+
+if __name__ == "__main__":
+    main()
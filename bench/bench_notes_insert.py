@@ -0,0 +1,93 @@
+# coding=utf-8
+"""cards/sec of AnkiCollectionWriter.insert_notes_table, the old per-row inserts against the batched writer
+
+    python bench/bench_notes_insert.py --cards 1000000
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from anki_base import DEFAULT_DECK_ID
+from anki_collection_writer import AnkiCollectionWriter
+from misc import gen_guid, now_sec
+from util import resource_path
+
+TID = 1000
+CATS = OrderedDict({aid: {"aid": aid, "pid": 0, "name": f"cat{aid}"} for aid in range(1, 11)})
+TPLS = OrderedDict({TID: {"tid": TID, "name": "问答", "css": "", "css_back": "",
+                          "fields": [{"name": "问题"}, {"name": "答案"}],
+                          "front": "{{问题}}", "back": "{{问题}}<hr>{{答案}}", "front_back": "", "back_back": ""}})
+
+
+class SyntheticCards:
+    """generates the cards on every pass instead of holding a million dicts"""
+
+    def __init__(self, count):
+        self.count = count
+
+    def items(self):
+        for i in range(self.count):
+            cid = 1600000000000 + i
+            yield cid, {"cid": cid, "aid": i % 11, "tid": TID, "is_back": 0,
+                        "data": {"问题": f"question {i} [image:q{i}.png]", "答案": f"answer {i} [audio:a{i}.mp3]"}}
+
+
+def insert_row_by_row(cw):
+    """the insert loop before batching: two execute calls per card"""
+    models = cw.get_models()
+    cnt = 0
+    with cw.con as c:
+        for idx, row in cw.cards_df.items():
+            deckId = row['aid'] or DEFAULT_DECK_ID
+            cnt += 1
+            model = models[str(row['tid'])]
+            fields = cw.insert_fields_to_notes(idx, row['data'], model)
+            c.execute("INSERT INTO notes (id, guid, mid, mod, usn, tags, flds, sfld, csum, flags, data)"
+                      " values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                      (idx, gen_guid(), row['tid'], now_sec(), -1, '', '\x1f'.join(fields), fields[0],
+                       random.randint(0, 1000000), 0, ''))
+            c.execute(
+                "INSERT INTO cards (id, nid, did, ord, mod, usn, type, queue, due, ivl, factor, reps, lapses, left, odue, odid, flags, data)"
+                " values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (idx, idx, deckId, 0, now_sec(), -1, 0, 0, cnt, 0, 0, 0, 0, 0, 0, 0, 0, ''))
+        c.commit()
+
+
+def insert_batched(cw):
+    cw.apply_build_pragmas()
+    cw.insert_notes_table()
+
+
+def run(name, insert, cards, tmp_dir):
+    collection_path = os.path.join(tmp_dir, f"{name}.anki2")
+    shutil.copyfile(resource_path("static/template.sqlite3"), collection_path)
+    cw = AnkiCollectionWriter("bench", collection_path, cats_df=CATS, cards_df=SyntheticCards(cards), tpls_df=TPLS)
+    cw.clear_old_rows()
+    start = time.perf_counter()
+    insert(cw)
+    elapsed = time.perf_counter() - start
+    cw.close()
+    print(f"{name:>10}: {cards} cards in {elapsed:.1f}s, {cards / elapsed:,.0f} cards/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cards", type=int, default=1000000)
+    args = parser.parse_args()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        run("row-by-row", insert_row_by_row, args.cards, tmp_dir)
+        run("batched", insert_batched, args.cards, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
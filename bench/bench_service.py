@@ -0,0 +1,139 @@
+# coding=utf-8
+"""drive service.py like the upload portal does: clients upload synthetic rpk files, poll and download the apkg
+
+the rpk files are made by make_rpk.py, their remote media served by media_server.py. The service runs in
+this process with its own warm workers. Prints the job latencies and the /metrics of the service.
+
+    python bench/bench_service.py --decks 20 --clients 8 --workers 2 --max-queued 2 --cards 2000
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zipfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from make_rpk import add_arguments, make_rpk, rpk_options
+from media_server import serve
+
+POLL_SEC = 0.1
+
+
+def request(method, url, data=None, headers=None):
+    """(status, headers, body), error statuses are returned too"""
+    req = urllib.request.Request(url, data=data, method=method, headers=headers or {})
+    try:
+        with urllib.request.urlopen(req) as resp:
+            return resp.status, resp.headers, resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, e.read()
+
+
+def run_client(base_url, rpk_path, results):
+    """upload until accepted, wait for the job, download and check the apkg"""
+    with open(rpk_path, "rb") as f:
+        data = f.read()
+    name = os.path.basename(rpk_path)
+    start = time.perf_counter()
+    rejected = 0
+    while True:
+        status, headers, body = request("POST", f"{base_url}/jobs?name={name}", data,
+                                        {"Content-Length": str(len(data))})
+        if status != 503:
+            break
+        rejected += 1
+        # the service asks for Retry-After seconds, a benchmark does not wait that long
+        time.sleep(min(float(headers.get("Retry-After", 1)), 0.5))
+    assert status == 202, body
+    job = json.loads(body)
+    accepted = time.perf_counter()
+    while job["state"] not in ("done", "failed"):
+        time.sleep(POLL_SEC)
+        job = json.loads(request("GET", f"{base_url}/jobs/{job['id']}")[2])
+    finished = time.perf_counter()
+    result = {"name": name, "state": job["state"], "error": job["error"], "rejected": rejected,
+              "upload_sec": accepted - start, "job_sec": finished - accepted}
+    if job["state"] == "done":
+        status, _, apkg = request("GET", f"{base_url}/jobs/{job['id']}/apkg")
+        assert status == 200
+        with zipfile.ZipFile(io.BytesIO(apkg)) as z:
+            assert "collection.anki2" in z.namelist()
+        result["apkg_bytes"] = len(apkg)
+        request("DELETE", f"{base_url}/jobs/{job['id']}")
+    result["total_sec"] = time.perf_counter() - start
+    results.append(result)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument("--decks", type=int, default=10, help="rpk files uploaded, one per seed")
+    parser.add_argument("--clients", type=int, default=4, help="uploads at once")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--max-queued", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8781, help="port of the service")
+    parser.add_argument("--media-port", type=int, default=8799, help="port of the local media server")
+    args = parser.parse_args()
+    if args.base_url == parser.get_default("base_url"):
+        args.base_url = f"http://127.0.0.1:{args.media_port}"
+
+    from service import ConversionService, make_server
+
+    work_dir = tempfile.mkdtemp(prefix="bench_service_")
+    media_server = serve(args.media_port)
+    service = ConversionService(os.path.join(work_dir, "jobs"), args.workers, args.max_queued)
+    server = make_server(service, port=args.port)
+    threading.Thread(target=server.serve_forever, name="service", daemon=True).start()
+    try:
+        rpk_paths = []
+        for i in range(args.decks):
+            path = os.path.join(work_dir, f"deck{i}.rpk")
+            make_rpk(path, **dict(rpk_options(args), seed=args.seed + i))
+            rpk_paths.append(path)
+        base_url = f"http://127.0.0.1:{args.port}"
+        results = []
+        pending = list(rpk_paths)
+        lock = threading.Lock()
+
+        def client():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    path = pending.pop(0)
+                run_client(base_url, path, results)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client) for _ in range(args.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - start
+        metrics = json.loads(request("GET", f"{base_url}/metrics")[2])
+    finally:
+        server.shutdown()
+        service.close()
+        media_server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    totals = [r["total_sec"] for r in results]
+    print(f"{len(results)} jobs in {wall:.2f}s, {len(results) / wall:.2f} jobs/s,"
+          f" {sum(r['state'] == 'done' for r in results)} done, {sum(r['rejected'] for r in results)} uploads"
+          f" answered 503")
+    print(f"latency: median {statistics.median(totals):.2f}s, max {max(totals):.2f}s")
+    print(json.dumps(metrics, indent=2))
+
+
+if __name__ == "__main__":
+    main()
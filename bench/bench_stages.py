@@ -0,0 +1,245 @@
+# coding=utf-8
+"""time every RpkConverter stage on a synthetic rpk, with the peak RSS of each, as JSON
+
+the rpk is made by make_rpk.py (or given with --rpk) and its remote media are served by
+media_server.py on --port. Every run converts in a fresh process, so runs do not share caches
+or memory. Save the JSON of one commit and pass it as --compare on the next one.
+
+    python bench/bench_stages.py --cards 1000000 --remote 2000 --repeat 3 --out before.json
+    python bench/bench_stages.py --cards 1000000 --remote 2000 --repeat 3 --compare before.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from make_rpk import add_arguments, make_rpk, rpk_options
+from media_server import serve
+
+SEQUENTIAL_STAGES = ["read_rpk", "load_rpk_json", "write_to_sqlite", "download_resource_files",
+                     "convert_media_files", "pack_apkg"]
+OVERLAPPED_STAGES = ["read_rpk", "load_rpk_json", "run_pipeline"]
+
+
+def reset_peak_rss():
+    """start a new high water mark of the process, linux only, False elsewhere"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """peak RSS since reset_peak_rss, or since the process started where it can not be reset"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        # windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def run_stages(rpk_path, out_dir, options, overlap, verbose, results):
+    """child process: convert rpk_path stage by stage and put {stage: {"sec", "peak_rss_mb"}} in results"""
+    from misc import setup_logging
+    from rpk_converter import RpkConverter
+    from util import resource_path
+
+    if verbose:
+        setup_logging()
+    converter = RpkConverter(rpk_path, out_dir, resource_path("static/template.sqlite3"), **options)
+    stages = {
+        "read_rpk": converter.read_rpk,
+        "load_rpk_json": converter.load_rpk_json,
+        "write_to_sqlite": converter.write_to_sqlite,
+        "download_resource_files": lambda: converter.download_resource_files(lambda done, count, nbytes: None),
+        "convert_media_files": converter.convert_media_files,
+        "pack_apkg": converter.pack_apkg,
+        "run_pipeline": converter.run_pipeline,
+    }
+    timings = {}
+    try:
+        for name in OVERLAPPED_STAGES if overlap else SEQUENTIAL_STAGES:
+            reset_peak_rss()
+            start = time.perf_counter()
+            stages[name]()
+            timings[name] = {"sec": time.perf_counter() - start, "peak_rss_mb": peak_rss_mb()}
+        apkg_bytes = os.path.getsize(converter.get_out_file_path())
+    finally:
+        converter.clear_tmp_files()
+    results.put({"stages": timings, "apkg_bytes": apkg_bytes})
+
+
+def run_once(rpk_path, options, overlap, verbose):
+    out_dir = tempfile.mkdtemp(prefix="bench_stages_")
+    try:
+        # spawn: a fresh interpreter, nothing inherited from this process or an earlier run
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        child = ctx.Process(target=run_stages, args=(rpk_path, out_dir, options, overlap, verbose, results))
+        start = time.perf_counter()
+        child.start()
+        child.join()
+        if child.exitcode != 0:
+            raise RuntimeError(f"conversion failed with exit code {child.exitcode}")
+        result = results.get()
+        result["total_sec"] = time.perf_counter() - start
+        return result
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def prepare_rpk(work_dir, rpk_opts):
+    """generate the rpk into work_dir, unless the one already there was made with the same options"""
+    os.makedirs(work_dir, exist_ok=True)
+    rpk_path = os.path.join(work_dir, "bench.rpk")
+    info_path = rpk_path + ".json"
+    key = json.loads(json.dumps(rpk_opts))
+    if os.path.exists(rpk_path) and os.path.exists(info_path):
+        with open(info_path, encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved["options"] == key:
+            print(f"reusing {rpk_path}")
+            return rpk_path, saved["info"]
+    start = time.perf_counter()
+    info = make_rpk(rpk_path, **rpk_opts)
+    info["extensions"] = ",".join(rpk_opts["extensions"])
+    print(f"generated {rpk_path} in {time.perf_counter() - start:.1f}s: {json.dumps(info)}")
+    with open(info_path, "w", encoding="utf-8") as f:
+        json.dump({"options": key, "info": info}, f)
+    return rpk_path, info
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(runs):
+    """the fastest time and the highest peak of every stage over the runs"""
+    best = {}
+    for name in runs[0]["stages"]:
+        secs = [r["stages"][name]["sec"] for r in runs]
+        peaks = [r["stages"][name]["peak_rss_mb"] for r in runs if r["stages"][name]["peak_rss_mb"] is not None]
+        best[name] = {"sec": min(secs), "peak_rss_mb": max(peaks) if peaks else None}
+    best["total"] = {"sec": min(r["total_sec"] for r in runs),
+                     "peak_rss_mb": max((s["peak_rss_mb"] for s in best.values() if s["peak_rss_mb"] is not None),
+                                        default=None)}
+    return best
+
+
+def print_table(best, baseline=None):
+    header = f"{'stage':<26}{'sec':>10}{'peak MB':>10}"
+    if baseline:
+        header += f"{'base sec':>10}{'ratio':>8}{'base MB':>10}"
+    print(header)
+    for name, s in best.items():
+        peak = f"{s['peak_rss_mb']:.0f}" if s["peak_rss_mb"] is not None else "-"
+        line = f"{name:<26}{s['sec']:>10.3f}{peak:>10}"
+        base = (baseline or {}).get(name)
+        if base:
+            base_peak = f"{base['peak_rss_mb']:.0f}" if base["peak_rss_mb"] is not None else "-"
+            line += f"{base['sec']:>10.3f}{s['sec'] / base['sec'] if base['sec'] else 0:>8.2f}{base_peak:>10}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.add_argument("--rpk", default=None, help="benchmark this rpk instead of generating one")
+    parser.add_argument("--work-dir", default=None,
+                        help="keep the generated rpk here and reuse it while the options stay the same"
+                             " (default: a temp dir)")
+    parser.add_argument("--port", type=int, default=8799, help="port of the local media server")
+    parser.add_argument("--latency-ms", type=int, default=0, help="delay of every media answer")
+    parser.add_argument("--repeat", type=int, default=1, help="runs, the fastest time of each stage is kept")
+    parser.add_argument("--overlap", action="store_true", help="time run_pipeline instead of the separate stages")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--stream-cards", action="store_true")
+    parser.add_argument("--collection-on-disk", action="store_true")
+    parser.add_argument("--compress-level", type=int, default=None)
+    parser.add_argument("--pack-threads", type=int, default=None)
+    parser.add_argument("--per-host-connections", type=int, default=None)
+    parser.add_argument("--in-memory-max", type=int, default=None, metavar="MB",
+                        help="rpk size up to which no temp dir is used, 0 always uses one")
+    parser.add_argument("--verbose", action="store_true", help="keep the log of the conversions")
+    parser.add_argument("--out", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="JSON results of another commit to compare with")
+    args = parser.parse_args()
+    if args.base_url == parser.get_default("base_url"):
+        args.base_url = f"http://127.0.0.1:{args.port}"
+
+    options = {"streaming": args.stream, "stream_cards": args.stream_cards,
+               "collection_in_memory": not args.collection_on_disk, "pack_threads": args.pack_threads,
+               "download_per_host": args.per_host_connections}
+    if args.compress_level is not None:
+        options["compress_level"] = args.compress_level
+    if args.in_memory_max is not None:
+        options["in_memory_max_bytes"] = args.in_memory_max * 1024 * 1024
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_rpk_")
+    server = serve(args.port, args.latency_ms)
+    try:
+        if args.rpk:
+            rpk_path = args.rpk
+            rpk_info = {"path": rpk_path}
+        else:
+            rpk_path, rpk_info = prepare_rpk(work_dir, rpk_options(args))
+        rpk_info["rpk_bytes"] = os.path.getsize(rpk_path)
+        runs = [run_once(rpk_path, options, args.overlap, args.verbose) for _ in range(args.repeat)]
+    finally:
+        server.shutdown()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    result = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "rpk": rpk_info,
+        "options": dict(options, overlap=args.overlap),
+        "apkg_bytes": runs[-1]["apkg_bytes"],
+        "best": summarize(runs),
+        "runs": runs,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["best"]
+    print_table(result["best"], baseline)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# coding=utf-8
+"""startup cost of the entry points, measured with python -X importtime in fresh processes
+
+import: the cumulative import time of each module as reported by -X importtime, wall: the whole process
+including the interpreter. first_stage: a fresh process until read_rpk of a small deck is done. Point
+--root at a checkout of another commit to measure it with the same script.
+
+    python bench/bench_startup.py --repeat 10 --out before.json
+    python bench/bench_startup.py --repeat 10 --compare before.json --top 15
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from make_rpk import make_rpk
+
+MODULES = ["rpk_converter", "cli", "service", "main"]
+
+FIRST_STAGE = """
+import sys
+sys.path.insert(0, {root!r})
+from rpk_converter import RpkConverter
+from util import resource_path
+converter = RpkConverter({rpk!r}, {out!r}, resource_path("static/template.sqlite3"))
+converter.read_rpk()
+converter.clear_tmp_files()
+print(",".join(m for m in ("requests", "asyncio", "tkinter", "multiprocessing") if m in sys.modules))
+"""
+
+
+def parse_importtime(stderr):
+    """[(module, self us, cumulative us, depth)] of an -X importtime log"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        self_us, cumulative, name = int(parts[0]), int(parts[1]), parts[2]
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        imports.append((name.strip(), self_us, cumulative, depth))
+    return imports
+
+
+def run(args, cwd):
+    """(wall seconds, completed process), None instead of the process if it failed"""
+    start = time.perf_counter()
+    try:
+        proc = subprocess.run(args, cwd=cwd, capture_output=True, text=True, timeout=60)
+    except subprocess.TimeoutExpired:
+        return None, None
+    wall = time.perf_counter() - start
+    return wall, proc if proc.returncode == 0 else None
+
+
+def measure_import(root, module):
+    wall, proc = run([sys.executable, "-X", "importtime", "-c", f"import {module}"], root)
+    if proc is None:
+        return None
+    top = [x for x in parse_importtime(proc.stderr) if x[0] == module and x[3] == 0]
+    return {"import_ms": top[-1][2] / 1000 if top else None, "wall_ms": wall * 1000,
+            "imports": parse_importtime(proc.stderr)}
+
+
+def median(values):
+    values = [v for v in values if v is not None]
+    return statistics.median(values) if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", default=ROOT, help="the checkout whose modules are imported")
+    parser.add_argument("--repeat", type=int, default=5, help="processes per measure, the median is kept")
+    parser.add_argument("--top", type=int, default=0, help="print the N slowest imports of rpk_converter")
+    parser.add_argument("--out", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="JSON results of another commit to compare with")
+    args = parser.parse_args()
+    root = os.path.abspath(args.root)
+
+    results = {}
+    interpreter = [run([sys.executable, "-c", "pass"], root)[0] for _ in range(args.repeat)]
+    results["python -c pass"] = {"import_ms": None, "wall_ms": median(interpreter) * 1000}
+    slowest = None
+    for module in MODULES:
+        runs = [measure_import(root, module) for _ in range(args.repeat)]
+        ok = [r for r in runs if r is not None]
+        if not ok:
+            # main.py of older commits opens its window when imported
+            results[f"import {module}"] = {"import_ms": None, "wall_ms": None}
+            continue
+        results[f"import {module}"] = {"import_ms": median([r["import_ms"] for r in ok]),
+                                       "wall_ms": median([r["wall_ms"] for r in ok])}
+        if module == "rpk_converter":
+            slowest = sorted(ok[0]["imports"], key=lambda x: x[2], reverse=True)
+
+    work_dir = tempfile.mkdtemp(prefix="bench_startup_")
+    try:
+        rpk_path = os.path.join(work_dir, "small.rpk")
+        make_rpk(rpk_path, cards=20, cats=3, bundled=2, remote=0)
+        script = FIRST_STAGE.format(root=root, rpk=rpk_path, out=work_dir)
+        walls = []
+        loaded = None
+        for _ in range(args.repeat):
+            wall, proc = run([sys.executable, "-c", script], work_dir)
+            walls.append(wall * 1000 if proc is not None else None)
+            if proc is not None:
+                loaded = proc.stdout.strip()
+        results["first stage (read_rpk)"] = {"import_ms": None, "wall_ms": median(walls),
+                                             "loaded": loaded.split(",") if loaded else []}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    header = f"{'':<26}{'import ms':>10}{'wall ms':>10}"
+    if baseline:
+        header += f"{'base imp':>10}{'base wall':>10}"
+    print(header)
+    for name, r in results.items():
+        line = f"{name:<26}" + "".join(f"{v:>10.1f}" if v is not None else f"{'-':>10}"
+                                         for v in (r["import_ms"], r["wall_ms"]))
+        base = (baseline or {}).get(name)
+        if base:
+            line += "".join(f"{v:>10.1f}" if v is not None else f"{'-':>10}"
+                            for v in (base["import_ms"], base["wall_ms"]))
+        print(line)
+    print(f"modules loaded by the first stage: {', '.join(results['first stage (read_rpk)']['loaded']) or 'none'}"
+          f" (of requests, asyncio, tkinter, multiprocessing)")
+    if args.top and slowest:
+        print("\nslowest imports of rpk_converter (cumulative us, self us):")
+        for name, self_us, cumulative, depth in slowest[:args.top]:
+            print(f"{cumulative:>10}{self_us:>10}  {'  ' * depth}{name}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"root": root, "python": sys.version.split()[0], "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+# coding=utf-8
+"""generate a synthetic rpk, the same arguments always give the same file
+
+question/answer, cloze (填空), two-sided, [choice:X] and AwesomeSelect-3.x choice templates, a category tree,
+media bundled in the rpk and media listed in resources.json to download from --base-url
+(see media_server.py, which serves exactly what these urls expect)
+
+    python bench/make_rpk.py /tmp/deck.rpk --cards 1000000 --bundled 500 --remote 2000
+"""
+import argparse
+import json
+import random
+import zipfile
+
+DEFAULT_BASE_URL = "http://127.0.0.1:8799"
+TTS_RESOURCES = 10
+TEMPLATE_KINDS = 5
+# every member gets the same timestamp, so the rpk does not depend on when it was made
+DATE_TIME = (2024, 1, 1, 0, 0, 0)
+
+
+def media_bytes(name, size):
+    """the content of a media file, derived from its name
+
+    random bytes that the packer stores as they are (.png, .mp3), or repetitive text it deflates (.svg)
+    """
+    rnd = random.Random(name)
+    if name.endswith(".svg"):
+        words = [f"<path d='M{i} {i * 2}L{i * 3} {i}'/>" for i in range(64)]
+        out = []
+        total = 0
+        while total < size:
+            word = rnd.choice(words)
+            out.append(word)
+            total += len(word)
+        return "".join(out).encode()[:size]
+    return rnd.randbytes(size)
+
+
+def media_name(prefix, i, extensions, dup_ratio, rnd):
+    """name of the i-th media file, a dup_ratio share of them have the content of an earlier one"""
+    ext = extensions[i % len(extensions)]
+    if i > 0 and rnd.random() < dup_ratio:
+        # same content seed, another name
+        return f"{prefix}{i}{ext}", f"{prefix}{rnd.randrange(i)}{ext}"
+    return f"{prefix}{i}{ext}", f"{prefix}{i}{ext}"
+
+
+def make_templates(n):
+    """n templates cycling through the kinds the converter handles differently"""
+    tpls = []
+    for i in range(n):
+        tid = 100 * (i + 1)
+        kind = i % TEMPLATE_KINDS
+        if kind == 0:
+            tpls.append({"tid": tid, "name": f"问答{i}", "css": ".q{color:#333}", "css_back": "",
+                         "fields": [{"name": "问题"}, {"name": "答案"}],
+                         "front": "{{@问题}}", "back": "{{@问题}}<hr>{{答案}}", "front_back": "", "back_back": ""})
+        elif kind == 1:
+            tpls.append({"tid": tid, "name": f"填空{i}", "css": "", "css_back": "",
+                         "fields": [{"name": "问题"}, {"name": "解释"}],
+                         "front": "{{问题}}", "back": "{{问题}}<br>{{解释}}", "front_back": "", "back_back": ""})
+        elif kind == 2:
+            tpls.append({"tid": tid, "name": f"正反{i}", "css": "", "css_back": ".b{}",
+                         "fields": [{"name": "正面"}, {"name": "反面"}],
+                         "front": "{{正面}}", "back": "{{反面}}", "front_back": "{{反面}}", "back_back": "{{正面}}"})
+        elif kind == 3:
+            tpls.append({"tid": tid, "name": f"选择{i}", "css": ".answer{background:url(./icon-correct.png)}",
+                         "css_back": "",
+                         "fields": [{"name": "question"}, {"name": "A"}, {"name": "B"}, {"name": "C"},
+                                    {"name": "D"}, {"name": "answer"}, {"name": "explain"}],
+                         "front": "{{question}}[choice:A][choice:B][choice:C][choice:D]",
+                         "back": "<div class='answer'>{{answer}}</div>{{explain}}", "front_back": "", "back_back": ""})
+        else:
+            # fields filled by the AwesomeSelect branch of insert_fields_to_notes
+            tpls.append({"tid": tid, "name": "AwesomeSelect-3.x", "css": "", "css_back": "",
+                         "fields": [{"name": "id"}, {"name": "question"}, {"name": "options"}, {"name": "answer"},
+                                    {"name": "notes"}],
+                         "front": "{{question}}<div>{{options}}</div>", "back": "{{answer}}<br>{{notes}}",
+                         "front_back": "", "back_back": ""})
+    return tpls
+
+
+def make_card(i, tpl, aid, media, rnd):
+    kind = (tpl["tid"] // 100 - 1) % TEMPLATE_KINDS
+    words = " ".join(f"词{rnd.randrange(5000)}" for _ in range(rnd.randrange(3, 15)))
+    if kind == 0:
+        question = f"q{i} {words}"
+        if media:
+            question += f" [image:{rnd.choice(media)}]"
+        answer = f"a{i} {words}"
+        if media and rnd.random() < 0.3:
+            answer += f" [audio:{rnd.choice(media)}]"
+        data = {"问题": question, "答案": answer}
+    elif kind == 1:
+        data = {"问题": f"{words} __ 答案{i} __ [hide:隐藏{i}]", "解释": words}
+    elif kind == 2:
+        data = {"正面": f"front{i} {words}", "反面": f"back{i}"}
+    else:
+        # [choice:X] and AwesomeSelect cards both come as question, A-D, answer, explain
+        data = {"question": f"pick {i} {words}", "A": "甲", "B": "乙", "C": "丙", "D": "",
+                "answer": rnd.choice(["A", "B", "AC", "BD"]), "explain": words}
+    return {"cid": 1600000000000 + i, "aid": aid, "tid": tpl["tid"],
+            "is_back": 1 if kind == 2 and i % 2 else 0, "data": data}
+
+
+def member(name):
+    info = zipfile.ZipInfo(name, DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+
+def make_rpk(path, cards=10000, cats=100, tpls=10, bundled=50, remote=200, media_kb=20,
+             extensions=(".png", ".mp3", ".svg"), dup_ratio=0.05, base_url=DEFAULT_BASE_URL, seed=1):
+    """write the rpk to path, returns {"cards", "cats", "tpls", "bundled", "remote", "media_bytes"}"""
+    rnd = random.Random(seed)
+    templates = make_templates(tpls)
+    categories = []
+    for i in range(cats):
+        aid = 1000 + i
+        pid = 0 if i < max(1, cats // 20) else 1000 + rnd.randrange(i)
+        categories.append({"aid": aid, "pid": pid, "name": f"分类{i}"})
+    aids = [x["aid"] for x in categories] or [0]
+
+    bundled_files = [media_name("bundled", i, extensions, dup_ratio, rnd) for i in range(bundled)]
+    remote_files = [media_name("remote", i, extensions, dup_ratio, rnd) for i in range(remote)]
+    sizes = {}
+    for _, content_name in bundled_files + remote_files:
+        if content_name not in sizes:
+            sizes[content_name] = max(1, int(rnd.expovariate(1 / (media_kb * 1024))))
+    resources = [{"id": i + 1, "name": name, "type": 0,
+                  "url": f"{base_url}/media/{content_name}?size={sizes[content_name]}"}
+                 for i, (name, content_name) in enumerate(remote_files)]
+    # text to speech entries are skipped by the converter
+    resources += [{"id": 1000000 + i, "name": f"tts{i}.mp3", "type": 1, "url": f"{base_url}/tts/{i}"}
+                  for i in range(TTS_RESOURCES)]
+    media = [name for name, _ in bundled_files + remote_files]
+
+    total_media = 0
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        # cards.json is written card by card, a million cards never sit in memory as one list
+        with z.open(member("data/cards.json"), "w", force_zip64=True) as f:
+            f.write(b"[")
+            for i in range(cards):
+                card = make_card(i, templates[i % len(templates)], 0 if i % 50 == 0 else rnd.choice(aids),
+                                 media, rnd)
+                f.write((b"," if i else b"") + json.dumps(card, ensure_ascii=False).encode("utf-8"))
+            f.write(b"]")
+        z.writestr(member("data/cats.json"), json.dumps(categories, ensure_ascii=False))
+        z.writestr(member("data/tpls.json"), json.dumps(templates, ensure_ascii=False))
+        z.writestr(member("data/resources.json"), json.dumps(resources, ensure_ascii=False))
+        for name, content_name in bundled_files:
+            data = media_bytes(content_name, sizes[content_name])
+            total_media += len(data)
+            z.writestr(member(f"resources/{name}"), data)
+    total_media += sum(sizes[content_name] for _, content_name in remote_files)
+    return {"cards": cards, "cats": cats, "tpls": tpls, "bundled": bundled, "remote": remote,
+            "media_bytes": total_media}
+
+
+def add_arguments(parser):
+    parser.add_argument("--cards", type=int, default=10000)
+    parser.add_argument("--cats", type=int, default=100, help="categories, nested at random")
+    parser.add_argument("--tpls", type=int, default=10, help="templates, cycling through the five kinds")
+    parser.add_argument("--bundled", type=int, default=50, help="media files inside the rpk")
+    parser.add_argument("--remote", type=int, default=200, help="media files to download")
+    parser.add_argument("--media-kb", type=int, default=20, help="mean media file size")
+    parser.add_argument("--extensions", default=".png,.mp3,.svg",
+                        help="media extensions, used in turn (.png/.mp3: random bytes, .svg: compressible text)")
+    parser.add_argument("--dup-ratio", type=float, default=0.05, help="share of media with the content of another")
+    parser.add_argument("--base-url", default=DEFAULT_BASE_URL, help="where media_server.py serves the remote media")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def rpk_options(args):
+    return {"cards": args.cards, "cats": args.cats, "tpls": args.tpls, "bundled": args.bundled,
+            "remote": args.remote, "media_kb": args.media_kb, "extensions": tuple(args.extensions.split(",")),
+            "dup_ratio": args.dup_ratio, "base_url": args.base_url, "seed": args.seed}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(json.dumps(make_rpk(args.path, **rpk_options(args))))
+
+
+if __name__ == "__main__":
+    main()
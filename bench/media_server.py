@@ -0,0 +1,85 @@
+# coding=utf-8
+"""local stand-in for the media CDN of the rpk files made by make_rpk.py
+
+GET /media/<name>?size=N answers the bytes make_rpk.media_bytes(name, N), with an ETag so the
+media cache gets 304s, and honours Range requests so resumed downloads can be measured too.
+
+    python bench/media_server.py --port 8799 --latency-ms 20
+"""
+import argparse
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from make_rpk import media_bytes
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    # set on the server class by serve()
+    latency_sec = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if not url.path.startswith("/media/"):
+            self.send_error(404)
+            return
+        name = url.path[len("/media/"):]
+        size = int(parse_qs(url.query).get("size", ["1024"])[0])
+        etag = '"' + hashlib.sha1(f"{name}:{size}".encode()).hexdigest()[:16] + '"'
+        if self.latency_sec:
+            time.sleep(self.latency_sec)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        data = media_bytes(name, size)
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes=") and range_header.endswith("-"):
+            start = int(range_header[len("bytes="):-1])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=8799, latency_ms=0):
+    """start the server in a daemon thread, returns it, stop it with shutdown()"""
+    handler = type("Handler", (MediaHandler,), {"latency_sec": latency_ms / 1000})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="media-server", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--latency-ms", type=int, default=0, help="delay before every answer")
+    args = parser.parse_args()
+    server = serve(args.port, args.latency_ms)
+    print(f"serving on http://127.0.0.1:{args.port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import zipfile
+
+# bump whenever the same rpk converts to a different apkg, older manifests are ignored then
+MANIFEST_VERSION = 3
+# of the <deck>.apkg.mods written next to the apkg with its manifest, see iter_note_mods
+NOTE_MODS_VERSION = 2
+# offsets into the local file header of a zip member
+_FH_FILENAME_LENGTH = 10
+_FH_EXTRA_FIELD_LENGTH = 11
+# one encoder for all the records, json.dumps builds a new one per call when given options
+_record_encoder = json.JSONEncoder(sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+
+def record_hash(record):
+    """short sha1 of a json record, the same across runs and python versions"""
+    return hashlib.sha1(_record_encoder.encode(record).encode("utf-8")).hexdigest()[:16]
+
+
+def hash_cards(cards_df, watched_names=()):
+    """[(cid, hash)] in card order, and the set of cids of the cards mentioning one of watched_names"""
+    watched_re = re.compile("|".join(re.escape(x) for x in watched_names)) if watched_names else None
+    hashes = []
+    watched = set()
+    for cid, row in cards_df.items():
+        data = _record_encoder.encode(row)
+        hashes.append((cid, hashlib.sha1(data.encode("utf-8")).hexdigest()[:16]))
+        if watched_re is not None and watched_re.search(data):
+            watched.add(cid)
+    return hashes, watched
+
+
+def manifest_path_for(apkg_path):
+    return apkg_path + ".manifest.json"
+
+
+def write_manifest(apkg_path, manifest):
+    path = manifest_path_for(apkg_path)
+    with open(path + ".part", "w", encoding="utf-8") as f:
+        # json.dump would go through the pure python encoder
+        f.write(json.dumps(manifest, ensure_ascii=False, separators=(",", ":")))
+    os.replace(path + ".part", path)
+
+
+def remove_manifest(apkg_path):
+    """the manifest and the note mods of an apkg about to be replaced"""
+    for path in (manifest_path_for(apkg_path), note_mods_path_for(apkg_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def note_mods_path_for(apkg_path):
+    return apkg_path + ".mods"
+
+
+def iter_note_mods(apkg_path):
+    """yield (note id, content hash, mod) of the notes of the previous apkg by id, nothing when there is none
+
+    one line per note, read as they are needed, the file of a huge deck is never held in memory
+    """
+    try:
+        f = open(note_mods_path_for(apkg_path), encoding="utf-8")
+    except OSError:
+        return
+    with f:
+        if f.readline() != f"version {NOTE_MODS_VERSION}\n":
+            return
+        for line in f:
+            idx, h, mod = line.split()
+            yield int(idx), h, int(mod)
+
+
+def open_note_mods(apkg_path):
+    """a text file to write the (note id, content hash, mod) lines of the new apkg to, by id; it replaces
+    the previous one in commit_note_mods"""
+    f = open(note_mods_path_for(apkg_path) + ".part", "w", encoding="utf-8")
+    f.write(f"version {NOTE_MODS_VERSION}\n")
+    return f
+
+
+def commit_note_mods(apkg_path):
+    path = note_mods_path_for(apkg_path)
+    if os.path.exists(path + ".part"):
+        os.replace(path + ".part", path)
+
+
+def discard_note_mods(apkg_path):
+    """drop the note mods written by a conversion that did not finish"""
+    path = note_mods_path_for(apkg_path) + ".part"
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class PreviousMedia:
+    """a media member of the previous apkg, copied into the new one still compressed"""
+
+    def __init__(self, build, filename, zinfo, sha1):
+        self.build = build
+        self.filename = filename
+        self.zinfo = zinfo
+        self.sha1 = sha1
+
+    def open_raw(self):
+        """the apkg file positioned at the compressed data of the member"""
+        return self.build.open_raw(self.zinfo)
+
+
+class PreviousBuild:
+    """the apkg written by the last run for the same deck, and the manifest it was built from
+
+    manifest: {"version", "compress_level", "apkg_size", "tpls", "cats": hashes of the records,
+    "resources": {name: hash}, "cards": [[cid, hash]] in card order,
+    "media": {filename: sha1}, "aliases": {duplicate filename: filename it was rewritten to}}
+    """
+
+    def __init__(self, apkg_path, manifest):
+        self.apkg_path = apkg_path
+        self.manifest = manifest
+        self.zipf = zipfile.ZipFile(apkg_path, "r")
+        self.resources = manifest["resources"]
+        self.aliases = manifest["aliases"]
+        # {filename: ZipInfo}
+        self.members = {filename: self.zipf.getinfo(arcname)
+                        for arcname, filename in json.loads(self.zipf.read("media")).items()}
+
+    @classmethod
+    def load(cls, apkg_path, compress_level):
+        """None when there is no usable previous build"""
+        path = manifest_path_for(apkg_path)
+        if not os.path.exists(path) or not os.path.exists(apkg_path):
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        except ValueError as e:
+            logging.warning(f"Ignoring unreadable build manifest {path}: {e}")
+            return None
+        if manifest.get("version") != MANIFEST_VERSION:
+            logging.info("Build manifest from another converter version, building from scratch")
+            return None
+        if manifest.get("compress_level") != compress_level:
+            logging.info("Compression level changed, building from scratch")
+            return None
+        if manifest.get("apkg_size") != os.path.getsize(apkg_path):
+            # the apkg was replaced after the manifest was written
+            logging.info("Build manifest does not match the apkg, building from scratch")
+            return None
+        try:
+            return cls(apkg_path, manifest)
+        except (zipfile.BadZipFile, KeyError) as e:
+            logging.warning(f"Ignoring unreadable previous apkg {apkg_path}: {e}")
+            return None
+
+    def close(self):
+        self.zipf.close()
+
+    def same_collection_inputs(self, tpls_hash, cats_hash):
+        """models and decks come from the templates and categories only"""
+        return self.manifest["tpls"] == tpls_hash and self.manifest["cats"] == cats_hash
+
+    def cards(self):
+        """{cid: (due, hash)} of the previous build"""
+        return {cid: (due, h) for due, (cid, h) in enumerate(self.manifest["cards"], 1)}
+
+    def read_collection(self):
+        return self.zipf.read("collection.anki2")
+
+    def find_media(self, filename, crc=None, size=None):
+        """the previous member of filename, if crc and size are given only when they still match"""
+        zinfo = self.members.get(filename)
+        sha1 = self.manifest["media"].get(filename)
+        if zinfo is None or sha1 is None:
+            return None
+        if crc is not None and (zinfo.CRC != crc or zinfo.file_size != size):
+            return None
+        return PreviousMedia(self, filename, zinfo, sha1)
+
+    def open_raw(self, zinfo):
+        f = open(self.apkg_path, "rb")
+        try:
+            f.seek(zinfo.header_offset)
+            header = struct.unpack(zipfile.structFileHeader, f.read(zipfile.sizeFileHeader))
+            # the local extra field may differ from the one in the central directory
+            f.seek(header[_FH_FILENAME_LENGTH] + header[_FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+        except Exception:
+            f.close()
+            raise
+        return f
@@ -0,0 +1,39 @@
+import threading
+
+
+class Cancelled(Exception):
+    def __init__(self, message="cancelled"):
+        # the message is passed again when unpickled in another process
+        super().__init__(message)
+
+
+class CancelToken:
+    """set from any thread to stop a conversion, the stages call check() between two items"""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        """raise Cancelled once cancel() was called"""
+        if self.event.is_set():
+            raise Cancelled()
+
+    def sleep(self, seconds):
+        """time.sleep that returns early, with Cancelled, when cancelled meanwhile"""
+        self.event.wait(seconds)
+        self.check()
+
+
+def checked(items, token):
+    """yield the items, checking the token before each, token may be None"""
+    for item in items:
+        if token is not None:
+            token.check()
+        yield item
@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import shutil
+import threading
+
+from build_manifest import record_hash
+
+# bump when a work dir of an older version can not be resumed from, it is emptied then
+CHECKPOINT_VERSION = 1
+CHECKPOINT_FILE = "checkpoint.jsonl"
+
+
+def work_dir_for(apkg_path):
+    """the working directory of a resumable conversion, kept until the apkg is written"""
+    return apkg_path + ".work"
+
+
+def rpk_hash(rpk_infos):
+    """hash of the members of an rpk, from its central directory: {name: ZipInfo}"""
+    return record_hash(sorted((name, info.CRC, info.file_size) for name, info in rpk_infos.items()))
+
+
+class Checkpoint:
+    """the steps a resumable conversion finished, a log of JSON lines in <work dir>/checkpoint.jsonl
+
+    a line is appended and flushed as soon as a step is done, so a killed job only loses the step it was
+    in. A work dir made from another rpk, or by another version, is emptied first.
+    """
+
+    def __init__(self, work_dir, rpk):
+        """rpk: the rpk_hash of the rpk converted"""
+        self.path = os.path.join(work_dir, CHECKPOINT_FILE)
+        self.lock = threading.Lock()
+        self.steps = set()
+        # {filename: size} of the downloads that finished
+        self.downloads = {}
+        header = {"version": CHECKPOINT_VERSION, "rpk": rpk}
+        if not self.replay(header):
+            for name in os.listdir(work_dir):
+                path = os.path.join(work_dir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.write(json.dumps(header) + "\n")
+        self.resumed = bool(self.steps or self.downloads)
+        self.f = open(self.path, "a", encoding="utf-8")
+
+    def replay(self, header):
+        """read the log back, False when there is none for this rpk"""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "rb") as f:
+            lines = f.read().split(b"\n")
+        if len(lines) < 2:
+            # the header itself was torn
+            return False
+        try:
+            if json.loads(lines[0]) != header:
+                logging.info(f"Checkpoint of another rpk or version in {os.path.dirname(self.path)}, starting over")
+                return False
+        except ValueError:
+            return False
+        # the bytes of the complete lines
+        size = len(lines[0]) + 1
+        # the last one is empty, or torn by a kill in the middle of the write
+        for line in lines[1:-1]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            size += len(line) + 1
+            if "done" in record:
+                self.steps.add(record["done"])
+            elif "undone" in record:
+                self.steps.discard(record["undone"])
+            elif "downloaded" in record:
+                self.downloads[record["downloaded"]] = record["size"]
+        # the next line goes right after the last complete one
+        os.truncate(self.path, size)
+        return True
+
+    def append(self, record):
+        with self.lock:
+            self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.f.flush()
+
+    def done(self, step):
+        return step in self.steps
+
+    def mark(self, step):
+        self.steps.add(step)
+        self.append({"done": step})
+
+    def forget(self, step):
+        """the output of step is about to change, it is redone by the next run"""
+        if step in self.steps:
+            self.steps.discard(step)
+            self.append({"undone": step})
+
+    def downloaded(self, filename, size):
+        self.downloads[filename] = size
+        self.append({"downloaded": filename, "size": size})
+
+    def is_downloaded(self, filename, path):
+        """the download of filename finished in an earlier run, and path is still the file it wrote"""
+        size = self.downloads.get(filename)
+        return size is not None and os.path.isfile(path) and os.path.getsize(path) == size
+
+    def close(self):
+        self.f.close()
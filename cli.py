@@ -0,0 +1,238 @@
+# coding=utf-8
+"""Headless entry point, converts many rpk files in parallel without a display.
+
+    python cli.py exports/*.rpk --jobs 4 --out-dir out/
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+import traceback
+from multiprocessing import Pool
+
+from apkg_packer import COMPRESS_LEVELS, DEFAULT_COMPRESS_LEVEL
+from downloader import DOWNLOAD_THREADS
+from media_cache import DEFAULT_MAX_BYTES, MediaCache
+from metrics import JsonLinesSink
+from misc import setup_logging
+from profiling import DEFAULT_TOP, PIPELINE_PROFILE_STAGES, PROFILE_STAGES
+from rpk_converter import IN_MEMORY_MAX_BYTES, RpkConverter
+from sharding import plan_shards
+from template_cache import TemplateCache
+from util import resource_path
+
+
+def expand_inputs(patterns):
+    """expand globs ourselves, cmd.exe does not do it for us"""
+    paths = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matched:
+            logging.warning(f"No file matches {pattern}")
+        for path in matched:
+            path = os.path.normpath(path)
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def compress_level(value):
+    if value in COMPRESS_LEVELS:
+        return COMPRESS_LEVELS[value]
+    if value.isdigit() and 0 <= int(value) <= 9:
+        return int(value)
+    raise argparse.ArgumentTypeError(f"expected 0-9 or one of {', '.join(COMPRESS_LEVELS)}")
+
+
+def converter_options(args):
+    """RpkConverter keyword arguments from the command line, media_cache is opened inside the worker"""
+    return {
+        "streaming": args.stream,
+        "stream_cards": args.stream_cards,
+        "collection_in_memory": not args.collection_on_disk,
+        "media_cache": (args.media_cache, args.media_cache_size * 1024 * 1024) if args.media_cache else None,
+        "compress_level": args.compress_level,
+        "pack_threads": args.pack_threads,
+        "download_per_host": args.per_host_connections,
+        "incremental": args.incremental,
+        "template_cache": args.template_cache,
+        "profile_dir": args.profile,
+        "profile_stages": args.profile_stages.split(",") if args.profile_stages else None,
+        "profile_top": args.profile_top,
+        "referenced_media_only": args.referenced_media_only,
+        "convert_workers": args.convert_workers,
+        "in_memory_max_bytes": args.in_memory_max * 1024 * 1024,
+    }
+
+
+# {cache dir: TemplateCache} of this worker, its memory is kept from one job to the next
+_template_caches = {}
+
+
+def get_template_cache(cache_dir):
+    if cache_dir not in _template_caches:
+        _template_caches[cache_dir] = TemplateCache(cache_dir)
+    return _template_caches[cache_dir]
+
+
+def open_converter(rpk_file_path, out_dir, options):
+    """an RpkConverter writing into out_dir, the caches in options are shared by the jobs of this process"""
+    options = dict(options)
+    os.makedirs(out_dir, exist_ok=True)
+    if options.get("media_cache"):
+        options["media_cache"] = MediaCache(*options["media_cache"])
+    if options.get("template_cache"):
+        options["template_cache"] = get_template_cache(options["template_cache"])
+    return RpkConverter(rpk_file_path, out_dir, resource_path("static/template.sqlite3"), **options)
+
+
+def convert_one(task):
+    """convert a single rpk file, runs inside a worker process
+
+    task: (rpk_file_path, out_dir, keep_temp, overlap, metrics_path, converter_options)
+    returns (rpk_file_path, out_file_path or None, error message or None)
+    """
+    rpk_file_path, out_dir, keep_temp, overlap, metrics_path, options = task
+    out_dir = out_dir or os.path.dirname(os.path.abspath(rpk_file_path))
+    converter = None
+    sink = None
+    try:
+        converter = open_converter(rpk_file_path, out_dir, dict(options, keep_temp=keep_temp))
+        if metrics_path:
+            sink = converter.metrics.subscribe(JsonLinesSink(metrics_path))
+
+        def on_progress(done, count, nbytes):
+            if done == count or done % 100 == 0:
+                logging.info(f"{converter.out_name}: downloaded {done}/{count}, {nbytes / 1024 / 1024:.1f} MB")
+
+        converter.convert(on_progress, overlap=overlap)
+        return rpk_file_path, converter.get_out_file_path(), None
+    except Exception as e:
+        logging.error(f"{rpk_file_path}: {traceback.format_exc()}")
+        error = str(e) or e.__class__.__name__
+        if options.get("shard") is not None:
+            error = f"shard {options['shard'].name}: {error}"
+        return rpk_file_path, None, error
+    finally:
+        if sink is not None:
+            sink.close()
+        if converter is not None and not keep_temp:
+            converter.clear_tmp_files()
+
+
+def add_converter_arguments(parser):
+    """the arguments read by converter_options"""
+    parser.add_argument("--convert-workers", type=int, default=None, metavar="N",
+                        help="convert the card fields of big decks in N processes, files are converted one at a time")
+    parser.add_argument("--stream", action="store_true",
+                        help="copy json and media straight from the rpk into the apkg without extracting it")
+    parser.add_argument("--stream-cards", action="store_true",
+                        help="parse cards.json card by card while writing, keeps memory flat on huge decks")
+    parser.add_argument("--collection-on-disk", action="store_true",
+                        help="build the collection in the temp dir instead of in memory, for huge decks"
+                             " (over --in-memory-max)")
+    parser.add_argument("--in-memory-max", type=int, default=IN_MEMORY_MAX_BYTES // 1024 // 1024, metavar="MB",
+                        help="convert rpk files up to MB without a temp dir, 0 always uses one")
+    parser.add_argument("--compress-level", type=compress_level, default=DEFAULT_COMPRESS_LEVEL,
+                        help="zlib level of the apkg, 0-9 or fast (1) / default (6) / best (9)")
+    parser.add_argument("--pack-threads", type=int, default=None,
+                        help="threads compressing the apkg of each job (default: number of CPUs)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="write a build manifest next to each apkg and only redo what changed since then")
+    parser.add_argument("--template-cache", default=None, metavar="DIR",
+                        help="keep the models built from Jihu templates in DIR and reuse them across conversions")
+    parser.add_argument("--profile", default=None, metavar="DIR",
+                        help="profile the stages with cProfile and tracemalloc, results go to DIR (slow)")
+    parser.add_argument("--profile-stages", default=None, metavar="STAGES",
+                        help=f"comma separated stages to profile (default: {','.join(PROFILE_STAGES)},"
+                             f" {','.join(PIPELINE_PROFILE_STAGES)} without --no-overlap)")
+    parser.add_argument("--profile-top", type=int, default=DEFAULT_TOP, metavar="N",
+                        help="allocations listed per stage")
+    parser.add_argument("--referenced-media-only", action="store_true",
+                        help="skip the resources no card field or template mentions, neither downloaded nor packed")
+    parser.add_argument("--media-cache", default=None, metavar="DIR",
+                        help="keep downloaded media in DIR and reuse it across conversions")
+    parser.add_argument("--per-host-connections", type=int, default=None, metavar="N",
+                        help=f"media downloads from one host at once (default: {DOWNLOAD_THREADS}, all of them)")
+    parser.add_argument("--media-cache-size", type=int, default=DEFAULT_MAX_BYTES // 1024 // 1024, metavar="MB",
+                        help="size cap of the media cache, least recently used files are evicted first")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert rpk files exported from Jihu to Anki apkg files.")
+    parser.add_argument("inputs", nargs="+", help="rpk files or glob patterns")
+    parser.add_argument("-o", "--out-dir", default=None,
+                        help="output directory, defaults to the directory of each rpk file")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs, 1 with --convert-workers)")
+    parser.add_argument("--keep-temp", action="store_true", help="keep the temp directory of every job")
+    parser.add_argument("--resume", action="store_true",
+                        help="keep <deck>.apkg.work when a job fails or is interrupted, and go on from it next time")
+    parser.add_argument("--no-overlap", action="store_true",
+                        help="run the stages one after another instead of downloading while the collection is written")
+    parser.add_argument("--metrics", default=None, metavar="FILE",
+                        help="append the start and end of every stage of every job to FILE as JSON lines")
+    sharding = parser.add_mutually_exclusive_group()
+    sharding.add_argument("--shard-by-category", action="store_true",
+                          help="write an apkg per top-level category, <deck>.<NN>-<category>.apkg, in parallel")
+    sharding.add_argument("--shard-cards", type=int, default=None, metavar="N",
+                          help="write an apkg per N cards, <deck>.<NN>.apkg, in parallel")
+    sharding.add_argument("--shard-mb", type=int, default=None, metavar="MB",
+                          help="write an apkg per about MB of card fields and media, <deck>.<NN>.apkg, in parallel")
+    add_converter_arguments(parser)
+    args = parser.parse_args(argv)
+    setup_logging()
+
+    paths = expand_inputs(args.inputs)
+    if not paths:
+        parser.error("no rpk file to convert")
+    if args.convert_workers and args.convert_workers > 1 and args.jobs and args.jobs > 1:
+        parser.error("--convert-workers already uses several processes per file, it needs --jobs 1")
+    options = dict(converter_options(args), resume=args.resume)
+    tasks = []
+    failed = 0
+    for path in paths:
+        if args.shard_by_category or args.shard_cards or args.shard_mb:
+            # every shard is a job of its own, the shards of one deck are converted in parallel
+            try:
+                shards = plan_shards(path, args.shard_by_category, args.shard_cards,
+                                     args.shard_mb * 1024 * 1024 if args.shard_mb else None)
+            except Exception as e:
+                logging.error(f"{path}: {traceback.format_exc()}")
+                failed += 1
+                print(f"FAIL\t{path}\t{str(e) or e.__class__.__name__}", flush=True)
+                continue
+            tasks += [(path, args.out_dir, args.keep_temp, not args.no_overlap, args.metrics,
+                       dict(options, shard=shard)) for shard in shards]
+        else:
+            tasks.append((path, args.out_dir, args.keep_temp, not args.no_overlap, args.metrics, options))
+    jobs = args.jobs or (1 if args.convert_workers else os.cpu_count() or 1)
+    jobs = max(1, min(jobs, len(tasks)))
+    total = len(tasks) + failed
+
+    if jobs == 1:
+        # in this process: the processes of --convert-workers can not be started from a pool worker
+        results = map(convert_one, tasks)
+        pool = None
+    else:
+        # every job clones the template into its own collection, so workers are reused across files
+        # spawned workers (windows) do not run main(), their logging is set up again
+        pool = Pool(jobs, initializer=setup_logging)
+        results = pool.imap_unordered(convert_one, tasks)
+    try:
+        for rpk_file_path, out_path, error in results:
+            if error is None:
+                print(f"OK\t{rpk_file_path}\t{out_path}", flush=True)
+            else:
+                failed += 1
+                print(f"FAIL\t{rpk_file_path}\t{error}", flush=True)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    print(f"{total - failed}/{total} converted", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from cancellation import Cancelled, checked
+
+# requests and asyncio are imported when something is downloaded, they are most of the startup time
+
+DOWNLOAD_THREADS = 20
+CHUNK_SIZE = 64 * 1024
+RETRIES = 3
+BACKOFF_SEC = 0.5
+TIMEOUT_SEC = 30
+# next to a part file, the ETag or Last-Modified of the file it is the start of
+VALIDATOR_SUFFIX = ".validator"
+
+
+class DownloadError(Exception):
+    def __init__(self, failures):
+        """failures: [(url, exception)]"""
+        self.failures = failures
+        url, e = failures[0]
+        super().__init__(f"{len(failures)} file(s) failed to download, first: {url}: {e}")
+
+
+def resume_headers(part_path):
+    """Range and If-Range headers going on from part_path, {} when there is nothing to resume from
+
+    with If-Range the server only sends the rest when the file did not change since the part was written,
+    otherwise it answers 200 with the whole new file
+    """
+    try:
+        offset = os.path.getsize(part_path)
+        with open(part_path + VALIDATOR_SUFFIX, encoding="utf-8") as f:
+            validator = f.read()
+    except OSError:
+        return {}
+    if not offset or not validator:
+        return {}
+    return {"Range": f"bytes={offset}-", "If-Range": validator}
+
+
+def open_part(part_path, response, headers):
+    """(file, offset) to write the body of response into, the request was sent with headers
+
+    appended to when the response is the rest of the part file, written over otherwise. The validator of
+    the response is kept next to it for the next resume
+    """
+    if response.status_code == 206:
+        offset = int(headers["Range"][len("bytes="):-1]) if "Range" in headers else -1
+        if not response.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+            remove_part(part_path)
+            raise OSError(f"Unexpected Content-Range {response.headers.get('Content-Range')}")
+        return open(part_path, "ab"), offset
+    validator = response.headers.get("ETag")
+    if not validator or validator.startswith("W/"):
+        # a weak etag is not allowed in If-Range
+        validator = response.headers.get("Last-Modified")
+    if validator:
+        with open(part_path + VALIDATOR_SUFFIX, "w", encoding="utf-8") as f:
+            f.write(validator)
+    elif os.path.exists(part_path + VALIDATOR_SUFFIX):
+        os.remove(part_path + VALIDATOR_SUFFIX)
+    return open(part_path, "wb"), 0
+
+
+def remove_part(part_path):
+    """remove a part file and its validator"""
+    for path in (part_path, part_path + VALIDATOR_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def new_session():
+    """a requests session pooling as many connections as there are download threads"""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    # retries are done by the Downloader, with backoff and resume
+    adapter = HTTPAdapter(pool_connections=DOWNLOAD_THREADS, pool_maxsize=DOWNLOAD_THREADS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class Downloader:
+    """downloads many files at once, scheduled by asyncio with a bounded number of connections per host
+
+    per_host: connections to one host at once, as many as the threads by default, since the media of a
+    deck usually all come from the same CDN
+
+    the blocking requests calls run in a thread pool. Every file is written to `<dest>.part` and
+    renamed when complete, a `.part` left by an earlier attempt is resumed with an HTTP Range request,
+    as long as the If-Range validator shows the file did not change since.
+    With buffers the files are kept in memory instead, {dest: bytes}, dest is then only a key. Once they
+    hold buffer_max_bytes, the next files are downloaded to spill_path(dest) and buffers[dest] is that path.
+    cancel_token is checked between two chunks, download_all raises Cancelled soon after it is cancelled.
+    """
+
+    def __init__(self, session, threads=DOWNLOAD_THREADS, per_host=None,
+                 retries=RETRIES, backoff=BACKOFF_SEC, media_cache=None, buffers=None, buffer_max_bytes=None,
+                 spill_path=None, cancel_token=None):
+        self.session = session
+        self.buffers = buffers
+        self.buffer_max_bytes = buffer_max_bytes
+        self.spill_path = spill_path
+        self.buffered = 0
+        self.cancel_token = cancel_token
+        self.threads = threads
+        self.per_host = per_host or threads
+        self.retries = retries
+        self.backoff = backoff
+        self.media_cache = media_cache
+        self.bytes_done = 0
+        # failed attempts that were tried again
+        self.retried = 0
+        self.lock = threading.Lock()
+
+    def add_bytes(self, n):
+        with self.lock:
+            self.bytes_done += n
+
+    def fetch_to_file(self, url, dest_path):
+        """download url to dest_path, resuming dest_path.part, returns True if served by the media cache"""
+        if self.media_cache is not None:
+            hit = self.media_cache.fetch(self.session, url, dest_path, self.cancel_token)
+            self.add_bytes(os.path.getsize(dest_path))
+            return hit
+        part_path = dest_path + ".part"
+        headers = resume_headers(part_path)
+        with self.session.get(url, stream=True, headers=headers, timeout=TIMEOUT_SEC) as r:
+            if headers and r.status_code == 416:
+                # stale or already complete part file, start over
+                remove_part(part_path)
+                return self.fetch_to_file(url, dest_path)
+            r.raise_for_status()
+            # a changed file, or a server ignoring Range, answers 200 with the whole file
+            f, _ = open_part(part_path, r, headers)
+            with f:
+                for chunk in checked(r.iter_content(chunk_size=CHUNK_SIZE), self.cancel_token):
+                    f.write(chunk)
+                    self.add_bytes(len(chunk))
+        os.replace(part_path, dest_path)
+        remove_part(part_path)
+        return False
+
+    def fetch_to_buffer(self, url, dest):
+        """download url into self.buffers[dest], returns True if served by the media cache"""
+        if self.media_cache is not None:
+            data, hit = self.media_cache.read(self.session, url, self.cancel_token)
+            self.add_bytes(len(data))
+            self.keep_buffer(dest, data)
+            return hit
+        chunks = []
+        received = 0
+        try:
+            with self.session.get(url, stream=True, timeout=TIMEOUT_SEC) as r:
+                r.raise_for_status()
+                for chunk in checked(r.iter_content(chunk_size=CHUNK_SIZE), self.cancel_token):
+                    chunks.append(chunk)
+                    received += len(chunk)
+                    self.add_bytes(len(chunk))
+        except BaseException:
+            # nothing to resume from, the next attempt counts its bytes again
+            self.add_bytes(-received)
+            raise
+        self.keep_buffer(dest, b"".join(chunks))
+        return False
+
+    def keep_buffer(self, dest, data):
+        with self.lock:
+            self.buffered += len(data)
+        self.buffers[dest] = data
+
+    def fetch(self, url, dest):
+        """download url to dest, in memory or on disk, see the class doc"""
+        if self.buffers is None:
+            return self.fetch_to_file(url, dest)
+        if self.buffer_max_bytes is None or self.buffered < self.buffer_max_bytes:
+            return self.fetch_to_buffer(url, dest)
+        path = self.spill_path(dest)
+        hit = self.fetch_to_file(url, path)
+        self.buffers[dest] = path
+        return hit
+
+    def fetch_with_retry(self, url, dest_path):
+        import requests
+
+        for attempt in range(self.retries + 1):
+            if self.cancel_token is not None:
+                self.cancel_token.check()
+            try:
+                return self.fetch(url, dest_path)
+            except (requests.RequestException, OSError) as e:
+                response = getattr(e, "response", None)
+                if response is not None and response.status_code < 500:
+                    # 404 and friends will not get better
+                    raise
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                with self.lock:
+                    self.retried += 1
+                logging.warning(f"Download failed, retry in {delay}s: {url}: {e}")
+                if self.cancel_token is not None:
+                    self.cancel_token.sleep(delay)
+                else:
+                    time.sleep(delay)
+
+    async def download_async(self, items, progress_callback, file_callback):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(self.threads)
+        host_limits = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+
+        async def download(url, dest_path):
+            async with host_limits[urlsplit(url).netloc]:
+                try:
+                    hit = await loop.run_in_executor(executor, self.fetch_with_retry, url, dest_path)
+                    return url, dest_path, hit, None
+                except Exception as e:
+                    return url, dest_path, False, e
+
+        results = {}
+        failures = []
+        try:
+            tasks = [download(url, dest_path) for url, dest_path in items]
+            # completion order, one slow file does not hold back the progress of the others
+            for done, task in enumerate(asyncio.as_completed(tasks)):
+                url, dest_path, hit, error = await task
+                if error is None:
+                    results[dest_path] = hit
+                    file_callback(dest_path)
+                elif isinstance(error, Cancelled):
+                    pass
+                else:
+                    logging.error(f"Download failed: {url}: {error}")
+                    failures.append((url, error))
+                progress_callback(done + 1, len(tasks), self.bytes_done)
+        finally:
+            executor.shutdown(wait=True)
+        if self.cancel_token is not None:
+            self.cancel_token.check()
+        if failures:
+            raise DownloadError(failures)
+        return results
+
+    def download_all(self, items, progress_callback=None, file_callback=None):
+        """items: [(url, dest_path)], progress_callback: (doneCount, totalCount, doneBytes),
+        file_callback: (dest_path) as soon as a file is complete
+
+        returns {dest_path: served by the media cache}, raises DownloadError once every other file is done
+        """
+        progress_callback = progress_callback or (lambda done, count, nbytes: None)
+        file_callback = file_callback or (lambda dest_path: None)
+        import asyncio
+
+        return asyncio.run(self.download_async(items, progress_callback, file_callback))
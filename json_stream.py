@@ -0,0 +1,101 @@
+import io
+import json
+
+READ_SIZE = 64 * 1024
+WHITESPACE = " \t\n\r"
+ITEM_END = WHITESPACE + ",]"
+
+
+def iter_json_array(f, read_size=READ_SIZE):
+    """yield the items of a top level json array one by one from a text stream
+
+    only the item being decoded is held in memory, not the whole array
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = f.read(read_size)
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def skip(chars):
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            fill()
+
+    skip(WHITESPACE)
+    if buf[pos:pos + 1] != "[":
+        raise ValueError("Expected a json array")
+    pos += 1
+    expect_item = True
+    after_comma = False
+    while True:
+        skip(WHITESPACE)
+        if pos >= len(buf):
+            raise ValueError("Unexpected end of json array")
+        if buf[pos] == "]":
+            if after_comma:
+                raise ValueError("Unexpected ']' after ',' in json array")
+            pos += 1
+            skip(WHITESPACE)
+            if pos < len(buf):
+                raise ValueError("Extra data after json array")
+            return
+        if buf[pos] == ",":
+            if expect_item:
+                raise ValueError("Unexpected ',' in json array")
+            pos += 1
+            expect_item = after_comma = True
+            continue
+        if not expect_item:
+            raise ValueError("Expected ',' between json array items")
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+                # a number cut by the end of the buffer ("12" of "12.5") decodes fine,
+                # so only trust the item once a separator follows it
+                if eof or (end < len(buf) and buf[end] in ITEM_END):
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill()
+        pos = end
+        expect_item = after_comma = False
+        yield item
+
+
+class JsonArrayStream:
+    """re-iterable, dict-like view over a json array of records, keyed by `key`
+
+    opener: returns a new binary file object of the json file each time it is called
+    select: only the records it yields are seen, called with the iterator of all of them, e.g. Shard.select
+    """
+
+    def __init__(self, opener, key, select=None):
+        self.opener = opener
+        self.key = key
+        self.select = select
+
+    def values(self):
+        with self.opener() as f:
+            rows = iter_json_array(io.TextIOWrapper(f, encoding="utf-8"))
+            yield from (rows if self.select is None else self.select(rows))
+
+    def items(self):
+        for row in self.values():
+            yield row[self.key], row
+
+    def __iter__(self):
+        for row in self.values():
+            yield row[self.key]
@@ -6,10 +6,21 @@ import time
 import traceback
 from tkinter import Tk, messagebox, Label, Entry, StringVar, Button, filedialog
 
+from cancellation import Cancelled
 from message_stdout import Messagebox
-from rpk_converter import RpkConverter
+from misc import setup_logging
 from util import resource_path
 
+STAGE_LABELS = {
+    "read_rpk": "正在解析RPK文件(解压缩)",
+    "load_rpk_json": "正在解析RPK文件(分析json)",
+    "run_pipeline": "正在生成apkg文件",
+    "write_to_sqlite": "正在写入sqlite",
+    "download_resource_files": "正在下载音频、图片文件",
+    "pack_media": "正在打包音频、图片文件",
+    "write_collection": "正在写入apkg文件",
+}
+
 
 class App:
     def __init__(self, title):
@@ -19,6 +30,12 @@ class App:
         self.rpk_file_path = StringVar()
         self.out_dir = StringVar()
         self.status = ""
+        # {stage: last event} of the stages running now, filled by the converter thread
+        self.running_stages = {}
+        self.started = None
+        # the running conversion, cancelled when the window is closed
+        self.converter = None
+        self.closing = False
         # layout
         Label(self.root, text="选择从记乎导出的rpk文件").grid(row=0, column=0)
         Entry(self.root, textvariable=self.rpk_file_path, width=100).grid(row=0, column=1)
@@ -36,6 +53,7 @@ class App:
         screenheight = self.root.winfo_screenheight()
         self.root.geometry('+%d+%d' % ((screenwidth - 1000) / 2, (screenheight - 300) / 2))
         self.root.resizable(width=True, height=True)
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
         # mainloop
         messagebox.showinfo(title, "这个工具用于将rpk文件转换为Anki的apkg文件，用于在anki中学习")
         self.root.mainloop()
@@ -57,10 +75,11 @@ class App:
 
     def touch_button(self):
         self.run_button.config(state="disabled")
+        self.running_stages = {}
+        self.started = time.time()
         thread_convert = threading.Thread(target=self.run_convert)
         thread_convert.start()
-        thread_count = threading.Thread(target=self.time_count)
-        thread_count.start()
+        self.show_progress()
 
     def run_convert(self):
         rpk_file_path = self.rpk_file_path.get()
@@ -70,43 +89,69 @@ class App:
             out_dir = os.getcwd()
 
         message_stdout.clear()
-        converter = RpkConverter(rpk_file_path, out_dir, sqlite_path)
+        # imported after the window is up, it is most of the startup time
+        from rpk_converter import RpkConverter
+
+        # big decks keep their work dir when the window is closed, the next run goes on from there
+        converter = RpkConverter(rpk_file_path, out_dir, sqlite_path, resume=True)
+        converter.metrics.subscribe(self.on_stage_event)
+        self.converter = converter
         out_dir = os.path.normpath(out_dir)
         try:
-            self.status = "正在解析RPK文件(解压缩)"
             converter.read_rpk()
-            self.status = "正在解析RPK文件(分析json)"
             converter.load_rpk_json()
-            self.status = "正在生成apkg文件(写入sqlite)"
-            converter.write_to_sqlite()
-            def on_progress(idx, count):
-                self.status = f'正在下载音频、图片文件({idx}/{count})'
-            converter.download_resource_files(on_progress)
-            self.status = "正在生成apkg文件(转换media文件)"
-            converter.convert_media_files()
-            self.status = "正在生成apkg文件(打包为apkg)"
-            converter.pack_apkg()
+            converter.run_pipeline()
             messagebox.showinfo(self.title, "转换成功！请打开 " + out_dir + " 查看生成的apkg文件")
             if os.name == 'nt':
                 os.system(f'explorer.exe /select,"{converter.get_out_file_path()}"')
+        except Cancelled:
+            pass
         except Exception as e:
             messagebox.showerror(title, "**ERROR**\n" + str(
                 e) + "\n\n To check the complete traceback error log, please open the console. \n\n" + traceback.format_exc())
             sys.stderr.write(traceback.format_exc())
         finally:
             self.status = "清除临时文件"
-            # converter.clear_tmp_files()
+            converter.clear_tmp_files()
+            self.converter = None
             # message_stdout.send_message()
-            self.run_button.config(text="run", state="normal")
+            if not self.closing:
+                self.run_button.config(text="run", state="normal")
+
+    def close(self):
+        # the conversion thread stops within a second, and keeps what it did for the next run
+        self.closing = True
+        if self.converter is not None:
+            self.converter.cancel()
+        self.root.destroy()
+
+    def on_stage_event(self, event):
+        # called by the converter thread, only remembered here, show_progress draws it
+        if event.kind == "end":
+            self.running_stages.pop(event.stage, None)
+        else:
+            self.running_stages[event.stage] = event
+
+    def show_progress(self):
+        if self.run_button['state'] != "disabled":
+            return
+        running = list(self.running_stages.values())
+        # run_pipeline only says something while none of its parts runs
+        labels = [self.stage_label(e) for e in running if e.stage != "run_pipeline"] or \
+                 [self.stage_label(e) for e in running] or [self.status]
+        self.run_button['text'] = f"{time.time() - self.started:.0f}s...{'，'.join(labels)}"
+        self.root.after(500, self.show_progress)
 
-    def time_count(self):
-        count = 0
-        while self.run_button['state'] == "disabled" and count < 1000:
-            self.run_button['text'] = f"{count}s...{self.status}"
-            count += 1
-            time.sleep(1)
+    @staticmethod
+    def stage_label(event):
+        label = STAGE_LABELS.get(event.stage, event.stage)
+        if event.items_total is not None:
+            label += f"({event.items}/{event.items_total}, {event.bytes / 1024 / 1024:.1f}MB)"
+        return label
 
 
-title = "RpkConverter"
-message_stdout = Messagebox(title)
-app = App(title=title)
+if __name__ == "__main__":
+    setup_logging()
+    title = "RpkConverter"
+    message_stdout = Messagebox(title)
+    app = App(title=title)
@@ -0,0 +1,197 @@
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+from cancellation import checked
+from downloader import TIMEOUT_SEC, open_part, remove_part, resume_headers
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# blobs left half downloaded by a process that is gone are removed after this long
+STALE_PART_SEC = 24 * 3600
+
+
+class MediaCache:
+    """on-disk media download cache shared across conversions (and processes)
+
+    urls map to blobs stored once under the sha1 of their content, so decks sharing the same
+    CDN assets share the files. Entries are revalidated with ETag / Last-Modified, and the least
+    recently used blobs are evicted once the cache grows over max_bytes.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.index_path = os.path.join(cache_dir, "index.sqlite3")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        with closing(self.connect()) as conn, conn as c:
+            c.execute("CREATE TABLE IF NOT EXISTS blobs"
+                      " (sha1 text primary key, size integer not null, last_used real not null)")
+            c.execute("CREATE TABLE IF NOT EXISTS urls"
+                      " (url text primary key, sha1 text not null, etag text, last_modified text)")
+            c.execute("CREATE INDEX IF NOT EXISTS ix_blobs_last_used on blobs (last_used)")
+        # the cap may have been lowered since the last run
+        self.evict()
+        self.remove_stale_parts()
+
+    def connect(self):
+        # one connection per call, closed after it: the cache is used from download threads and worker
+        # processes at once
+        return sqlite3.connect(self.index_path, timeout=60)
+
+    def blob_path(self, sha1):
+        return os.path.join(self.objects_dir, sha1)
+
+    def part_path(self, url):
+        """the blob this thread is downloading from url, kept between two attempts to resume from"""
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.objects_dir, f"tmp-{key}-{os.getpid()}-{threading.get_ident()}")
+
+    def remove_stale_parts(self):
+        for name in os.listdir(self.objects_dir):
+            path = os.path.join(self.objects_dir, name)
+            try:
+                if name.startswith("tmp-") and time.time() - os.path.getmtime(path) > STALE_PART_SEC:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def lookup(self, url):
+        with closing(self.connect()) as conn, conn as c:
+            return c.execute("SELECT sha1, etag, last_modified FROM urls WHERE url = ?", (url,)).fetchone()
+
+    def touch(self, sha1):
+        with closing(self.connect()) as conn, conn as c:
+            c.execute("UPDATE blobs SET last_used = ? WHERE sha1 = ?", (time.time(), sha1))
+
+    @staticmethod
+    def place(blob_path, dest_path):
+        """hardlink the blob into the job, copy it when linking is not possible (other drive, FAT...)"""
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(blob_path, dest_path)
+        except OSError:
+            shutil.copyfile(blob_path, dest_path)
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def fetch(self, session, url, dest_path, cancel_token=None):
+        """download url to dest_path through the cache, returns True on a cache hit"""
+        return self.fetch_blob(session, url, lambda blob_path: self.place(blob_path, dest_path), cancel_token)
+
+    def read(self, session, url, cancel_token=None):
+        """(content of url, True on a cache hit) through the cache, for jobs without a temp dir"""
+        data = []
+
+        def read_blob(blob_path):
+            with open(blob_path, "rb") as f:
+                data.append(f.read())
+
+        hit = self.fetch_blob(session, url, read_blob, cancel_token)
+        return data[0], hit
+
+    def fetch_blob(self, session, url, use, cancel_token=None):
+        """download url into the cache and call use(blob path) before the blob can be evicted,
+        returns True on a cache hit. cancel_token is checked between two chunks, an interrupted download
+        goes on from where it stopped on the next attempt of this thread"""
+        entry = self.lookup(url)
+        part_path = self.part_path(url)
+        headers = resume_headers(part_path)
+        if entry is not None:
+            sha1, etag, last_modified = entry
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        with session.get(url, stream=True, headers=headers, timeout=TIMEOUT_SEC) as r:
+            if entry is not None and r.status_code == 304:
+                try:
+                    use(self.blob_path(sha1))
+                except FileNotFoundError:
+                    # evicted by another process in the meantime
+                    pass
+                else:
+                    self.touch(sha1)
+                    self.count(True)
+                    return True
+                return self.refetch(session, url, use, cancel_token)
+            if "Range" in headers and r.status_code == 416:
+                remove_part(part_path)
+                return self.fetch_blob(session, url, use, cancel_token)
+            r.raise_for_status()
+            sha1 = self.store(part_path, r, headers, cancel_token)
+            etag = r.headers.get("ETag")
+            last_modified = r.headers.get("Last-Modified")
+        with closing(self.connect()) as conn, conn as c:
+            c.execute("INSERT OR REPLACE INTO urls (url, sha1, etag, last_modified) values (?, ?, ?, ?)",
+                      (url, sha1, etag, last_modified))
+        use(self.blob_path(sha1))
+        self.count(False)
+        self.evict()
+        return False
+
+    def refetch(self, session, url, use, cancel_token=None):
+        with closing(self.connect()) as conn, conn as c:
+            c.execute("DELETE FROM urls WHERE url = ?", (url,))
+        return self.fetch_blob(session, url, use, cancel_token)
+
+    def store(self, part_path, response, headers, cancel_token=None):
+        """write the body of response into part_path, then into a blob named by the sha1 of the whole
+        content, returns the sha1. headers: those of the request, see downloader.open_part"""
+        digest = hashlib.sha1()
+        f, size = open_part(part_path, response, headers)
+        with f:
+            if size:
+                # resumed, the start of the content is already there
+                with open(part_path, "rb") as start:
+                    for chunk in iter(lambda: start.read(CHUNK_SIZE), b""):
+                        digest.update(chunk)
+            for chunk in checked(response.iter_content(chunk_size=CHUNK_SIZE), cancel_token):
+                digest.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        sha1 = digest.hexdigest()
+        # same content from another url is already there, keep that one
+        os.replace(part_path, self.blob_path(sha1))
+        remove_part(part_path)
+        with closing(self.connect()) as conn, conn as c:
+            c.execute("INSERT OR REPLACE INTO blobs (sha1, size, last_used) values (?, ?, ?)",
+                      (sha1, size, time.time()))
+        return sha1
+
+    def evict(self):
+        """drop the least recently used blobs until the cache fits into max_bytes"""
+        with closing(self.connect()) as conn, conn as c:
+            total = c.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            evicted = []
+            for sha1, size in c.execute("SELECT sha1, size FROM blobs ORDER BY last_used").fetchall():
+                if total <= self.max_bytes:
+                    break
+                evicted.append(sha1)
+                total -= size
+            c.executemany("DELETE FROM blobs WHERE sha1 = ?", [(x,) for x in evicted])
+            c.executemany("DELETE FROM urls WHERE sha1 = ?", [(x,) for x in evicted])
+        for sha1 in evicted:
+            try:
+                # files already linked into a job stay alive through their own link
+                os.remove(self.blob_path(sha1))
+            except FileNotFoundError:
+                pass
+        logging.info(f"Media cache: evicted {len(evicted)} files")
@@ -0,0 +1,168 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class StageEvent:
+    """what a stage of a conversion did so far
+
+    kind: "start", "progress" or "end". started / ended: unix timestamps, ended is None until the end.
+    items_total: None when not known up front. error: message of the exception that ended the stage.
+    """
+
+    def __init__(self, kind, deck, stage, started, ended=None, items=0, items_total=None, nbytes=0, retries=0,
+                 error=None):
+        self.kind = kind
+        self.deck = deck
+        self.stage = stage
+        self.started = started
+        self.ended = ended
+        self.items = items
+        self.items_total = items_total
+        self.bytes = nbytes
+        self.retries = retries
+        self.error = error
+
+    @property
+    def elapsed(self):
+        return (self.ended or time.time()) - self.started
+
+    @property
+    def items_per_sec(self):
+        return self.items / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def bytes_per_sec(self):
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def to_dict(self):
+        return {"kind": self.kind, "deck": self.deck, "stage": self.stage, "started": self.started,
+                "ended": self.ended, "elapsed": self.elapsed, "items": self.items, "items_total": self.items_total,
+                "bytes": self.bytes, "items_per_sec": self.items_per_sec, "bytes_per_sec": self.bytes_per_sec,
+                "retries": self.retries, "error": self.error}
+
+
+class Stage:
+    """a running stage, see ConversionMetrics.stage. Safe to update from several threads"""
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.started = None
+        self.items = 0
+        self.items_total = None
+        self.bytes = 0
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def event(self, kind, ended=None, error=None):
+        return StageEvent(kind, self.metrics.deck, self.name, self.started, ended, self.items, self.items_total,
+                          self.bytes, self.retries, error)
+
+    def __enter__(self):
+        self.started = time.time()
+        self.metrics.emit(self.event("start"))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        event = self.event("end", ended=time.time(), error=(str(exc) or exc_type.__name__) if exc_type else None)
+        self.metrics.finish(event)
+        return False
+
+    def add(self, items=0, nbytes=0, retries=0):
+        """count work without telling the subscribers"""
+        with self.lock:
+            self.items += items
+            self.bytes += nbytes
+            self.retries += retries
+
+    def progress(self, items=None, items_total=None, nbytes=None, retries=None):
+        """set the counters to these totals and tell the subscribers"""
+        with self.lock:
+            if items is not None:
+                self.items = items
+            if items_total is not None:
+                self.items_total = items_total
+            if nbytes is not None:
+                self.bytes = nbytes
+            if retries is not None:
+                self.retries = retries
+            event = self.event("progress")
+        self.metrics.emit(event)
+
+
+class ConversionMetrics:
+    """the stage events of one conversion
+
+    subscribers are called with every StageEvent, in the thread running the stage, they should be quick
+    """
+
+    def __init__(self, deck):
+        self.deck = deck
+        self.subscribers = []
+        # {stage: last "end" event}, in the order the stages ended
+        self.stages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def stage(self, name):
+        """with metrics.stage("read_rpk") as stage: ... emits the start and end events of the stage"""
+        return Stage(self, name)
+
+    def emit(self, event):
+        for callback in list(self.subscribers):
+            callback(event)
+
+    def finish(self, event):
+        with self.lock:
+            self.stages[event.stage] = event
+        self.emit(event)
+
+    def summary(self):
+        """{"deck", "stages": {stage: event dict}} of the stages ended so far"""
+        with self.lock:
+            return {"deck": self.deck, "stages": {name: e.to_dict() for name, e in self.stages.items()}}
+
+    def summary_line(self):
+        with self.lock:
+            stages = list(self.stages.values())
+        parts = []
+        for e in stages:
+            part = f"{e.stage} {e.elapsed:.2f}s"
+            if e.items:
+                part += f" {e.items} items"
+            if e.bytes:
+                part += f" {e.bytes / 1024 / 1024:.1f} MB"
+            if e.retries:
+                part += f" {e.retries} retries"
+            parts.append(part)
+        return f"{self.deck}: " + ", ".join(parts)
+
+
+class JsonLinesSink:
+    """subscriber writing every event as a line of JSON, path is opened for appending"""
+
+    def __init__(self, path, kinds=("start", "end")):
+        """kinds: the kinds of events written, progress events can be many"""
+        self.kinds = set(kinds)
+        self.lock = threading.Lock()
+        self.f = open(path, "a", encoding="utf-8")
+
+    def __call__(self, event):
+        if event.kind not in self.kinds:
+            return
+        line = json.dumps(event.to_dict(), ensure_ascii=False) + "\n"
+        with self.lock:
+            # one write per line, so processes appending to the same file do not interleave lines
+            self.f.write(line)
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
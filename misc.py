@@ -1,8 +1,16 @@
+import hashlib
 import logging
 import random
 import string
 import time
-from logging.handlers import TimedRotatingFileHandler
+
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+
+def setup_logging(level=logging.INFO):
+    """log to stderr, called by the entry points: importing the converter configures nothing"""
+    logging.basicConfig(level=level, format=LOG_FORMAT)
 
 
 def now_sec():
@@ -18,7 +26,24 @@ def gen_guid():
     return ''.join(random.choice(letters) for i in range(10))
 
 
+# the alphabet anki writes its guids in
+BASE91_TABLE = string.ascii_letters + string.digits + "!#$%&()*+,-./:;<=>?@[]^_`{|}~"
+
+
+def stable_guid(*parts):
+    """an anki style guid derived from parts, the same note gets the same guid on every conversion"""
+    num = int.from_bytes(hashlib.sha1("\x1f".join(map(str, parts)).encode("utf-8")).digest()[:8], "big")
+    chars = []
+    while num:
+        num, i = divmod(num, len(BASE91_TABLE))
+        chars.append(BASE91_TABLE[i])
+    return "".join(reversed(chars)) or BASE91_TABLE[0]
+
+
 def get_logger(loggerName):
+    # logging.handlers is a tenth of the import time of the converter, and this is rarely used
+    from logging.handlers import TimedRotatingFileHandler
+
     logfilePath = f"{loggerName}.log"
     myLogger = logging.getLogger(loggerName)
     myLogger.setLevel(logging.INFO)
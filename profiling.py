@@ -0,0 +1,124 @@
+import cProfile
+import logging
+import os
+import pstats
+import threading
+import tracemalloc
+
+# the stages profiled when none are named
+PROFILE_STAGES = ("load_rpk_json", "write_to_sqlite", "insert_notes_table", "convert_media_files", "pack_apkg")
+# the same, once run_pipeline started: convert_media_files and pack_apkg do not run there. pack_media runs
+# alongside write_to_sqlite in another thread and only one thread is profiled at a time, name it to profile it
+PIPELINE_PROFILE_STAGES = ("load_rpk_json", "write_to_sqlite", "insert_notes_table", "write_collection")
+DEFAULT_TOP = 25
+
+# the thread profiling a stage: cProfile of python 3.12+ raises when a profiler is enabled while the one of
+# another thread is, so one thread of the process is profiled at a time
+_profiling_thread = None
+_profiling_thread_lock = threading.Lock()
+
+
+class StageProfiler:
+    """metrics subscriber running cProfile and tracemalloc over the chosen stages
+
+    writes <deck>.<stage>.pstats (open with pstats or snakeviz) and <deck>.<stage>.memory.txt, the top
+    allocations made during the stage, into out_dir. cProfile only sees the thread running the stage,
+    so the download and deflate threads do not show up. A stage nested in another profiled stage is
+    written on its own and added to the outer one. A stage starting while another thread is profiled is
+    skipped, e.g. write_to_sqlite while pack_media runs: name only one of them.
+
+    stages: PROFILE_STAGES by default, PIPELINE_PROFILE_STAGES inside run_pipeline
+    """
+
+    def __init__(self, out_dir, stages=None, top=DEFAULT_TOP):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.stages = set(stages) if stages else None
+        self.top = top
+        self.in_pipeline = False
+        # [profiled stage] of every thread, innermost last
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.tracing = 0
+        self.started_tracemalloc = False
+
+    def __call__(self, event):
+        if event.stage == "run_pipeline" and event.kind in ("start", "end"):
+            self.in_pipeline = event.kind == "start"
+        stages = self.stages
+        if stages is None:
+            stages = PIPELINE_PROFILE_STAGES if self.in_pipeline else PROFILE_STAGES
+        if event.stage not in stages:
+            return
+        if event.kind == "start":
+            self.start(event)
+        elif event.kind == "end":
+            self.stop(event)
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def start(self, event):
+        global _profiling_thread
+        stack = self.stack()
+        if not stack:
+            with _profiling_thread_lock:
+                if _profiling_thread is not None:
+                    logging.info(f"{event.stage} not profiled, {_profiling_thread.name} is being profiled")
+                    return
+                _profiling_thread = threading.current_thread()
+        else:
+            # one profiler per thread at a time, the outer one gets the inner stats added at its end
+            stack[-1]["profile"].disable()
+        with self.lock:
+            if self.tracing == 0:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self.started_tracemalloc = True
+                tracemalloc.reset_peak()
+            self.tracing += 1
+        profile = cProfile.Profile()
+        stack.append({"stage": event.stage, "profile": profile, "nested": [],
+                      "snapshot": tracemalloc.take_snapshot()})
+        profile.enable()
+
+    def stop(self, event):
+        global _profiling_thread
+        stack = self.stack()
+        if not stack or stack[-1]["stage"] != event.stage:
+            return
+        frame = stack.pop()
+        frame["profile"].disable()
+        if not stack:
+            with _profiling_thread_lock:
+                _profiling_thread = None
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        with self.lock:
+            self.tracing -= 1
+            if self.tracing == 0 and self.started_tracemalloc:
+                tracemalloc.stop()
+                self.started_tracemalloc = False
+        base = os.path.join(self.out_dir, f"{event.deck}.{event.stage}")
+        stats = pstats.Stats(frame["profile"])
+        for nested in frame["nested"]:
+            stats.add(nested)
+        stats.dump_stats(base + ".pstats")
+        self.write_memory(base + ".memory.txt", event, frame["snapshot"], snapshot, current, peak)
+        if stack:
+            stack[-1]["nested"].append(frame["profile"])
+            stack[-1]["profile"].enable()
+        logging.info(f"Profile of {event.stage} written to {base}.pstats")
+
+    def write_memory(self, path, event, before, after, current, peak):
+        # the profiler's own frames are noise
+        filters = [tracemalloc.Filter(False, f) for f in (tracemalloc.__file__, cProfile.__file__, __file__)]
+        diff = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"{event.deck} {event.stage}: {event.elapsed:.2f}s, traced {current / 1024 / 1024:.1f} MB"
+                    f" at the end, peak {peak / 1024 / 1024:.1f} MB while profiling\n")
+            f.write(f"top {self.top} allocations still alive at the end of the stage, by line:\n")
+            for stat in diff[:self.top]:
+                f.write(f"{stat}\n")
@@ -1,29 +1,58 @@
+import io
 import json
 import logging
 import os
 import shutil
+import sqlite3
+import queue
+import tempfile
+import threading
 import time
 import zipfile
+import zlib
 from collections import OrderedDict
-import requests
-from multiprocessing.pool import ThreadPool
-from util import resource_path
+from util import media_references, resource_path
 
-from anki_collection_writer import AnkiCollectionWriter
+from apkg_packer import DEFAULT_COMPRESS_LEVEL, ApkgPacker
+from anki_collection_writer import AnkiCollectionWriter, dump_collection, load_collection, open_collection
+from build_manifest import (MANIFEST_VERSION, PreviousBuild, PreviousMedia, commit_note_mods, discard_note_mods,
+                            hash_cards, iter_note_mods, open_note_mods, record_hash, remove_manifest,
+                            write_manifest)
+from cancellation import CancelToken, checked
+from checkpoint import Checkpoint, rpk_hash, work_dir_for
+from downloader import VALIDATOR_SUFFIX, Downloader, new_session
+from json_stream import JsonArrayStream
+from media_cache import MediaCache
+from metrics import ConversionMetrics
+from misc import now_sec
+from sharding import Shard, shard_file_name
+from template_cache import TemplateCache
 
-LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
-logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+ICON_FILES = ['icon-correct.png', 'icon-correct-2.png', 'icon-correct-not-selected.png', 'icon-error.png',
+              'icon-error-2.png']
+# rpk files up to this size are converted without a temp dir: the rpk, the downloads and the apkg stay in memory
+IN_MEMORY_MAX_BYTES = 64 * 1024 * 1024
 
-import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+# the requests session of the process, built by the first conversion that downloads something
+_web_client = None
+_web_client_lock = threading.Lock()
+_icons = {}
 
-DOWNLOAD_THREADS = 20
-web_client = requests.Session()
-retry = Retry(total=3)
-adapter = HTTPAdapter(pool_connections=DOWNLOAD_THREADS, pool_maxsize=DOWNLOAD_THREADS, max_retries=retry)
-web_client.mount('http://', adapter)
-web_client.mount('https://', adapter)
+
+def get_web_client():
+    global _web_client
+    with _web_client_lock:
+        if _web_client is None:
+            _web_client = new_session()
+        return _web_client
+
+
+def load_icon(filename):
+    ''' bytes of a static icon, read once per process '''
+    if filename not in _icons:
+        with open(resource_path(f"static/{filename}"), "rb") as f:
+            _icons[filename] = f.read()
+    return _icons[filename]
 
 
 
@@ -31,131 +60,702 @@ class RpkConverter:
     def __init__(self,
                  file_path: str,
                  out_dir: str,
-                 sqlite_path: str
+                 sqlite_path: str,
+                 streaming: bool = False,
+                 stream_cards: bool = False,
+                 collection_in_memory: bool = True,
+                 media_cache: MediaCache = None,
+                 compress_level: int = DEFAULT_COMPRESS_LEVEL,
+                 pack_threads: int = None,
+                 download_per_host: int = None,
+                 incremental: bool = False,
+                 template_cache: TemplateCache = None,
+                 profile_dir: str = None,
+                 profile_stages=None,
+                 profile_top: int = None,
+                 referenced_media_only: bool = False,
+                 convert_workers: int = None,
+                 in_memory_max_bytes: int = IN_MEMORY_MAX_BYTES,
+                 keep_temp: bool = False,
+                 resume: bool = False,
+                 cancel_token: CancelToken = None,
+                 shard: Shard = None
                  ):
         self.rpk_file_path = file_path
+        # in_memory: rpk files up to in_memory_max_bytes are read and converted without a temp dir, 0 always
+        # uses one. Downloads are held in memory too, until they add up to in_memory_max_bytes: a small rpk can
+        # name big remote media, the next ones go to a temp dir made then, see spill_path
+        self.in_memory_max_bytes = in_memory_max_bytes
+        self.in_memory = bool(in_memory_max_bytes) and os.path.isfile(file_path) and \
+            os.path.getsize(file_path) <= in_memory_max_bytes
+        # {download key: bytes, or the path of a download past the budget} of the resources when in memory
+        self.downloads = OrderedDict() if self.in_memory else None
+        self.spill_lock = threading.Lock()
+        # keep_temp: leave the temp dir in place when convert() is done
+        self.keep_temp = keep_temp
+        # resume: work in <deck>.apkg.work with a checkpoint of every finished step, kept when the job fails
+        # or is cancelled, so the next run of the same rpk into the same out_dir goes on from there.
+        # Decks converted in memory are quick to redo, they start over
+        self.resume = resume and not self.in_memory
+        self.checkpoint = None
+        self.finished = False
+        # cancel_token: cancel() stops the conversion with cancellation.Cancelled, the stages check it
+        # between two items
+        self.cancel_token = cancel_token or CancelToken()
+        # streaming: read json and media straight from the rpk zip instead of extracting it
+        self.streaming = streaming
+        # stream_cards: parse cards.json record by record while writing the notes instead of loading it at once
+        self.stream_cards = stream_cards
+        # collection_in_memory: build the collection in memory, otherwise in a file of the temp dir.
+        # A resumed conversion always keeps it in the file, to resume from
+        self.collection_in_memory = (collection_in_memory or self.in_memory) and not self.resume
+        # media_cache: shared download cache, downloads go straight to the network without it
+        self.media_cache = media_cache
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # compress_level: zlib level of the apkg, pack_threads: deflate threads, number of CPUs by default
+        self.compress_level = compress_level
+        self.pack_threads = pack_threads
+        # download_per_host: connections to one media host at once, as many as the download threads by default
+        self.download_per_host = download_per_host
+        # incremental: write a build manifest next to the apkg, and on the next run of the same deck
+        # only convert the changed cards, download the changed resources and copy the rest from the old apkg
+        self.incremental = incremental
+        # template_cache: models built from tpl records by earlier conversions, the process wide one by default
+        self.template_cache = template_cache
+        # shard: convert only the cards of this shard of the deck (see sharding.plan_shards) into
+        # <deck>.<shard>.apkg, with the models and media they use. The root deck keeps the name of the rpk
+        self.shard = shard
+        # referenced_media_only: download and pack only the resources the cards or templates mention,
+        # always with a shard, that is how it only carries its own media
+        self.referenced_media_only = referenced_media_only or shard is not None
+        # the names of the resources that are, None when every resource is packed
+        self.referenced_media = None
+        # convert_workers: processes converting the card fields of big decks, see AnkiCollectionWriter
+        self.convert_workers = convert_workers
+        self.previous = None
+        # {filename: PreviousMedia} of the resources not downloaded again
+        self.reused_downloads = OrderedDict()
+        self.resource_hashes = {}
+        self.card_hashes = []
+        self.rpk_zip = None
+        # {name: ZipInfo} of the rpk members, kept when extracting too
+        self.rpk_infos = {}
         self.sqlite_path = sqlite_path
         self.filename = os.path.splitext(os.path.split(self.rpk_file_path)[1])[0]
+        # the name of the apkg, the one of the rpk unless sharded
+        self.out_name = self.filename if shard is None else shard_file_name(self.filename, shard)
 
         self.out_dir = out_dir
-        # temp files directory labeled for concurrent
-        local_time = time.strftime("%y%m%d%H%M%S", time.localtime())
-        self.tmp_dir = f"{out_dir}/temp{local_time}"
-        self.rpk_tmp_dir = f"{self.tmp_dir}/rpk"
-        self.apkg_tmp_dir = f"{self.tmp_dir}/apkg"
-        os.mkdir(self.tmp_dir)
-        os.mkdir(self.rpk_tmp_dir)
-        os.mkdir(self.apkg_tmp_dir)
-
-        self.media_files_path = f"{self.rpk_tmp_dir}/resources"
+        # made by read_rpk unless in memory, see make_tmp_dir
+        self.tmp_dir = None
+        self.rpk_tmp_dir = None
+        self.apkg_tmp_dir = None
+        self.collection_path = None
+        self.media_files_path = None
+        self.collection_writer = None
 
         self.cards_df = None
         self.carts_df = None
         self.tpls_df = None
+        # {filename: source}, source is a path on disk, a ZipInfo of the rpk or bytes
+        self.media_sources = OrderedDict()
+        self.packer = None
+        # stage events, subscribe with self.metrics.subscribe(callback)
+        self.metrics = ConversionMetrics(self.out_name)
+        # profile_dir: run cProfile and tracemalloc over profile_stages and write their results there,
+        # see profiling.PROFILE_STAGES and DEFAULT_TOP for the defaults
+        if profile_dir is not None:
+            from profiling import DEFAULT_TOP, StageProfiler
+
+            self.metrics.subscribe(StageProfiler(profile_dir, profile_stages, profile_top or DEFAULT_TOP))
+
+    def cancel(self):
+        ''' stop the conversion from another thread, the stage running raises Cancelled within a second '''
+        self.cancel_token.cancel()
+
+    def make_tmp_dir(self):
+        if self.resume:
+            # the same dir on every run of the deck, call after self.rpk_infos is read
+            self.tmp_dir = work_dir_for(self.get_out_file_path())
+            os.makedirs(self.tmp_dir, exist_ok=True)
+            self.checkpoint = Checkpoint(self.tmp_dir, self.get_input_hash())
+            if self.checkpoint.resumed:
+                logging.info(f"Resuming from {self.tmp_dir}: {', '.join(sorted(self.checkpoint.steps)) or 'no step'}"
+                             f" done, {len(self.checkpoint.downloads)} files downloaded")
+        else:
+            # temp files directory labeled for concurrent, mkdtemp keeps jobs started in the same second apart
+            local_time = time.strftime("%y%m%d%H%M%S", time.localtime())
+            self.tmp_dir = tempfile.mkdtemp(prefix=f"temp{local_time}_", dir=self.out_dir)
+        self.rpk_tmp_dir = f"{self.tmp_dir}/rpk"
+        self.apkg_tmp_dir = f"{self.tmp_dir}/apkg"
+        os.makedirs(self.rpk_tmp_dir, exist_ok=True)
+        os.makedirs(self.apkg_tmp_dir, exist_ok=True)
+        # every job builds its own copy of the template collection
+        self.collection_path = f"{self.apkg_tmp_dir}/collection.anki2"
+        self.media_files_path = f"{self.rpk_tmp_dir}/resources"
+
+    def get_input_hash(self):
+        ''' hash of the rpk members, and of the shard converted '''
+        if self.shard is None:
+            return rpk_hash(self.rpk_infos)
+        return record_hash([rpk_hash(self.rpk_infos), self.shard.key()])
 
     def read_rpk(self):
         assert os.path.exists(self.rpk_file_path), f"File not exists: {self.rpk_file_path}"
         assert zipfile.is_zipfile(self.rpk_file_path), f"Not valid rpk file: {self.rpk_file_path}"
         logging.info("Reading from rpk file")
-        zipf = zipfile.ZipFile(self.rpk_file_path, "r", zipfile.ZIP_DEFLATED)
-        zipf.extractall(self.rpk_tmp_dir)
-        zipf.close()
+        with self.metrics.stage("read_rpk") as stage:
+            if self.in_memory:
+                # one read, the members are inflated from memory
+                with open(self.rpk_file_path, "rb") as f:
+                    zipf = zipfile.ZipFile(io.BytesIO(f.read()), "r", zipfile.ZIP_DEFLATED)
+            else:
+                zipf = zipfile.ZipFile(self.rpk_file_path, "r", zipfile.ZIP_DEFLATED)
+            self.rpk_infos = dict(zipf.NameToInfo)
+            stage.add(items=len(self.rpk_infos), nbytes=os.path.getsize(self.rpk_file_path))
+            if not self.in_memory:
+                self.make_tmp_dir()
+            if self.streaming or self.in_memory:
+                # kept open until pack_apkg
+                self.rpk_zip = zipf
+                return
+            with zipf:
+                if self.checkpoint is not None and self.checkpoint.done("extract_rpk"):
+                    return
+                for info in checked(zipf.infolist(), self.cancel_token):
+                    zipf.extract(info, self.rpk_tmp_dir)
+            if self.checkpoint is not None:
+                self.checkpoint.mark("extract_rpk")
+
+    def rpk_file_exists(self, name):
+        if self.rpk_zip is not None:
+            return name in self.rpk_zip.NameToInfo
+        return os.path.exists(f"{self.rpk_tmp_dir}/{name}")
+
+    def open_rpk_file(self, name):
+        ''' open a file of the rpk in binary mode, name is relative to the rpk root, e.g. data/cards.json '''
+        if self.rpk_zip is not None:
+            return self.rpk_zip.open(name)
+        return open(f"{self.rpk_tmp_dir}/{name}", "rb")
+
+    def load_json_file(self, name, object_hook=None):
+        with self.open_rpk_file(name) as f:
+            return json.load(io.TextIOWrapper(f, encoding="utf-8"), object_hook=object_hook)
+
+    def checked_object(self, obj):
+        ''' json object_hook checking the cancel token, a big json file is not parsed to the end once cancelled '''
+        self.cancel_token.check()
+        return obj
 
     def load_rpk_json(self):
         logging.info("Loading rpk json")
-        with open(f"{self.rpk_tmp_dir}/data/cards.json", encoding="utf-8") as f:
-            obj = json.load(f)
+        with self.metrics.stage("load_rpk_json") as stage:
+            select = self.shard.select if self.shard is not None else None
+            if self.stream_cards:
+                self.cards_df = JsonArrayStream(lambda: self.open_rpk_file("data/cards.json"), "cid", select)
+            else:
+                if select is not None:
+                    # only the cards of the shard are ever held
+                    cards = JsonArrayStream(lambda: self.open_rpk_file("data/cards.json"), "cid", select)
+                    self.cards_df = OrderedDict(checked(cards.items(), self.cancel_token))
+                else:
+                    obj = self.load_json_file("data/cards.json", object_hook=self.checked_object)
+                    self.cards_df = OrderedDict({x["cid"]: x for x in obj})
+                # streamed cards are counted by write_to_sqlite
+                stage.add(items=len(self.cards_df))
 
-        self.cards_df = OrderedDict({x["cid"]: x for x in obj})
+            # df[df['cid'] == df.iloc[0]['related_cid']]
 
-        # df[df['cid'] == df.iloc[0]['related_cid']]
+            self.cancel_token.check()
+            obj = self.load_json_file("data/cats.json")
+            self.carts_df = OrderedDict({x["aid"]: x for x in obj})
 
-        with open(f"{self.rpk_tmp_dir}/data/cats.json", encoding="utf-8") as f:
-            obj = json.load(f)
+            obj = self.load_json_file("data/tpls.json")
+            self.tpls_df = OrderedDict({x["tid"]: x for x in obj})
+            if self.shard is not None:
+                self.carts_df = OrderedDict((aid, x) for aid, x in self.carts_df.items() if aid in self.shard.cats)
+                self.tpls_df = OrderedDict((tid, x) for tid, x in self.tpls_df.items()
+                                           if tid in self.shard.mids or tid + 1 in self.shard.mids)
 
-        self.carts_df = OrderedDict({x["aid"]: x for x in obj})
+            if self.rpk_file_exists("data/resources.json"):
+                obj = self.load_json_file("data/resources.json")
+                self.resources_df = OrderedDict({x["id"]: x for x in obj})
+            else:
+                self.resources_df = OrderedDict()
+            if self.referenced_media_only:
+                self.scan_media_references()
+            stage.add(nbytes=sum(info.file_size for name, info in self.rpk_infos.items()
+                                 if name.startswith("data/")))
+            if self.incremental:
+                self.load_previous_build()
 
-        with open(f"{self.rpk_tmp_dir}/data/tpls.json", encoding="utf-8") as f:
-            obj = json.load(f)
-        self.tpls_df = OrderedDict({x["tid"]: x for x in obj})
+    def scan_media_references(self):
+        ''' find the resources mentioned by a card field or a template, the others are neither downloaded nor packed '''
+        bundled = {}
+        for name, info in self.rpk_infos.items():
+            filename = name[len("resources/"):]
+            if name.startswith("resources/") and filename and "/" not in filename:
+                bundled[filename] = info.file_size
+        remote = {row['name'] for row in self.resources_df.values() if row['type'] != 1}
+        names = remote | bundled.keys()
+        with self.metrics.stage("scan_references") as stage:
+            tpls_text = json.dumps(list(self.tpls_df.values()), ensure_ascii=False)
+            # templates are few, any mention counts there (scripts build names too)
+            refs = {name for name in names if name in tpls_text}
+            refs.update(media_references(tpls_text))
+            for card in checked(self.cards_df.values(), self.cancel_token):
+                data = card.get('data') or {}
+                refs.update(media_references("\n".join(str(v) for v in data.values() if v)))
+                stage.add(items=1)
+            self.referenced_media = refs & names
+        skipped_bundled = [name for name in bundled if name not in self.referenced_media]
+        skipped_remote = [name for name in remote if name not in self.referenced_media and name not in bundled]
+        skipped_bytes = sum(bundled[name] for name in skipped_bundled)
+        logging.info(f"Media references: {len(self.referenced_media)} of {len(names)} resources referenced,"
+                     f" skipped {len(skipped_bundled)} bundled ({skipped_bytes / 1024 / 1024:.1f} MB)"
+                     f" and {len(skipped_remote)} downloads")
 
-        resources_file = f"{self.rpk_tmp_dir}/data/resources.json"
-        if os.path.exists(resources_file):
-            with open(resources_file, encoding="utf-8") as f:
-                obj = json.load(f)
-            self.resources_df = OrderedDict({x["id"]: x for x in obj})
-        else:
-            self.resources_df = OrderedDict()
+    def is_referenced(self, filename):
+        return self.referenced_media is None or filename in self.referenced_media
+
+    def load_previous_build(self):
+        ''' hash the rpk tables and open the previous apkg of the deck, if its manifest still fits '''
+        self.tpls_hash = record_hash(list(self.tpls_df.values()))
+        self.cats_hash = record_hash(list(self.carts_df.values()))
+        self.resource_hashes = {row['name']: record_hash(row) for row in self.resources_df.values()
+                                if row['type'] != 1}
+        self.previous = PreviousBuild.load(self.get_out_file_path(), self.compress_level)
+        if self.previous is None:
+            return
+        for name, h in self.resource_hashes.items():
+            if self.previous.resources.get(name) == h:
+                media = self.previous.find_media(name)
+                if media is not None:
+                    self.reused_downloads[name] = media
+        logging.info(f"Previous build found, {len(self.reused_downloads)} of {len(self.resource_hashes)}"
+                     f" resources reused")
+
+    def get_content_mod(self):
+        ''' when the cards were exported, the mod of the new and changed notes: a re-import only updates them
+        after a new export. When incremental, the other notes keep the mod of the previous apkg, see write_collection '''
+        info = self.rpk_infos.get("data/cards.json")
+        if info is None:
+            return now_sec()
+        return int(time.mktime(info.date_time + (0, 0, -1)))
 
     def write_to_sqlite(self):
         logging.info("Writing to sqlite3")
-        cw = AnkiCollectionWriter(self.filename, self.sqlite_path,
-                                  cats_df=self.carts_df, cards_df=self.cards_df, tpls_df=self.tpls_df)
-        cw.clear_old_rows()
+        with self.metrics.stage("write_to_sqlite") as stage:
+            collection_path = ":memory:" if self.collection_in_memory else self.collection_path
+            if self.incremental:
+                # cards mentioning a file deduplicated last time are redone, the file may differ now
+                watched = self.previous.aliases.keys() if self.previous is not None else ()
+                self.card_hashes, watched_cids = hash_cards(self.cards_df, watched)
+            if self.checkpoint is not None and self.checkpoint.done("collection") and os.path.exists(collection_path):
+                # built by an earlier run, only the media references are left to rewrite
+                self.collection_writer = self.open_collection_writer(sqlite3.connect(collection_path))
+                return
+            if self.incremental and self.previous is not None and \
+                    self.previous.same_collection_inputs(self.tpls_hash, self.cats_hash):
+                con = load_collection(self.previous.read_collection(), collection_path)
+                stage.add(items=self.update_sqlite(con, watched_cids))
+                if self.checkpoint is not None:
+                    self.checkpoint.mark("collection")
+                return
+            con = open_collection(self.sqlite_path, collection_path)
+            cw = self.open_collection_writer(con)
+            cw.apply_build_pragmas()
+
+            cw.insert_col_table()
+            with self.metrics.stage("insert_notes_table") as inserting:
+                inserting.add(items=cw.insert_notes_table())
+            stage.add(items=inserting.items)
+            # kept open until write_collection, the media references may still be rewritten
+            self.collection_writer = cw
+            if self.checkpoint is not None:
+                self.checkpoint.mark("collection")
+
+    def open_collection_writer(self, con):
+        return AnkiCollectionWriter(self.filename, con,
+                                    cats_df=self.carts_df, cards_df=self.cards_df, tpls_df=self.tpls_df,
+                                    mod=self.get_content_mod(), template_cache=self.template_cache,
+                                    workers=self.convert_workers, cancel_token=self.cancel_token,
+                                    model_ids=self.shard.mids if self.shard is not None else None)
 
+    def update_sqlite(self, con, redo_cids):
+        ''' bring the collection of the previous build up to date, only the changed cards are converted,
+        returns the number of cards converted '''
+        cw = self.open_collection_writer(con)
+        cw.apply_build_pragmas()
+        previous_cards = self.previous.cards()
+        changed = set(redo_cids)
+        # [(due, cid)], the due of a card is its position in the deck
+        moved = []
+        for due, (cid, h) in enumerate(self.card_hashes, 1):
+            previous = previous_cards.pop(cid, None)
+            if previous is None or previous[1] != h:
+                changed.add(cid)
+            elif previous[0] != due:
+                moved.append((due, cid))
+        # what is left is gone from the rpk
+        cw.delete_notes(list(previous_cards) + list(changed))
         cw.insert_col_table()
-        cw.insert_notes_table()
-
-    def download_resource_files(self, progress_callback):
-        ''' progress_callback: (currentCount, totalCount) '''
-        os.makedirs(f'{self.rpk_tmp_dir}/resources/', exist_ok=True)
-        pool = ThreadPool(DOWNLOAD_THREADS)
-        futures = []
-
-        def download_file(name, url):
-            with web_client.get(url, stream=True) as r:
-                r.raise_for_status()
-                with open(f'{self.rpk_tmp_dir}/resources/{name}', 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        # If you have chunk encoded response uncomment if
-                        # and set chunk_size parameter to None.
-                        # if chunk:
-                        f.write(chunk)
+        with self.metrics.stage("insert_notes_table") as stage:
+            stage.add(items=cw.insert_notes_table(only=changed))
+        cw.update_due(moved)
+        logging.info(f"Collection updated: {len(changed)} cards converted, {len(previous_cards)} removed,"
+                     f" {len(moved)} moved")
+        self.collection_writer = cw
+        return len(changed)
 
+    def list_download_items(self):
+        ''' [(url, dest_path)] of the resources to download '''
+        items = []
         for idx, row in self.resources_df.items():
             name = row['name']
             url = row['url']
             type = row['type']
-            if type != 1:
+            if type != 1 and name not in self.reused_downloads and self.is_referenced(name) and \
+                    not self.downloaded_before(name):
                 # type = 1, TTS resources, skip
-                f = pool.apply_async(download_file, (name, url))
-                futures.append(f)
+                items.append((url, self.download_path(name)))
+        return items
+
+    def downloaded_before(self, name):
+        ''' downloaded by an earlier run of a resumed conversion, and still there '''
+        return self.checkpoint is not None and self.checkpoint.is_downloaded(name, self.download_path(name))
+
+    def download_path(self, name):
+        ''' where a resource is downloaded to, only the key of self.downloads when in memory '''
+        return name if self.in_memory else f'{self.media_files_path}/{name}'
+
+    def downloaded_source(self, dest_path):
+        return self.downloads[dest_path] if self.in_memory else dest_path
 
-        for idx, f in enumerate(futures):
-            f.get()
-            progress_callback(idx, len(futures))
+    def spill_path(self, name):
+        ''' where a download past the memory budget goes when in memory, the temp dir is made by the first one '''
+        with self.spill_lock:
+            if self.tmp_dir is None:
+                logging.info(f"Downloads over {self.in_memory_max_bytes // 1024 // 1024} MB, the next go to disk")
+                self.make_tmp_dir()
+                os.makedirs(self.media_files_path, exist_ok=True)
+        return f'{self.media_files_path}/{name}'
+
+    def download_resource_files(self, progress_callback, file_callback=None):
+        ''' progress_callback: (doneCount, totalCount, doneBytes), file_callback: (dest_path) of every finished file '''
+        if not self.in_memory:
+            os.makedirs(self.media_files_path, exist_ok=True)
+        with self.metrics.stage("download_resource_files") as stage:
+            items = self.list_download_items()
+            if not items:
+                # no session, no requests import
+                return
+            downloader = Downloader(get_web_client(), per_host=self.download_per_host,
+                                    media_cache=self.media_cache, buffers=self.downloads,
+                                    buffer_max_bytes=self.in_memory_max_bytes, spill_path=self.spill_path,
+                                    cancel_token=self.cancel_token)
+
+            def progress(done, count, nbytes):
+                stage.progress(done, count, nbytes, downloader.retried)
+                progress_callback(done, count, nbytes)
+
+            def downloaded(dest_path):
+                if self.checkpoint is not None:
+                    self.checkpoint.downloaded(os.path.basename(dest_path), os.path.getsize(dest_path))
+                if file_callback is not None:
+                    file_callback(dest_path)
+
+            results = downloader.download_all(items, progress, downloaded)
+            stage.progress(len(results), len(results), downloader.bytes_done, downloader.retried)
+        if self.media_cache is not None:
+            self.cache_hits = sum(1 for hit in results.values() if hit)
+            self.cache_misses = len(results) - self.cache_hits
+            logging.info(f"Media cache: {self.cache_hits} hits, {self.cache_misses} misses")
+
+    def list_media_sources(self):
+        ''' {filename: source}, downloaded files win over the files bundled in the rpk '''
+        sources = OrderedDict()
+        if self.rpk_zip is not None:
+            for info in self.rpk_zip.infolist():
+                name = info.filename[len("resources/"):]
+                if info.filename.startswith("resources/") and name and "/" not in name:
+                    sources[name] = info
+        if self.media_files_path is not None and os.path.exists(self.media_files_path):
+            for filename in os.listdir(self.media_files_path):
+                if filename.endswith((".part", ".part" + VALIDATOR_SUFFIX)):
+                    # unfinished download
+                    continue
+                sources[filename] = f"{self.media_files_path}/{filename}"
+        if self.downloads:
+            sources.update(self.downloads)
+        # unchanged resources are copied from the previous apkg instead of downloaded
+        sources.update(self.reused_downloads)
+        if self.referenced_media is not None:
+            return OrderedDict((f, source) for f, source in sources.items() if self.is_referenced(f))
+        return sources
+
+    @staticmethod
+    def list_icon_sources():
+        return OrderedDict(("_" + f, load_icon(f)) for f in ICON_FILES)
+
+    def open_media_source(self, source):
+        ''' (opener, size, date_time) of a media source '''
+        if isinstance(source, bytes):
+            return (lambda: io.BytesIO(source)), len(source), time.localtime()[:6]
+        if isinstance(source, zipfile.ZipInfo):
+            # read straight from the rpk, nothing touches the disk
+            return (lambda: self.rpk_zip.open(source)), source.file_size, source.date_time
+        st = os.stat(source)
+        return (lambda: open(source, "rb")), st.st_size, time.localtime(st.st_mtime)[:6]
+
+    def find_previous_media(self, filename, source):
+        ''' the PreviousMedia of a source whose content did not change since the previous build '''
+        if self.previous is None:
+            return None
+        if isinstance(source, PreviousMedia):
+            return source
+        if isinstance(source, bytes):
+            return self.previous.find_media(filename, zlib.crc32(source), len(source))
+        if not isinstance(source, zipfile.ZipInfo):
+            if filename in self.resource_hashes:
+                # just downloaded, so it changed
+                return None
+            # extracted from the rpk
+            source = self.rpk_infos.get(f"resources/{filename}")
+            if source is None:
+                return None
+        return self.previous.find_media(filename, source.CRC, source.file_size)
+
+    def add_media(self, filename, source):
+        previous = self.find_previous_media(filename, source)
+        if previous is not None:
+            self.packer.add_raw_media(filename, previous)
+            return
+        opener, size, date_time = self.open_media_source(source)
+        self.packer.add_media(filename, opener, size, date_time)
 
     def convert_media_files(self):
+        ''' collect the media files, they are numbered and written by pack_apkg '''
         logging.info("Converting media files")
-        media_list = os.listdir(self.media_files_path) if os.path.exists(self.media_files_path) else []
-        media_dict = {}
-        for i in range(len(media_list)):
-            filename = media_list[i]
-            os.rename(f"{self.media_files_path}/{filename}", f"{self.media_files_path}/{i}")
-            media_dict[f"{i}"] = filename
-        for f in ['icon-correct.png', 'icon-correct-2.png', 'icon-correct-not-selected.png', 'icon-error.png', 'icon-error-2.png']:
-            i = len(media_dict)
-            shutil.copyfile(resource_path(f"static/{f}"), f"{self.media_files_path}/{i}")
-            media_dict[f"{i}"] = "_" + f
-        json.dump(media_dict, open(f"{self.apkg_tmp_dir}/media", "w"))
+        with self.metrics.stage("convert_media_files") as stage:
+            self.media_sources = self.list_media_sources()
+            self.media_sources.update(self.list_icon_sources())
+            stage.add(items=len(self.media_sources))
+
+    def write_collection(self):
+        ''' write the media map and collection.anki2, the last entries of the apkg '''
+        cw = self.collection_writer
+        self.cancel_token.check()
+        if self.checkpoint is not None:
+            # changed from here on, the next run builds it again
+            self.checkpoint.forget("collection")
+        with self.metrics.stage("write_collection") as stage:
+            aliases = self.packer.get_aliases()
+            if aliases:
+                # duplicate media are not packed, their references point at the copy that is
+                still_referenced = cw.rewrite_media_references(aliases)
+                self.packer.write_duplicates(still_referenced)
+            self.packer.write_media_map()
+            self.cancel_token.check()
+            if self.incremental:
+                out_path = self.get_out_file_path()
+                with open_note_mods(out_path) as out:
+                    cw.keep_unchanged_mods(iter_note_mods(out_path), out)
+                self.cancel_token.check()
+            cw.optimize()
+            self.cancel_token.check()
+            if self.collection_in_memory:
+                data = dump_collection(cw.con)
+                stage.add(nbytes=len(data))
+                self.packer.write_collection(data)
+                cw.close()
+            else:
+                cw.close()
+                stage.add(nbytes=os.path.getsize(self.collection_path))
+                self.packer.write_collection(self.collection_path)
+            self.collection_writer = None
+
+    def open_packer(self, out_path):
+        # moved into place by finish_apkg
+        return ApkgPacker(out_path + ".part", compress_level=self.compress_level, threads=self.pack_threads,
+                          record_hashes=self.incremental, cancel_token=self.cancel_token)
+
+    def finish_apkg(self, out_path):
+        ''' move the finished apkg into place, with its build manifest when incremental '''
+        self.cancel_token.check()
+        self.packer.close()
+        # the previous apkg is about to be replaced
+        self.close_previous()
+        remove_manifest(out_path)
+        os.replace(out_path + ".part", out_path)
+        if self.incremental:
+            write_manifest(out_path, self.get_manifest(out_path))
+            commit_note_mods(out_path)
+        self.finished = True
+
+    def get_manifest(self, out_path):
+        written = set(self.packer.media.values())
+        return {
+            "version": MANIFEST_VERSION,
+            "compress_level": self.compress_level,
+            "apkg_size": os.path.getsize(out_path),
+            "tpls": self.tpls_hash,
+            "cats": self.cats_hash,
+            "resources": self.resource_hashes,
+            "cards": self.card_hashes,
+            "media": self.packer.media_hashes(),
+            "aliases": {f: c for f, c in self.packer.get_aliases().items() if f not in written},
+        }
 
     def pack_apkg(self):
         logging.info("Packing into apkg file")
         out_path = self.get_out_file_path()
-        zipf = zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED)
-        zipf.write(f"{self.apkg_tmp_dir}/media", "media")
-        zipf.write(self.sqlite_path, "collection.anki2")
-        media_list = os.listdir(self.media_files_path) if os.path.exists(self.media_files_path) else []
-        for media_file in media_list:
-            zipf.write(f"{self.media_files_path}/{media_file}", media_file)
-        zipf.close()
+        self.packer = self.open_packer(out_path)
+        with self.metrics.stage("pack_apkg") as stage:
+            try:
+                for filename, source in checked(self.media_sources.items(), self.cancel_token):
+                    self.add_media(filename, source)
+                self.write_collection()
+                self.finish_apkg(out_path)
+                stage.add(items=self.packer.stats.files, nbytes=os.path.getsize(out_path))
+            finally:
+                self.packer.abort()
+                discard_note_mods(out_path)
+                self.close_collection()
+                self.close_rpk()
+                self.close_previous()
         done_message = f"转换成功！输出文件在 {out_path} \n 你可以选择下一个文件进行转换。"
         logging.info(done_message)
+        logging.info(self.metrics.summary_line())
+
+    def run_pipeline(self, progress_callback=None):
+        ''' write_to_sqlite, download_resource_files, convert_media_files and pack_apkg overlapped:
+        the downloads start right away, the collection is written meanwhile, and every media file
+        is packed as soon as it is there. Call after load_rpk_json.
+
+        progress_callback: (doneCount, totalCount, doneBytes) of the downloads
+        '''
+        logging.info("Running the conversion pipeline")
+        progress_callback = progress_callback or (lambda done, count, nbytes: None)
+        downloading = {os.path.basename(dest_path) for _, dest_path in self.list_download_items()}
+        # downloaded files win over the files bundled in the rpk
+        bundled = [(filename, source) for filename, source in self.list_media_sources().items()
+                   if filename not in downloading]
+        downloaded = queue.Queue()
+        errors = []
+
+        def fail(e):
+            # the first error stops the other branches, the downloads left are not waited for
+            errors.append(e)
+            self.cancel_token.cancel()
+        out_path = self.get_out_file_path()
+        self.packer = self.open_packer(out_path)
+
+        def download():
+            try:
+                self.download_resource_files(progress_callback, downloaded.put)
+            except Exception as e:
+                fail(e)
+            finally:
+                downloaded.put(None)
+
+        def pack():
+            # the only thread writing to the packer until it is done
+            try:
+                with self.metrics.stage("pack_media") as stage:
+                    for filename, source in checked(bundled, self.cancel_token):
+                        self.add_media(filename, source)
+                        stage.add(items=1)
+                    while True:
+                        dest_path = downloaded.get()
+                        if dest_path is None:
+                            break
+                        self.cancel_token.check()
+                        self.add_media(os.path.basename(dest_path), self.downloaded_source(dest_path))
+                        stage.add(items=1)
+            except Exception as e:
+                fail(e)
+
+        with self.metrics.stage("run_pipeline") as stage:
+            threads = [threading.Thread(target=download, name="download"),
+                       threading.Thread(target=pack, name="pack")]
+            for t in threads:
+                t.start()
+            try:
+                self.write_to_sqlite()
+            except Exception as e:
+                fail(e)
+            for t in threads:
+                t.join()
+            try:
+                if errors:
+                    raise errors[0]
+                for filename, source in self.list_icon_sources().items():
+                    self.add_media(filename, source)
+                self.write_collection()
+                self.finish_apkg(out_path)
+                stage.add(items=self.packer.stats.files, nbytes=os.path.getsize(out_path))
+            finally:
+                self.packer.abort()
+                discard_note_mods(out_path)
+                self.close_collection()
+                self.close_rpk()
+                self.close_previous()
+        logging.info(f"转换成功！输出文件在 {out_path} \n 你可以选择下一个文件进行转换。")
+        logging.info(self.metrics.summary_line())
+
+    def convert(self, progress_callback=None, overlap=True):
+        ''' run every stage, progress_callback: (doneCount, totalCount, doneBytes) of the downloads
+
+        overlap: run the stages after load_rpk_json through run_pipeline, otherwise one after another.
+        The temp dir is deleted at the end, unless keep_temp
+        '''
+        try:
+            self.read_rpk()
+            self.load_rpk_json()
+            if overlap:
+                self.run_pipeline(progress_callback)
+                return
+            self.write_to_sqlite()
+            self.download_resource_files(progress_callback or (lambda done, count, nbytes: None))
+            self.convert_media_files()
+            self.pack_apkg()
+        finally:
+            if not self.keep_temp:
+                self.clear_tmp_files()
 
     def get_out_file_path(self):
-        return os.path.normpath(os.path.join(self.out_dir, self.filename + ".apkg"))
+        return os.path.normpath(os.path.join(self.out_dir, self.out_name + ".apkg"))
+
+    def close_collection(self):
+        if self.collection_writer is not None:
+            self.collection_writer.close()
+            self.collection_writer = None
+
+    def close_previous(self):
+        if self.previous is not None:
+            self.previous.close()
+            self.previous = None
+
+    def close_rpk(self):
+        if self.rpk_zip is not None:
+            self.rpk_zip.close()
+            self.rpk_zip = None
 
     def clear_tmp_files(self):
+        self.close_collection()
+        self.close_rpk()
+        self.close_previous()
+        if self.tmp_dir is None:
+            # in memory, or deleted already
+            return
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+            if not self.finished:
+                logging.info(f"Keeping {self.tmp_dir} to resume from")
+                self.tmp_dir = None
+                return
         logging.info("Deleting temp files")
         error_message = "Delete temp files failed. Please delete them manually."
         try:
@@ -163,3 +763,4 @@ class RpkConverter:
         except:
             logging.error(error_message)
             print(error_message)
+        self.tmp_dir = None
@@ -0,0 +1,537 @@
+# coding=utf-8
+"""Local conversion service, converts uploaded rpk files in warm worker processes.
+
+    python service.py --port 8780 --workers 4 --work-dir jobs/
+
+    POST   /jobs?name=deck.rpk  the rpk as the request body: 202 and the job, 503 while the queue is full
+    GET    /jobs                every job
+    GET    /jobs/<id>           state and stage events of a job
+    GET    /jobs/<id>/apkg      the apkg once the job is done, streamed from disk
+    DELETE /jobs/<id>           forget a finished job and delete its files, cancel a queued or running one
+    GET    /metrics             queue, jobs and stage totals
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import threading
+import time
+import traceback
+import uuid
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+from anki_collection_writer import load_template
+from cancellation import Cancelled
+from cli import add_converter_arguments, converter_options, open_converter
+from misc import setup_logging
+from rpk_converter import ICON_FILES, get_web_client, load_icon
+from util import resource_path
+
+COPY_CHUNK = 1024 * 1024
+# progress events of a stage are forwarded from the workers at most this often
+PROGRESS_INTERVAL = 0.5
+DEFAULT_PORT = 8780
+DEFAULT_MAX_QUEUED = 8
+DEFAULT_MAX_UPLOAD_MB = 2048
+DEFAULT_KEEP_JOBS = 100
+RETRY_AFTER_SEC = 5
+FINISHED = ("done", "failed")
+# dropped into the dir of a job to cancel it, the worker looks for it this often
+CANCEL_FILE = "cancel"
+CANCEL_POLL_SEC = 0.2
+# the error of the jobs running in a worker that died, killed or out of memory
+WORKER_DIED = "worker process died"
+
+
+class QueueFull(Exception):
+    pass
+
+
+# the queue taking the stage events of this worker process to the service, see init_worker
+_events = None
+
+
+def init_worker(events):
+    """load what every job needs once per worker: the template collection, the icons and the http session"""
+    global _events
+    _events = events
+    setup_logging()
+    get_web_client()
+    load_template(resource_path("static/template.sqlite3"))
+    for filename in ICON_FILES:
+        load_icon(filename)
+
+
+def watch_cancel(converter, marker, stopped):
+    """cancel the converter once the service drops the marker file, runs in a thread of the worker"""
+    while not stopped.wait(CANCEL_POLL_SEC):
+        if os.path.exists(marker):
+            converter.cancel()
+            return
+
+
+def run_job(job_id, rpk_path, out_dir, overlap, options):
+    """convert an upload inside a worker, returns the apkg path"""
+    last_progress = {}
+
+    def forward(event):
+        if event.kind == "progress":
+            now = time.time()
+            if now - last_progress.get(event.stage, 0) < PROGRESS_INTERVAL:
+                return
+            last_progress[event.stage] = now
+        _events.put((job_id, event.to_dict()))
+
+    converter = open_converter(rpk_path, out_dir, options)
+    converter.metrics.subscribe(forward)
+    marker = os.path.join(out_dir, CANCEL_FILE)
+    if os.path.exists(marker):
+        # cancelled while queued
+        converter.cancel()
+    stopped = threading.Event()
+    threading.Thread(target=watch_cancel, args=(converter, marker, stopped), name="cancel", daemon=True).start()
+    try:
+        converter.convert(overlap=overlap)
+        return converter.get_out_file_path()
+    except Cancelled:
+        logging.info(f"{rpk_path}: cancelled")
+        raise
+    except Exception:
+        logging.error(f"{rpk_path}: {traceback.format_exc()}")
+        raise
+    finally:
+        stopped.set()
+        converter.clear_tmp_files()
+
+
+class Job:
+    def __init__(self, job_id, name, job_dir):
+        self.id = job_id
+        self.name = name
+        self.dir = job_dir
+        self.rpk_path = os.path.join(job_dir, name)
+        # uploading, queued, running, done or failed
+        self.state = "uploading"
+        self.error = None
+        self.out_path = None
+        # DELETE came while queued or running, the job is forgotten as soon as it ends
+        self.cancelling = False
+        # queued again after a worker died before the job started, only once
+        self.requeued = False
+        self.upload_bytes = 0
+        self.created = time.time()
+        self.queued = None
+        self.started = None
+        self.ended = None
+        # {stage: last event dict}, in the order the stages started
+        self.stages = OrderedDict()
+
+    def to_dict(self):
+        return {"id": self.id, "name": self.name, "state": self.state, "error": self.error,
+                "upload_bytes": self.upload_bytes,
+                "apkg_bytes": os.path.getsize(self.out_path) if self.state == "done" else None,
+                "created": self.created, "queued": self.queued, "started": self.started, "ended": self.ended,
+                "running_stages": [name for name, e in self.stages.items() if e["kind"] != "end"],
+                "stages": self.stages}
+
+
+class ConversionService:
+    """the job queue: uploads wait for one of `workers` warm processes, at most max_queued of them
+
+    the workers live as long as the service, so the template, icons and http session are loaded once. When
+    one dies (killed, out of memory) the pool is replaced: the running jobs fail, the queued ones are queued again
+    """
+
+    def __init__(self, work_dir, workers=None, max_queued=DEFAULT_MAX_QUEUED, options=None, overlap=True,
+                 keep_jobs=DEFAULT_KEEP_JOBS):
+        os.makedirs(work_dir, exist_ok=True)
+        self.work_dir = work_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queued = max_queued
+        self.options = options or {}
+        self.overlap = overlap
+        # finished jobs kept for download, the oldest are deleted first
+        self.keep_jobs = keep_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        # summed over the jobs, for the means of /metrics
+        self.wait_sec = 0.0
+        self.waited = 0
+        self.job_sec = 0.0
+        # {stage: {"count", "sec", "items", "bytes"}} over every job ended
+        self.stage_totals = {}
+        # spawn: the service runs the http, event and pool threads, a forked worker could inherit their held locks
+        self.context = multiprocessing.get_context("spawn")
+        self.events = self.context.Queue()
+        self.executor = self.new_executor()
+        self.listener = threading.Thread(target=self.listen, name="job-events", daemon=True)
+        self.listener.start()
+
+    def new_executor(self):
+        return ProcessPoolExecutor(self.workers, mp_context=self.context, initializer=init_worker,
+                                   initargs=(self.events,))
+
+    def replace_executor(self, broken):
+        """a new pool in place of one whose worker died, once however many of its jobs report it"""
+        with self.lock:
+            if self.executor is not broken:
+                return
+            self.executor = self.new_executor()
+        broken.shutdown(wait=False)
+        logging.warning("A worker process died, the worker pool is started again")
+
+    def close(self):
+        with self.lock:
+            executor = self.executor
+        executor.shutdown(wait=False, cancel_futures=True)
+        # the workers are the only children of the service, the running jobs are not waited for
+        for process in multiprocessing.active_children():
+            process.terminate()
+            process.join()
+        self.events.put(None)
+        self.listener.join()
+
+    def listen(self):
+        while True:
+            item = self.events.get()
+            if item is None:
+                return
+            job_id, event = item
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    continue
+                if job.state == "queued":
+                    job.state = "running"
+                if job.started is None:
+                    # the events may come after the result
+                    job.started = event["started"]
+                    self.wait_sec += job.started - job.queued
+                    self.waited += 1
+                job.stages[event["stage"]] = event
+                if event["kind"] == "end":
+                    totals = self.stage_totals.setdefault(event["stage"],
+                                                          {"count": 0, "sec": 0.0, "items": 0, "bytes": 0})
+                    totals["count"] += 1
+                    totals["sec"] += event["elapsed"]
+                    totals["items"] += event["items"]
+                    totals["bytes"] += event["bytes"]
+
+    def reserve(self, name):
+        """a new job waiting for its upload, QueueFull when every worker and queue slot is taken"""
+        name = os.path.basename(name.replace("\\", "/")).strip() or "deck.rpk"
+        if not name.endswith(".rpk"):
+            name += ".rpk"
+        with self.lock:
+            active = sum(1 for j in self.jobs.values() if j.state not in FINISHED)
+            if active >= self.workers + self.max_queued:
+                self.rejected += 1
+                raise QueueFull()
+            job_id = uuid.uuid4().hex[:12]
+            job = Job(job_id, name, os.path.join(self.work_dir, job_id))
+            os.makedirs(job.dir)
+            self.jobs[job_id] = job
+        return job
+
+    def submit(self, job):
+        """queue an uploaded job"""
+        with self.lock:
+            if job.cancelling:
+                self.forget(job)
+                return
+            job.state = "queued"
+            job.queued = time.time()
+        self.run(job)
+
+    def run(self, job):
+        with self.lock:
+            executor = self.executor
+        try:
+            future = executor.submit(run_job, job.id, job.rpk_path, job.dir, self.overlap, self.options)
+        except BrokenProcessPool:
+            # a worker died while idle
+            self.replace_executor(executor)
+            with self.lock:
+                executor = self.executor
+            future = executor.submit(run_job, job.id, job.rpk_path, job.dir, self.overlap, self.options)
+        future.add_done_callback(lambda f: self.ended(job, executor, f))
+
+    def ended(self, job, executor, future):
+        try:
+            out_path = future.result()
+        except BrokenProcessPool:
+            # every job of the pool ends so, the one of the dead worker and the ones waiting
+            self.replace_executor(executor)
+            with self.lock:
+                requeue = job.state == "queued" and not job.requeued and not job.cancelling
+                job.requeued = True
+            if requeue:
+                self.run(job)
+            else:
+                self.finish(job, None, WORKER_DIED)
+        except BaseException as e:
+            self.finish(job, None, str(e) or e.__class__.__name__)
+        else:
+            self.finish(job, out_path, None)
+
+    def finish(self, job, out_path, error):
+        with self.lock:
+            job.out_path = out_path
+            job.error = error
+            job.state = "failed" if error is not None else "done"
+            job.ended = time.time()
+            if error is None:
+                self.completed += 1
+                self.job_sec += job.ended - job.queued
+            else:
+                self.failed += 1
+            if os.path.exists(job.rpk_path):
+                os.remove(job.rpk_path)
+            if job.cancelling:
+                self.forget(job)
+            finished = [j for j in self.jobs.values() if j.state in FINISHED]
+            for old in finished[:max(0, len(finished) - self.keep_jobs)]:
+                self.forget(old)
+        logging.info(f"Job {job.id} {job.name}: {job.state}" + (f", {error}" if error else ""))
+
+    def fail_upload(self, job, error):
+        with self.lock:
+            job.state = "failed"
+            job.error = error
+            job.ended = time.time()
+            self.forget(job)
+
+    def forget(self, job):
+        """call with the lock held"""
+        self.jobs.pop(job.id, None)
+        shutil.rmtree(job.dir, ignore_errors=True)
+
+    def delete(self, job_id):
+        """delete a finished job or cancel an unfinished one (forgotten when it ends), returns "deleted" or
+        "cancelling"
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return "deleted"
+            if job.state in FINISHED:
+                self.forget(job)
+                return "deleted"
+            job.cancelling = True
+            if job.state != "uploading":
+                # seen by the worker within CANCEL_POLL_SEC, the job is forgotten when it ends
+                open(os.path.join(job.dir, CANCEL_FILE), "w").close()
+        return "cancelling"
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job.to_dict() if job is not None else None
+
+    def apkg_path(self, job_id):
+        """the apkg of a done job, None once the job is gone"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job.out_path if job is not None and job.state == "done" else None
+
+    def list(self):
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def metrics(self):
+        with self.lock:
+            states = {}
+            for job in self.jobs.values():
+                states[job.state] = states.get(job.state, 0) + 1
+            return {
+                "uptime_sec": time.time() - self.started,
+                "workers": self.workers,
+                "max_queued": self.max_queued,
+                "jobs": states,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                # from queued to the first stage of a worker
+                "mean_wait_sec": self.wait_sec / self.waited if self.waited else None,
+                # from queued to done
+                "mean_job_sec": self.job_sec / self.completed if self.completed else None,
+                "stages": self.stage_totals,
+            }
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # set on the handler class by make_server()
+    service = None
+    max_upload_bytes = DEFAULT_MAX_UPLOAD_MB * 1024 * 1024
+
+    def send_json(self, status, obj, headers=()):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self):
+        url = urlsplit(self.path)
+        return [p for p in url.path.split("/") if p], parse_qs(url.query)
+
+    def do_GET(self):
+        parts, _ = self.route()
+        if parts == ["metrics"]:
+            self.send_json(200, self.service.metrics())
+        elif parts == ["jobs"]:
+            self.send_json(200, self.service.list())
+        elif len(parts) in (2, 3) and parts[0] == "jobs":
+            job = self.service.get(parts[1])
+            if job is None:
+                self.send_json(404, {"error": "no such job"})
+            elif len(parts) == 2:
+                self.send_json(200, job)
+            elif parts[2] != "apkg":
+                self.send_json(404, {"error": "not found"})
+            elif job["state"] != "done":
+                self.send_json(409, {"error": f"job is {job['state']}"})
+            else:
+                self.send_apkg(self.service.apkg_path(job["id"]))
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def send_apkg(self, out_path):
+        try:
+            if out_path is None:
+                raise FileNotFoundError
+            # still readable if the job is deleted meanwhile
+            f = open(out_path, "rb")
+        except FileNotFoundError:
+            # deleted since it was looked up
+            self.send_json(404, {"error": "no such job"})
+            return
+        filename = os.path.basename(out_path)
+        with f:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(filename)}")
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, COPY_CHUNK)
+
+    def do_POST(self):
+        parts, query = self.route()
+        if parts != ["jobs"]:
+            self.send_json(404, {"error": "not found"})
+            return
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.close_connection = True
+            self.send_json(411, {"error": "Content-Length required"})
+            return
+        length = int(length)
+        if length > self.max_upload_bytes:
+            # the body is not read, the connection can not be reused
+            self.close_connection = True
+            self.send_json(413, {"error": f"upload larger than {self.max_upload_bytes} bytes"})
+            return
+        try:
+            job = self.service.reserve(query.get("name", ["deck.rpk"])[0])
+        except QueueFull:
+            self.close_connection = True
+            self.send_json(503, {"error": "queue full"}, [("Retry-After", str(RETRY_AFTER_SEC))])
+            return
+        try:
+            self.receive(job, length)
+        except Exception as e:
+            self.service.fail_upload(job, str(e))
+            self.close_connection = True
+            self.send_json(400, {"error": str(e) or e.__class__.__name__})
+            return
+        self.service.submit(job)
+        self.send_json(202, self.service.get(job.id), [("Location", f"/jobs/{job.id}")])
+
+    def receive(self, job, length):
+        """write the request body to the rpk of the job, chunk by chunk"""
+        with open(job.rpk_path, "wb") as f:
+            left = length
+            while left > 0:
+                chunk = self.rfile.read(min(COPY_CHUNK, left))
+                if not chunk:
+                    raise ValueError("upload ended early")
+                f.write(chunk)
+                left -= len(chunk)
+        job.upload_bytes = length
+        if not zipfile.is_zipfile(job.rpk_path):
+            raise ValueError("not a valid rpk file")
+
+    def do_DELETE(self):
+        parts, _ = self.route()
+        if len(parts) != 2 or parts[0] != "jobs":
+            self.send_json(404, {"error": "not found"})
+        elif self.service.delete(parts[1]) == "cancelling":
+            self.send_json(202, {"id": parts[1], "deleted": False, "cancelling": True})
+        else:
+            self.send_json(200, {"id": parts[1], "deleted": True})
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def make_server(service, host="127.0.0.1", port=DEFAULT_PORT, max_upload_mb=DEFAULT_MAX_UPLOAD_MB):
+    """the http server of the service, call serve_forever() on it"""
+    handler = type("Handler", (ServiceHandler,), {"service": service,
+                                                  "max_upload_bytes": max_upload_mb * 1024 * 1024})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert uploaded rpk files to Anki apkg files over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--work-dir", default="service_jobs", help="uploads and finished apkg files go here")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="conversions running at once (default: number of CPUs)")
+    parser.add_argument("--max-queued", type=int, default=DEFAULT_MAX_QUEUED,
+                        help="uploads waiting for a worker, more are answered with 503")
+    parser.add_argument("--max-upload-mb", type=int, default=DEFAULT_MAX_UPLOAD_MB)
+    parser.add_argument("--keep-jobs", type=int, default=DEFAULT_KEEP_JOBS,
+                        help="finished jobs kept for download, the oldest are deleted first")
+    parser.add_argument("--no-overlap", action="store_true",
+                        help="run the stages one after another instead of downloading while the collection is written")
+    add_converter_arguments(parser)
+    args = parser.parse_args(argv)
+    setup_logging()
+    if args.convert_workers and args.convert_workers > 1:
+        parser.error("--convert-workers can not be used by the service workers")
+
+    service = ConversionService(args.work_dir, args.workers, args.max_queued, converter_options(args),
+                                overlap=not args.no_overlap, keep_jobs=args.keep_jobs)
+    server = make_server(service, args.host, args.port, args.max_upload_mb)
+    logging.info(f"Serving on http://{args.host}:{args.port} with {service.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
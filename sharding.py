@@ -0,0 +1,216 @@
+import io
+import json
+import logging
+import os
+import re
+import zipfile
+from collections import OrderedDict, defaultdict
+
+from build_manifest import record_hash
+from json_stream import iter_json_array
+from util import media_references
+
+# the shard of the cards without a category, like the default deck of AnkiCollectionWriter
+UNCATEGORIZED = "未分类"
+# remote media have no size in resources.json, they count as big as the mean bundled file, or this
+REMOTE_MEDIA_BYTES = 64 * 1024
+# characters a windows file name can not have
+UNSAFE_NAME_RE = re.compile(r'[\\/:*?"<>|\x00-\x1f]+')
+NAME_MAX_CHARS = 60
+
+
+class Shard:
+    """the cards of one apkg of a sharded deck, converted with RpkConverter(shard=...)
+
+    the cards of the categories in `aids`, or the cards at positions span[0] to span[1] - 1 of cards.json.
+    cats: the categories written as decks, their parents included, so every shard has the deck names of the
+    whole deck. mids: the models its cards use, the tid of the template or tid + 1 for the back side
+    """
+
+    def __init__(self, name, cats, mids, aids=None, span=None, cards=0, nbytes=0):
+        self.name = name
+        self.cats = frozenset(cats)
+        self.mids = frozenset(mids)
+        self.aids = frozenset(aids) if aids is not None else None
+        self.span = span
+        # counted, and estimated, by plan_shards
+        self.cards = cards
+        self.nbytes = nbytes
+
+    def select(self, cards):
+        """yield the cards of the shard out of all the cards of cards.json, in order"""
+        for position, card in enumerate(cards):
+            if self.span is None:
+                if card['aid'] in self.aids:
+                    yield card
+            elif position >= self.span[1]:
+                return
+            elif position >= self.span[0]:
+                yield card
+
+    def key(self):
+        """hash of what the shard holds, its checkpoint is not resumed from by another shard of the same name"""
+        return record_hash([self.name, sorted(self.cats), sorted(self.mids),
+                            sorted(self.aids) if self.aids is not None else None, self.span])
+
+
+def shard_file_name(deck_name, shard):
+    """<deck>.<shard>, the apkg of the shard is written as <deck>.<shard>.apkg"""
+    return f"{deck_name}.{shard.name}"
+
+
+def safe_name(name):
+    return UNSAFE_NAME_RE.sub("_", str(name)).strip(" .")[:NAME_MAX_CHARS]
+
+
+def top_categories(cats):
+    """{aid: aid of its top-level category}, the one hung under the root deck, see get_deck_names"""
+    tops = {}
+    for aid in cats:
+        path = []
+        on_path = set()
+        cur = aid
+        while cur not in tops:
+            row = cats.get(cur)
+            if row is None or cur in on_path:
+                # a missing parent or a cycle, the last category walked hangs under the root deck
+                top = path[-1]
+                break
+            path.append(cur)
+            on_path.add(cur)
+            if row['pid'] == 0:
+                top = cur
+                break
+            cur = row['pid']
+        else:
+            top = tops[cur]
+        for idx in path:
+            tops[idx] = top
+    return tops
+
+
+def model_id(card):
+    """the model of a card, see AnkiCollectionWriter.iter_cards"""
+    return card['tid'] + 1 if card['is_back'] == 1 else card['tid']
+
+
+def with_parents(aids, cats):
+    """the categories aids and every parent of them"""
+    result = set()
+    for aid in aids:
+        while aid in cats and aid not in result:
+            result.add(aid)
+            aid = cats[aid]['pid']
+    return result
+
+
+def media_sizes(z):
+    """{filename: bytes} of the resources of the rpk, the remote ones estimated"""
+    sizes = {}
+    for info in z.infolist():
+        name = info.filename[len("resources/"):]
+        if info.filename.startswith("resources/") and name and "/" not in name:
+            sizes[name] = info.file_size
+    remote_size = sum(sizes.values()) // len(sizes) if sizes else REMOTE_MEDIA_BYTES
+    if "data/resources.json" in z.NameToInfo:
+        for row in load_json(z, "data/resources.json"):
+            if row['type'] != 1:
+                sizes.setdefault(row['name'], remote_size)
+    return sizes
+
+
+def load_json(z, name):
+    with z.open(name) as f:
+        return json.load(io.TextIOWrapper(f, encoding="utf-8"))
+
+
+def plan_by_category(cards, cats):
+    """a shard per top-level category, in the order of cats.json, and one of the cards without a category"""
+    tops = top_categories(cats)
+    # {top aid: [aid]}, empty subcategories are kept as decks too
+    members = defaultdict(list)
+    for aid, top in tops.items():
+        members[top].append(aid)
+    # {top aid, 0 without a category: [cards, mids]}
+    counts = OrderedDict((aid, [0, set()]) for aid in cats if tops[aid] == aid)
+    # aid 0, or a category missing from cats.json
+    orphans = set()
+    for card in cards:
+        top = tops.get(card['aid'], 0)
+        if top == 0:
+            orphans.add(card['aid'])
+        count = counts.setdefault(top, [0, set()])
+        count[0] += 1
+        count[1].add(model_id(card))
+    shards = []
+    for top, (n, mids) in counts.items():
+        if n == 0:
+            continue
+        label = f"{len(shards) + 1:02d}-{safe_name(cats[top]['name']) if top else UNCATEGORIZED}"
+        aids = members[top] if top else orphans
+        shards.append(Shard(label, members[top] if top else (), mids, aids=aids, cards=n))
+    return shards
+
+
+def plan_by_size(cards, cats, max_cards=None, max_bytes=None, sizes=None):
+    """runs of consecutive cards, each up to max_cards cards and about max_bytes of fields and media
+
+    a file referenced by several cards of the run is counted once, templates are not counted
+    """
+    shards = []
+    start = 0
+    count = nbytes = 0
+    aids = set()
+    mids = set()
+    seen = set()
+
+    def close(stop):
+        shards.append(Shard(f"{len(shards) + 1:02d}", with_parents(aids, cats), mids, span=(start, stop),
+                            cards=count, nbytes=nbytes))
+
+    for position, card in enumerate(cards):
+        text_bytes = 0
+        refs = set()
+        if max_bytes:
+            data = card.get('data') or {}
+            text = "\n".join(str(v) for v in data.values() if v)
+            text_bytes = len(text.encode("utf-8"))
+            refs = media_references(text) & sizes.keys()
+        size = text_bytes + sum(sizes[x] for x in refs - seen)
+        if count and ((max_cards and count >= max_cards) or (max_bytes and nbytes + size > max_bytes)):
+            close(position)
+            start = position
+            count = nbytes = 0
+            aids = set()
+            mids = set()
+            seen = set()
+            size = text_bytes + sum(sizes[x] for x in refs)
+        count += 1
+        nbytes += size
+        aids.add(card['aid'])
+        mids.add(model_id(card))
+        seen |= refs
+    if count:
+        close(start + count)
+    return shards
+
+
+def plan_shards(rpk_path, by_category=False, max_cards=None, max_bytes=None):
+    """[Shard] of an rpk, read from its cards.json card by card
+
+    by_category: a shard per top-level category, otherwise runs of cards up to max_cards cards and max_bytes
+    of card fields plus media, as estimated from the rpk
+    """
+    assert by_category or max_cards or max_bytes, "Nothing to shard by"
+    with zipfile.ZipFile(rpk_path) as z:
+        cats = OrderedDict((x["aid"], x) for x in load_json(z, "data/cats.json"))
+        with z.open("data/cards.json") as f:
+            cards = iter_json_array(io.TextIOWrapper(f, encoding="utf-8"))
+            if by_category:
+                shards = plan_by_category(cards, cats)
+            else:
+                shards = plan_by_size(cards, cats, max_cards, max_bytes, media_sizes(z) if max_bytes else None)
+    deck_name = os.path.splitext(os.path.basename(rpk_path))[0]
+    logging.info(f"{deck_name}: {sum(s.cards for s in shards)} cards in {len(shards)} shards,"
+                 f" {max((s.cards for s in shards), default=0)} in the biggest")
+    return shards
@@ -0,0 +1,83 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import closing
+
+from build_manifest import record_hash
+
+# bump whenever get_models turns the same tpl record into different models
+TEMPLATE_CACHE_VERSION = 1
+# models kept in memory, the least recently used are dropped first (and read back from the sqlite file if any)
+MEMORY_MAX_ENTRIES = 2048
+
+
+class TemplateCache:
+    """models built from tpl records, keyed by the hash of the record without its tid
+
+    the last max_entries used are kept in memory for the whole process, and all of them in
+    cache_dir/templates.sqlite3 across runs (and processes)
+    when a cache_dir is given. Decks exported from the same Jihu templates share the entries.
+    """
+
+    def __init__(self, cache_dir: str = None, max_entries: int = MEMORY_MAX_ENTRIES):
+        # {key: models json}, in the order they were last used
+        self.memory = OrderedDict()
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.index_path = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.index_path = os.path.join(cache_dir, "templates.sqlite3")
+            with closing(self.connect()) as conn, conn as c:
+                c.execute("CREATE TABLE IF NOT EXISTS models (key text primary key, models text not null)")
+
+    def connect(self):
+        return sqlite3.connect(self.index_path, timeout=60)
+
+    @staticmethod
+    def key(row):
+        return f"{TEMPLATE_CACHE_VERSION}:{record_hash({k: v for k, v in row.items() if k != 'tid'})}"
+
+    def get(self, row):
+        """the cached value for the tpl record, a fresh copy, or None"""
+        key = self.key(row)
+        with self.lock:
+            text = self.memory.get(key)
+            if text is not None:
+                self.memory.move_to_end(key)
+        if text is None and self.index_path is not None:
+            with closing(self.connect()) as conn, conn as c:
+                found = c.execute("SELECT models FROM models WHERE key = ?", (key,)).fetchone()
+            if found is not None:
+                text = found[0]
+                self.remember(key, text)
+        with self.lock:
+            if text is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(text)
+
+    def remember(self, key, text):
+        with self.lock:
+            self.memory[key] = text
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def put(self, row, value):
+        """value: json serializable"""
+        key = self.key(row)
+        text = json.dumps(value)
+        self.remember(key, text)
+        if self.index_path is not None:
+            with closing(self.connect()) as conn, conn as c:
+                c.execute("INSERT OR REPLACE INTO models (key, models) values (?, ?)", (key, text))
+
+
+# shared by the conversions of a process that are not given a cache of their own
+process_template_cache = TemplateCache()
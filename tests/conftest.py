@@ -0,0 +1,81 @@
+import hashlib
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from downloader import new_session
+
+
+class CdnHandler(BaseHTTPRequestHandler):
+    """serves server.files, {path: bytes}, with an ETag of their content, 304s and Range / If-Range
+
+    server.cut: {path: bytes}, the next answer of path stops after that many bytes of the body
+    server.stall: paths answered with nothing for 2s. server.sent: {path: body bytes sent}
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.path in self.server.stall:
+            time.sleep(2)
+            self.close_connection = True
+            return
+        if data is None:
+            self.send_error(404)
+            return
+        etag = '"' + hashlib.sha1(data).hexdigest()[:16] + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range", etag) == etag:
+            start = int(range_header[len("bytes="):-1])
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        body = data[start:start + self.server.cut.pop(self.path)] if self.path in self.server.cut else data[start:]
+        self.wfile.write(body)
+        self.server.sent[self.path] = self.server.sent.get(self.path, 0) + len(body)
+        if len(body) < len(data) - start:
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def cdn():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CdnHandler)
+    server.daemon_threads = True
+    server.files = {}
+    server.cut = {}
+    server.stall = set()
+    server.sent = {}
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def session():
+    with new_session() as s:
+        yield s
@@ -0,0 +1,138 @@
+"""ApkgPacker: the zip it writes by hand, deflated in parallel, deduplicated, raw-copied and with ZIP64"""
+import hashlib
+import io
+import json
+import random
+import zipfile
+
+import apkg_packer
+from apkg_packer import ApkgPacker
+from build_manifest import PreviousBuild
+
+DATE_TIME = (2024, 1, 1, 0, 0, 0)
+
+
+def text(seed, size):
+    """compressible bytes, several deflate blocks when big"""
+    rnd = random.Random(seed)
+    words = [f"word{i} ".encode() for i in range(500)]
+    out = bytearray()
+    while len(out) < size:
+        out += rnd.choice(words)
+    return bytes(out[:size])
+
+
+def noise(seed, size):
+    return random.Random(seed).randbytes(size)
+
+
+FILES = {
+    "big.svg": text(1, 3 * apkg_packer.DEFLATE_BLOCK_SIZE + 12345),
+    "small.txt": text(2, 100),
+    "empty.svg": b"",
+    "image.png": noise(3, 200000),
+    "sound.mp3": noise(4, 5000),
+}
+
+
+def add(packer, filename, data):
+    packer.add_media(filename, lambda: io.BytesIO(data), len(data), DATE_TIME)
+
+
+def pack(path, files=FILES, **kwargs):
+    packer = ApkgPacker(str(path), **kwargs)
+    for filename, data in files.items():
+        add(packer, filename, data)
+    packer.close()
+    return packer
+
+
+def contents(path):
+    """{filename: bytes} through the media map"""
+    with zipfile.ZipFile(path) as z:
+        assert z.testzip() is None
+        media = json.loads(z.read("media")) if "media" in z.NameToInfo else None
+        if media is None:
+            return {info.filename: z.read(info) for info in z.infolist()}
+        return {filename: z.read(arcname) for arcname, filename in media.items()}
+
+
+def test_thread_count_does_not_change_the_archive(tmp_path):
+    pack(tmp_path / "1.apkg", threads=1)
+    pack(tmp_path / "4.apkg", threads=4)
+    assert (tmp_path / "1.apkg").read_bytes() == (tmp_path / "4.apkg").read_bytes()
+
+
+def test_stored_and_deflated_members_read_back(tmp_path):
+    packer = ApkgPacker(str(tmp_path / "a.apkg"), threads=4)
+    for filename, data in FILES.items():
+        add(packer, filename, data)
+    packer.write_media_map()
+    packer.write_collection(b"collection" * 1000)
+    packer.close()
+    assert contents(tmp_path / "a.apkg") == FILES
+    with zipfile.ZipFile(tmp_path / "a.apkg") as z:
+        types = {z.getinfo(a).compress_type for a in json.loads(z.read("media"))}
+        assert types == {zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED}
+        assert z.read("collection.anki2") == b"collection" * 1000
+
+
+def test_raw_copied_members_read_back(tmp_path):
+    previous_path = str(tmp_path / "previous.apkg")
+    packer = ApkgPacker(previous_path)
+    for filename, data in FILES.items():
+        add(packer, filename, data)
+    packer.write_media_map()
+    packer.close()
+    manifest = {"resources": {}, "aliases": {},
+                "media": {filename: hashlib.sha1(data).hexdigest() for filename, data in FILES.items()}}
+    previous = PreviousBuild(previous_path, manifest)
+    packer = ApkgPacker(str(tmp_path / "new.apkg"))
+    add(packer, "new.txt", b"new" * 100)
+    for filename in FILES:
+        packer.add_raw_media(filename, previous.find_media(filename))
+    packer.write_media_map()
+    packer.close()
+    previous.close()
+    assert packer.stats.reused_files == len(FILES)
+    assert contents(tmp_path / "new.apkg") == dict(FILES, **{"new.txt": b"new" * 100})
+
+
+def test_duplicates_keep_the_smallest_name(tmp_path):
+    same = noise(5, 1000)
+    packer = ApkgPacker(str(tmp_path / "a.apkg"))
+    add(packer, "c.png", same)
+    add(packer, "other.png", noise(6, 1000))
+    add(packer, "a.png", same)
+    add(packer, "b.png", same)
+    assert packer.get_aliases() == {"b.png": "a.png", "c.png": "a.png"}
+    # b.png is still named somewhere the references were not rewritten
+    packer.write_duplicates({"b.png"})
+    packer.write_media_map()
+    packer.close()
+    assert contents(tmp_path / "a.apkg") == {"a.png": same, "b.png": same, "other.png": noise(6, 1000)}
+    assert packer.stats.dedup_files == 1
+
+
+def test_zip64_members(tmp_path, monkeypatch):
+    monkeypatch.setattr(zipfile, "ZIP64_LIMIT", 1000)
+    first = tmp_path / "first.apkg"
+    packer = ApkgPacker(str(first), threads=2)
+    for filename, data in FILES.items():
+        add(packer, filename, data)
+    packer.write_media_map()
+    packer.close()
+    manifest = {"resources": {}, "aliases": {},
+                "media": {filename: hashlib.sha1(data).hexdigest() for filename, data in FILES.items()}}
+    previous = PreviousBuild(str(first), manifest)
+    packer = ApkgPacker(str(tmp_path / "raw.apkg"))
+    for filename in FILES:
+        packer.add_raw_media(filename, previous.find_media(filename))
+    packer.write_media_map()
+    packer.close()
+    previous.close()
+    for path in (first, tmp_path / "raw.apkg"):
+        with zipfile.ZipFile(path) as z:
+            # member 0 is big.svg, over the limit: it carries the zip64 extra field, id 1
+            assert z.getinfo("0").extra[:2] == b"\x01\x00"
+        assert contents(path) == FILES
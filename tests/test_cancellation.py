@@ -0,0 +1,28 @@
+"""CancelToken stopping the sqlite statements of a conversion while they run"""
+from collections import OrderedDict
+
+import pytest
+
+from anki_collection_writer import AnkiCollectionWriter, open_collection
+from cancellation import CancelToken, Cancelled
+from util import resource_path
+
+
+def test_cancelled_token_interrupts_optimize():
+    token = CancelToken()
+    cw = AnkiCollectionWriter("deck", open_collection(resource_path("static/template.sqlite3")),
+                              OrderedDict(), OrderedDict(), OrderedDict(), cancel_token=token)
+    # enough rows for VACUUM to run a while
+    cw.con.execute("CREATE TABLE filler AS WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n"
+                   " WHERE i < 200000) SELECT i, hex(randomblob(50)) AS x FROM n")
+    token.cancel()
+    with pytest.raises(Cancelled):
+        cw.optimize()
+    cw.close()
+
+
+def test_optimize_runs_without_cancel():
+    cw = AnkiCollectionWriter("deck", open_collection(resource_path("static/template.sqlite3")),
+                              OrderedDict(), OrderedDict(), OrderedDict(), cancel_token=CancelToken())
+    cw.optimize()
+    cw.close()
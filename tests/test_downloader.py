@@ -0,0 +1,61 @@
+"""Downloader resuming .part files with Range / If-Range"""
+import os
+
+from downloader import VALIDATOR_SUFFIX, Downloader
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_part_of_the_same_file_is_resumed(cdn, session, tmp_path):
+    data = os.urandom(1000000)
+    cdn.files["/a.png"] = data
+    cdn.cut["/a.png"] = 300000
+    dest = str(tmp_path / "a.png")
+    Downloader(session, backoff=0).download_all([(cdn.url + "/a.png", dest)])
+    assert read(dest) == data
+    # the chunks written before the connection broke are not asked for again
+    offset = int(cdn.requests[-1][1]["Range"][len("bytes="):-1])
+    assert 0 < offset <= 300000
+    assert cdn.sent["/a.png"] == 1300000 - offset
+    assert sorted(os.listdir(tmp_path)) == ["a.png"]
+
+
+def test_part_of_a_changed_file_is_not_spliced(cdn, session, tmp_path):
+    dest = str(tmp_path / "a.png")
+    with open(dest + ".part", "wb") as f:
+        f.write(b"old" * 1000)
+    with open(dest + ".part" + VALIDATOR_SUFFIX, "w") as f:
+        f.write('"etag-of-the-old-file"')
+    cdn.files["/a.png"] = b"new" * 2000
+    Downloader(session).download_all([(cdn.url + "/a.png", dest)])
+    assert cdn.requests[-1][1]["If-Range"] == '"etag-of-the-old-file"'
+    assert read(dest) == b"new" * 2000
+
+
+def test_part_without_validator_starts_over(cdn, session, tmp_path):
+    dest = str(tmp_path / "a.png")
+    with open(dest + ".part", "wb") as f:
+        f.write(b"old" * 1000)
+    cdn.files["/a.png"] = b"new" * 2000
+    Downloader(session).download_all([(cdn.url + "/a.png", dest)])
+    assert "Range" not in cdn.requests[-1][1]
+    assert read(dest) == b"new" * 2000
+
+
+def test_buffers_past_the_budget_go_to_disk(cdn, session, tmp_path):
+    for name in "abc":
+        cdn.files[f"/{name}.png"] = name.encode() * 1000
+    buffers = {}
+    # one at a time, the first file alone fills the budget
+    downloader = Downloader(session, threads=1, per_host=1, buffers=buffers, buffer_max_bytes=1000,
+                            spill_path=lambda dest: str(tmp_path / dest))
+    downloader.download_all([(cdn.url + f"/{name}.png", name) for name in "abc"])
+    in_memory = [name for name in "abc" if isinstance(buffers[name], bytes)]
+    assert len(in_memory) == 1
+    for name in "abc":
+        data = buffers[name] if name in in_memory else read(buffers[name])
+        assert data == name.encode() * 1000
+    assert sorted(os.listdir(tmp_path)) == sorted(set("abc") - set(in_memory))
@@ -0,0 +1,52 @@
+"""iter_json_array reading a json array item by item"""
+import io
+import json
+
+import pytest
+
+from json_stream import iter_json_array
+
+ITEMS = [
+    {"id": 1, "text": "a ] b, c [ d"},
+    "],[",
+    12.5,
+    -3e10,
+    [1, [2, [3]]],
+    None,
+    True,
+    "冒险举动；轻举妄动",
+    {"nested": {"s": "\"]\", \\\\", "n": []}},
+    "x" * 1000,
+]
+
+
+def items(text, read_size=64 * 1024):
+    return list(iter_json_array(io.StringIO(text), read_size))
+
+
+@pytest.mark.parametrize("read_size", [1, 2, 3, 7, 64, 64 * 1024])
+def test_items_split_across_reads(read_size):
+    text = json.dumps(ITEMS, ensure_ascii=False)
+    assert items(text, read_size) == ITEMS
+    assert items(json.dumps(ITEMS, indent=2), read_size) == ITEMS
+
+
+@pytest.mark.parametrize("read_size", [1, 4, 64])
+def test_numbers_cut_by_a_read_are_not_truncated(read_size):
+    assert items("[12.5,1000000,-7e3]", read_size) == [12.5, 1000000, -7e3]
+
+
+@pytest.mark.parametrize("text", ["[]", " [ ] ", "\n[\n]\n"])
+def test_empty_arrays(text):
+    assert items(text, 1) == []
+    assert items(text) == []
+
+
+@pytest.mark.parametrize("text", [
+    "[1,]", "[1, ]", "[,1]", "[1,,2]", "[1 2]", "[1,2] junk", "[1,2]]", "[1,2",
+    "[", "", "{}", "1",
+])
+@pytest.mark.parametrize("read_size", [1, 64])
+def test_malformed_arrays_raise(text, read_size):
+    with pytest.raises(ValueError):
+        items(text, read_size)
@@ -0,0 +1,111 @@
+"""MediaCache against a local stand-in of the media CDN: ETag revalidation, dedup, changed content, eviction"""
+import hashlib
+import os
+import sqlite3
+
+import pytest
+import requests
+
+import media_cache
+from media_cache import MediaCache
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def blobs(cache):
+    return sorted(x for x in os.listdir(cache.objects_dir) if not x.startswith("tmp-"))
+
+
+def test_second_fetch_is_a_304_hit(cdn, session, tmp_path):
+    cdn.files["/a.png"] = b"a" * 1000
+    cache = MediaCache(str(tmp_path / "cache"))
+    assert cache.fetch(session, cdn.url + "/a.png", str(tmp_path / "1.png")) is False
+    assert cache.fetch(session, cdn.url + "/a.png", str(tmp_path / "2.png")) is True
+    assert read(tmp_path / "2.png") == b"a" * 1000
+    assert "If-None-Match" in cdn.requests[-1][1]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_same_content_from_two_urls_is_stored_once(cdn, session, tmp_path):
+    cdn.files["/x/a.png"] = cdn.files["/y/a.png"] = b"same" * 100
+    cache = MediaCache(str(tmp_path / "cache"))
+    cache.fetch(session, cdn.url + "/x/a.png", str(tmp_path / "1.png"))
+    cache.fetch(session, cdn.url + "/y/a.png", str(tmp_path / "2.png"))
+    assert blobs(cache) == [hashlib.sha1(b"same" * 100).hexdigest()]
+    assert read(tmp_path / "1.png") == read(tmp_path / "2.png")
+
+
+def test_changed_content_is_downloaded_again(cdn, session, tmp_path):
+    cdn.files["/a.png"] = b"old"
+    cache = MediaCache(str(tmp_path / "cache"))
+    cache.fetch(session, cdn.url + "/a.png", str(tmp_path / "1.png"))
+    cdn.files["/a.png"] = b"new"
+    assert cache.fetch(session, cdn.url + "/a.png", str(tmp_path / "2.png")) is False
+    assert read(tmp_path / "2.png") == b"new"
+    data, hit = cache.read(session, cdn.url + "/a.png")
+    assert (data, hit) == (b"new", True)
+
+
+def test_least_recently_used_blob_is_evicted(cdn, session, tmp_path):
+    for name in "abc":
+        cdn.files[f"/{name}.png"] = name.encode() * 400
+    cache = MediaCache(str(tmp_path / "cache"), max_bytes=1000)
+    cache.fetch(session, cdn.url + "/a.png", str(tmp_path / "a.png"))
+    cache.fetch(session, cdn.url + "/b.png", str(tmp_path / "b.png"))
+    # a is used again, b is now the least recently used one
+    assert cache.fetch(session, cdn.url + "/a.png", str(tmp_path / "a2.png")) is True
+    cache.fetch(session, cdn.url + "/c.png", str(tmp_path / "c.png"))
+    assert blobs(cache) == sorted(hashlib.sha1(x.encode() * 400).hexdigest() for x in "ac")
+    # evicted from the index too, fetched as a miss
+    assert cache.fetch(session, cdn.url + "/b.png", str(tmp_path / "b2.png")) is False
+    # files linked into a job outlive the eviction of their blob
+    assert read(tmp_path / "b.png") == b"b" * 400
+
+
+def test_interrupted_download_goes_on_from_where_it_stopped(cdn, session, tmp_path):
+    cdn.files["/a.png"] = os.urandom(1000000)
+    cdn.cut["/a.png"] = 300000
+    cache = MediaCache(str(tmp_path / "cache"))
+    with pytest.raises(requests.RequestException):
+        cache.fetch(session, cdn.url + "/a.png", str(tmp_path / "1.png"))
+    cache.fetch(session, cdn.url + "/a.png", str(tmp_path / "1.png"))
+    assert read(tmp_path / "1.png") == cdn.files["/a.png"]
+    offset = int(cdn.requests[-1][1]["Range"][len("bytes="):-1])
+    assert 0 < offset <= 300000
+    assert cdn.sent["/a.png"] == 1300000 - offset
+    assert os.listdir(cache.objects_dir) == blobs(cache)
+
+
+def test_stalled_server_times_out(cdn, session, tmp_path, monkeypatch):
+    monkeypatch.setattr(media_cache, "TIMEOUT_SEC", 0.5)
+    cdn.files["/a.png"] = b"a" * 1000
+    cdn.stall.add("/a.png")
+    cache = MediaCache(str(tmp_path / "cache"))
+    with pytest.raises(requests.Timeout):
+        cache.fetch(session, cdn.url + "/a.png", str(tmp_path / "1.png"))
+
+
+def test_index_connections_are_closed(cdn, session, tmp_path, monkeypatch):
+    opened = []
+    real_connect = sqlite3.connect
+
+    class Connection(sqlite3.Connection):
+        closed = False
+
+        def close(self):
+            self.closed = True
+            super().close()
+
+    def connect(*args, **kwargs):
+        opened.append(real_connect(*args, factory=Connection, **kwargs))
+        return opened[-1]
+
+    monkeypatch.setattr(media_cache.sqlite3, "connect", connect)
+    cdn.files["/a.png"] = b"a" * 1000
+    cache = MediaCache(str(tmp_path / "cache"), max_bytes=500)
+    cache.fetch(session, cdn.url + "/a.png", str(tmp_path / "1.png"))
+    cache.fetch(session, cdn.url + "/a.png", str(tmp_path / "2.png"))
+    assert len(opened) > 5 and all(c.closed for c in opened)
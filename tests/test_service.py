@@ -0,0 +1,55 @@
+"""ConversionService recovering from a worker process that died"""
+import multiprocessing
+import os
+import shutil
+import socket
+import time
+
+import pytest
+
+from bench.make_rpk import make_rpk
+from service import WORKER_DIED, ConversionService, QueueFull
+
+
+def wait_for(predicate, timeout=60):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def queue(service, rpk_path):
+    job = service.reserve(os.path.basename(rpk_path))
+    shutil.copy(rpk_path, job.rpk_path)
+    service.submit(job)
+    return job.id
+
+
+def test_killed_worker_fails_its_job_and_frees_the_slot(tmp_path):
+    # accepts connections and never answers, the downloads of the job hang
+    silent = socket.socket()
+    silent.bind(("127.0.0.1", 0))
+    silent.listen(64)
+    hanging = str(tmp_path / "hanging.rpk")
+    make_rpk(hanging, cards=20, cats=2, tpls=2, bundled=0, remote=5,
+             base_url=f"http://127.0.0.1:{silent.getsockname()[1]}")
+    quick = str(tmp_path / "quick.rpk")
+    make_rpk(quick, cards=20, cats=2, tpls=2, bundled=2, remote=0)
+    service = ConversionService(str(tmp_path / "jobs"), workers=1, max_queued=0)
+    try:
+        job_id = queue(service, hanging)
+        wait_for(lambda: service.get(job_id)["state"] == "running")
+        with pytest.raises(QueueFull):
+            # the only slot is taken
+            service.reserve("more.rpk")
+        for process in multiprocessing.active_children():
+            process.kill()
+        wait_for(lambda: service.get(job_id)["state"] == "failed")
+        assert service.get(job_id)["error"] == WORKER_DIED
+        # the slot is free again, and the new pool converts
+        job_id = queue(service, quick)
+        wait_for(lambda: service.get(job_id)["state"] in ("done", "failed"))
+        assert service.get(job_id)["state"] == "done"
+    finally:
+        service.close()
+        silent.close()
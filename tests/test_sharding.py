@@ -0,0 +1,94 @@
+"""shard plans cover every card of the deck exactly once"""
+import io
+import json
+import time
+import zipfile
+from collections import OrderedDict
+
+import pytest
+
+from bench.make_rpk import make_rpk
+from sharding import UNCATEGORIZED, plan_by_category, plan_by_size, plan_shards, top_categories
+
+
+def cats_of(*rows):
+    return OrderedDict((aid, {"aid": aid, "pid": pid, "name": f"c{aid}"}) for aid, pid in rows)
+
+
+def card(cid, aid, tid=100, is_back=0, text=""):
+    return {"cid": cid, "aid": aid, "tid": tid, "is_back": is_back, "data": {"q": text}}
+
+
+def read_cards(rpk):
+    with zipfile.ZipFile(rpk) as z, z.open("data/cards.json") as f:
+        return json.load(io.TextIOWrapper(f, encoding="utf-8"))
+
+
+def assert_partition(shards, cards):
+    cids = [c["cid"] for shard in shards for c in shard.select(iter(cards))]
+    assert sorted(cids) == sorted(c["cid"] for c in cards)
+    assert [shard.cards for shard in shards] == [len(list(shard.select(iter(cards)))) for shard in shards]
+
+
+@pytest.fixture(scope="module")
+def rpk(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("deck") / "deck.rpk")
+    make_rpk(path, cards=3000, cats=60, tpls=8, bundled=20, remote=0, media_kb=4)
+    return path
+
+
+@pytest.mark.parametrize("options", [
+    {"by_category": True}, {"max_cards": 250}, {"max_bytes": 40 * 1024}, {"max_cards": 100, "max_bytes": 40 * 1024},
+])
+def test_shards_of_an_rpk_hold_the_whole_deck(rpk, options):
+    shards = plan_shards(rpk, **options)
+    assert len(shards) > 1
+    assert_partition(shards, read_cards(rpk))
+    if "max_cards" in options:
+        assert max(s.cards for s in shards) <= options["max_cards"]
+
+
+def test_shard_cats_include_the_parents(rpk):
+    with zipfile.ZipFile(rpk) as z, z.open("data/cats.json") as f:
+        cats = {x["aid"]: x for x in json.load(io.TextIOWrapper(f, encoding="utf-8"))}
+    for shard in plan_shards(rpk, max_cards=250):
+        assert all(cats[aid]["pid"] in shard.cats for aid in shard.cats if cats[aid]["pid"])
+
+
+def test_by_category_with_cycles_and_orphan_pids():
+    # 1 <- 2 <- 3, 4 <-> 5 in a cycle, 6 under a missing 99, 7 its own parent
+    cats = cats_of((1, 0), (2, 1), (3, 2), (4, 5), (5, 4), (6, 99), (7, 7))
+    tops = top_categories(cats)
+    assert tops[1] == tops[2] == tops[3] == 1
+    assert tops[4] == tops[5] and tops[4] in (4, 5)
+    assert tops[6] == 6 and tops[7] == 7
+    # 0 and 42 are not categories, they go to the shard of the cards without one
+    cards = [card(i, aid) for i, aid in enumerate([3, 2, 0, 5, 4, 6, 42, 7, 1, 0])]
+    shards = plan_by_category(iter(cards), cats)
+    assert_partition(shards, cards)
+    assert [s.cards for s in shards] == [3, 2, 1, 1, 3]
+    assert shards[-1].name.endswith(UNCATEGORIZED)
+    assert shards[-1].aids == {0, 42}
+    assert shards[0].cats == {1, 2, 3}
+
+
+def test_deep_chain_of_categories_is_linear():
+    depth = 40000
+    cats = cats_of(*((aid, aid + 1 if aid < depth else 0) for aid in range(1, depth + 1)))
+    start = time.perf_counter()
+    tops = top_categories(cats)
+    assert time.perf_counter() - start < 2
+    assert set(tops.values()) == {depth}
+
+
+def test_by_size_counts_a_shared_file_once_per_shard():
+    sizes = {"a.png": 1000, "b.png": 1000}
+    cats = cats_of((1, 0), (2, 1))
+    cards = [card(i, 2, text=f"[image:{'a' if i % 2 else 'b'}.png]") for i in range(10)]
+    shards = plan_by_size(iter(cards), cats, max_bytes=2500, sizes=sizes)
+    assert_partition(shards, cards)
+    assert len(shards) == 1
+    assert shards[0].cats == {1, 2}
+    shards = plan_by_size(iter(cards), cats, max_cards=3, max_bytes=2500, sizes=sizes)
+    assert [s.span for s in shards] == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    assert_partition(shards, cards)
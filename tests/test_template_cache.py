@@ -0,0 +1,55 @@
+"""TemplateCache in memory and in its sqlite file"""
+import sqlite3
+
+import template_cache
+from template_cache import TemplateCache
+
+
+def tpl(i):
+    return {"tid": i, "name": f"t{i}", "html": f"<div>{i}</div>"}
+
+
+def test_memory_keeps_the_most_recently_used(tmp_path):
+    cache = TemplateCache(max_entries=3)
+    for i in range(5):
+        cache.put(tpl(i), [i])
+    assert cache.get(tpl(0)) is None
+    assert cache.get(tpl(2)) == [2]
+    cache.put(tpl(5), [5])
+    # 3 was the least recently used once 2 was read
+    assert cache.get(tpl(3)) is None
+    assert [cache.get(tpl(i)) for i in (2, 4, 5)] == [[2], [4], [5]]
+    assert len(cache.memory) == 3
+
+
+def test_entries_dropped_from_memory_are_read_back_from_the_file(tmp_path):
+    cache = TemplateCache(str(tmp_path), max_entries=2)
+    for i in range(4):
+        cache.put(tpl(i), {"models": i})
+    assert cache.get(dict(tpl(0), tid=99)) == {"models": 0}
+    assert len(cache.memory) == 2
+    assert TemplateCache(str(tmp_path)).get(tpl(3)) == {"models": 3}
+
+
+def test_connections_are_closed(tmp_path, monkeypatch):
+    opened = []
+    real_connect = sqlite3.connect
+
+    class Connection(sqlite3.Connection):
+        closed = False
+
+        def close(self):
+            self.closed = True
+            super().close()
+
+    def connect(*args, **kwargs):
+        opened.append(real_connect(*args, factory=Connection, **kwargs))
+        return opened[-1]
+
+    monkeypatch.setattr(template_cache.sqlite3, "connect", connect)
+    cache = TemplateCache(str(tmp_path), max_entries=1)
+    cache.put(tpl(1), [1])
+    cache.put(tpl(2), [2])
+    assert cache.get(tpl(1)) == [1]
+    assert cache.get(tpl(3)) is None
+    assert len(opened) == 5 and all(c.closed for c in opened)
@@ -0,0 +1,25 @@
+"""util.convert_to_apkg_format against the chained regexes it replaced"""
+import pytest
+
+from bench.bench_fields import convert_chained, random_fields
+from util import convert_to_apkg_format
+
+GOLDEN = [
+    None, "", 0, 1, 12.5, "plain text", "  padded  ", "冒险举动；轻举妄动",
+    "[audio:aws_a.mp3]", "[audio:b.mp3]", "[audio:aws_]", "x [audio:aws_[audio:c.mp3] y",
+    "[image:a.png]", "[image:]", "[image:a.png][image:b.png]", "[image:a]b]", "[image:[image:a.png]]",
+    "__word__", "__ word __", "a __b__ c __d__", "__a,b__", "____", "___a___", "__" + "x" * 100 + "__",
+    "__" + "x" * 101 + "__", "__a\nb__", "{{c1::  spaced  }}", "{{c1::a}} {{c1:: b }}", "{{c1::}}",
+    "[hide:secret]", "[hide: spaced ]", "[hide:__x__]", "[hide:[image:a.png]]", "__[hide:x]__",
+    "[image:__a__.png]", "[audio:aws___x__.mp3]", "<b>__bold__</b>", "\t__x__\n", "[Image:a.png]",
+    "[hide:a][hide:b]", "{{c1::__x__}}", "__{{c1::x}}__", "[hide:x", "[image:x", "[audio:", "_ _ _",
+]
+
+@pytest.mark.parametrize("field", GOLDEN)
+def test_golden_fields_match_the_chained_regexes(field):
+    assert convert_to_apkg_format(field) == convert_chained(field)
+
+
+def test_random_markup_matches_the_chained_regexes():
+    for field in random_fields(200000):
+        assert convert_to_apkg_format(field) == convert_chained(field), repr(field)
@@ -1,13 +1,16 @@
+import hashlib
+import html
 import os
 import re
 import sys
+from urllib.parse import unquote
 
 
 def resource_path(relative_path):
     if getattr(sys, 'frozen', False):
         base_path = sys._MEIPASS
     else:
-        base_path = os.path.abspath(".")
+        base_path = os.path.dirname(os.path.abspath(__file__))
     return os.path.join(base_path, relative_path)
 
 
@@ -15,15 +18,64 @@ def is_capital_letter(char):
     return len(char) == 1 and char.isupper()
 
 
+IMAGE_RE = re.compile(r"\[image:(.*?)\]")
+CLOZE_RE = re.compile(r"__([^_,]{1,100}?)__")
+CLOZE_SPACES_RE = re.compile(r"{{c1::\s*(.*?)\s*}}")
+HIDE_RE = re.compile(r"\[hide:(.*?)\]")
+# anything any of the rewrites below could match, most fields have none of it
+MARKUP_RE = re.compile(r"\[(?:audio|image|hide):|__|{{c1::")
+
+
+IMG_SRC_RE = re.compile(r"<img[^>]+src=[\"']?([^\"'>]+)[\"']?[^>]*>", re.IGNORECASE)
+HTML_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+HTML_TAG_RE = re.compile(r"<.*?>", re.DOTALL)
+# [image:x] / [audio:x], the only way a name with spaces is referenced
+MEDIA_MARKUP_RE = re.compile(r"\[(?:image|audio):(.*?)\]")
+# anything looking like a file name: src="x.png", url(./x.png), [sound:x.mp3], a bare x.mp3
+MEDIA_TOKEN_RE = re.compile(r"[^\s\"'<>()\[\]{}|:;,=]+\.[0-9A-Za-z]{1,5}\b")
+
+
+def media_references(text):
+    """the media file names a field or template may point at, a superset: also any word with an extension"""
+    refs = set()
+    if "." not in text:
+        return refs
+    refs.update(MEDIA_MARKUP_RE.findall(text))
+    for token in MEDIA_TOKEN_RE.findall(text):
+        refs.add(token)
+        # ./x.png, //host/dir/x.png, x%20y.png
+        refs.add(os.path.basename(unquote(token)))
+    # [audio:aws_x] becomes [sound:x]
+    refs.update([x[len("aws_"):] for x in refs if x.startswith("aws_")])
+    return refs
+
+
+def field_checksum(f):
+    """the csum anki computes for the first field: sha1 of the text without html, images kept by filename"""
+    f = IMG_SRC_RE.sub(r" \1 ", f)
+    f = HTML_TAG_RE.sub("", HTML_COMMENT_RE.sub("", f))
+    f = html.unescape(f).strip()
+    return int(hashlib.sha1(f.encode("utf-8")).hexdigest()[:8], 16)
+
+
 def convert_to_apkg_format(f):
     if not f:
         return ""
     f = str(f)
-    f = f.replace(r"[audio:aws_", "[sound:")
-    f = f.replace(r"[audio:", "[sound:")
-    f = re.sub(r"\[image:(.*?)\]", r'<img src="\1">', f)
-    f = re.sub(r"__([^_,]{1,100}?)__", r"{{c1::\1}}", f)
+    if MARKUP_RE.search(f) is None:
+        return f.strip()
+    # the rewrites feed into each other (a cloze made from __x__ gets its spaces removed, [hide:] wraps clozes),
+    # so they run in this order, each one skipped when its markup is not in the current text
+    if "[audio:" in f:
+        f = f.replace(r"[audio:aws_", "[sound:")
+        f = f.replace(r"[audio:", "[sound:")
+    if "[image:" in f:
+        f = IMAGE_RE.sub(r'<img src="\1">', f)
+    if "__" in f:
+        f = CLOZE_RE.sub(r"{{c1::\1}}", f)
     # remove spaces in cloze
-    f = re.sub(r"{{c1::\s*(.*?)\s*}}", r"{{c1::\1}}", f)
-    f = re.sub(r"\[hide:(.*?)\]", r"{{c1::\1}}", f)
+    if "{{c1::" in f:
+        f = CLOZE_SPACES_RE.sub(r"{{c1::\1}}", f)
+    if "[hide:" in f:
+        f = HIDE_RE.sub(r"{{c1::\1}}", f)
     return f.strip()